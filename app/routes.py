@@ -1,18 +1,105 @@
 from flask import Flask, render_template, request
 from utils.vectorizer import process_and_encode_articles,encode_dataset, preprocess_text, download_parse_article
-from utils.indexer import get_index, index_dataset,similarity_search
+from utils.indexer import get_index, index_dataset,similarity_search, served_index, sharded_index
 from utils.util import read_from_partitions,read_from_local_partitions
+from utils.models import warm_up
+from utils.cache import embedding_cache, result_cache, search_cache, normalize_query, canonical_url
+from utils.neighbors import neighbor_table
+from utils.metadata import article_metadata, filtered_search
+from utils.store import article_store
 import pandas as pd
+import numpy as np
+import os
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 from flask import Flask, jsonify, session
 from creds import awsconfig
 from news_articles.news_articles.spider_runner import NewsArticleSpiderRunner
 
 app = Flask(__name__)
 
+# Limits of the batch recommendation API: queries per request, results per query (k + offset), texts summarized at once
+API_MAX_QUERIES = int(os.environ.get('NEWSREC_API_MAX_QUERIES', 64))
+API_MAX_RESULTS = int(os.environ.get('NEWSREC_API_MAX_RESULTS', 100))
+API_BATCH_SIZE = int(os.environ.get('NEWSREC_API_BATCH_SIZE', 8))
+
+# Threads scraping the URLs of the API queries, shared by all requests
+API_SCRAPE_WORKERS = int(os.environ.get('NEWSREC_API_SCRAPE_WORKERS', 8))
+scrape_pool = ThreadPoolExecutor(max_workers=API_SCRAPE_WORKERS)
+
+# Load the models at startup so that requests only pay for inference
+if os.environ.get('NEWSREC_WARM_UP') == '1':
+    warm_up()
+
+def index_version():
+    # Version of the searched index, the query caches are emptied when it changes
+    if os.environ.get('NEWSREC_SHARDED') == '1':
+        return sharded_index.version
+    served_index.snapshot()
+    return (served_index.version, served_index.generation)
+
+def filters_supported():
+    # Filters select the articles by their metadata
+    return article_metadata.available
+
+def search_index(vec, k, filters=None, version=None):
+    # Reuse the top-k ids of an embedding already searched with the same filters
+    key = (hashlib.sha256(vec.tobytes()).hexdigest(), k, repr(sorted((filters or {}).items())))
+    cached = search_cache.get(key, version)
+    if cached is not None:
+        return cached
+
+    # Search the embedding partitions shard by shard if NEWSREC_SHARDED=1, the published index otherwise
+    # A positional index returns rows of the embeddings, translated with its row ids (None if it returns article ids)
+    if os.environ.get('NEWSREC_SHARDED') == '1':
+        index, embeddings, row_ids = sharded_index, None, None
+    else:
+        index, embeddings, row_ids = served_index.snapshot(with_ids=True)
+
+    if filters:
+        if not filters_supported():
+            raise ValueError("Filters need the article metadata")
+        selected = article_metadata.select(**filters)
+        if row_ids is not None:
+            rows = row_ids.to_rows(selected)
+            selected = np.sort(rows[rows >= 0])
+        D, I = filtered_search(vec, k, index, selected, embeddings=embeddings)
+    else:
+        D, I = similarity_search(vec, k, index, embeddings)
+    if row_ids is not None:
+        I = row_ids.to_ids(I)
+    search_cache.put(key, (D, I), version)
+    return D, I
+
+def read_articles(ids):
+    # Read the headline and link of the articles from the article store, or from the CSV partitions without one
+    if article_store.available:
+        return article_store.get(ids)
+    return read_from_local_partitions(ids)
+
+def request_filters(fields=None):
+    # Optional category and date range fields of the search forms, or of the filters of an API request
+    if fields is None:
+        # The forms only show the filter fields when filters are supported, ignore them otherwise
+        fields = request.form if filters_supported() else {}
+    filters = {}
+    if fields.get('category'):
+        filters['categories'] = [fields['category']]
+    for name in ('start_date', 'end_date'):
+        if fields.get(name):
+            try:
+                if not isinstance(fields[name], str):
+                    raise TypeError(fields[name])
+                pd.Timestamp(fields[name])
+            except (ValueError, TypeError):
+                raise ValueError(f"Invalid {name} {fields[name]!r}, expected a date such as 2020-01-31")
+            filters[name] = fields[name]
+    return filters
+
 @app.route('/')
 def index():
-    # Render the main page with the input form
-    return render_template('index.html')
+    # Render the main page with the input form, with the filter fields when filtered searches are supported
+    return render_template('index.html', filters=filters_supported())
 
 @app.route('/search_paragraph', methods=['POST'])
 def search_paragraph():
@@ -21,27 +108,51 @@ def search_paragraph():
         if len(text_passage) <100:
             return render_template('error.html', message="Paragraph too Short. Minimum 100 characters required.")
 
+        # Repeated paragraphs are served from the result cache
+        try:
+            filters = request_filters()
+        except ValueError as e:
+            return render_template('error.html', message=str(e))
+        version = index_version()
+        key = ('paragraph', normalize_query(text_passage), repr(sorted(filters.items())))
+        result = result_cache.get(key, version)
+        if result is not None:
+            return render_template('results.html', results= result)
+
         summary, embedding = process_and_encode_articles([text_passage])
 
-        index = get_index()
-        D, I = similarity_search(embedding[0].reshape(1,-1), 5, index)
+        D, I = search_index(embedding[0].reshape(1,-1), 5, filters, version)
+        if (I[0] < 0).all():
+            return render_template('error.html', message="No article matches the filters.")
 
         bucket_name = 'hrnewsarticles'
         base_file_path = 'NYTimes'
         aws_access_key_id = awsconfig["aws_access_key_id"]
         aws_secret_access_key =awsconfig["aws_secret_access_key"]
-        df =read_from_local_partitions(I[0], 990)
+        df =read_articles(I[0][I[0] >= 0])
 
         # To enable AWS:
-        #df = read_from_partitions(bucket_name, base_file_path,  I[0], 990, aws_access_key_id, aws_secret_access_key)
+        #df = read_from_partitions(bucket_name, base_file_path,  I[0], None, aws_access_key_id, aws_secret_access_key)
 
         result = {i:j for i,j in zip(df['headline'],df['link'])}
+        result_cache.put(key, result, version)
         return render_template('results.html', results= result)
 
 @app.route('/search_url', methods=['POST'])
 def search_url():
         selected_source = request.form.get('source')
 
+        # Repeated articles are served from the result cache without scraping them again
+        try:
+            filters = request_filters()
+        except ValueError as e:
+            return render_template('error.html', message=str(e))
+        version = index_version()
+        key = ('url', selected_source, canonical_url(request.form['url']), repr(sorted(filters.items())))
+        result = result_cache.get(key, version)
+        if result is not None:
+            return render_template('results.html', results= result)
+
         if selected_source == 'huffpost':
             # Use customized scraper for Huffpost
              print("running spider")
@@ -55,21 +166,237 @@ def search_url():
 
         summary, embedding = process_and_encode_articles([text_passage])
 
-        index = get_index()
-        D, I = similarity_search(embedding[0].reshape(1,-1), 5, index)
+        D, I = search_index(embedding[0].reshape(1,-1), 5, filters, version)
+        if (I[0] < 0).all():
+            return render_template('error.html', message="No article matches the filters.")
 
         bucket_name = 'hrnewsarticles'
         base_file_path = 'NYTimes'
         aws_access_key_id = awsconfig["aws_access_key_id"]
         aws_secret_access_key =awsconfig["aws_secret_access_key"]
-        df =read_from_local_partitions(I[0], 990)
+        df =read_articles(I[0][I[0] >= 0])
         # To enable AWS:
-        #df = read_from_partitions(bucket_name, base_file_path,  I[0], 990, aws_access_key_id, aws_secret_access_key)
+        #df = read_from_partitions(bucket_name, base_file_path,  I[0], None, aws_access_key_id, aws_secret_access_key)
 
         result = {i:j for i,j in zip(df['headline'],df['link'])}
+        result_cache.put(key, result, version)
         return render_template('results.html', results= result)
 
 
+@app.route('/related/<int:article_id>')
+def related(article_id):
+    # Serve the precomputed related articles of an article of the corpus
+    k = request.args.get('k', type=int)
+    if k is not None and k < 0:
+        return jsonify(error="k must be a non-negative integer"), 400
+    neighbors = neighbor_table.related(article_id, k)
+    if neighbors is None:
+        return jsonify(error=f"Unknown article {article_id}"), 404
+
+    ids, distances = neighbors
+    return jsonify(id=article_id, related=ids, distances=distances)
+
+
+def scrape_url(url, source=None):
+    # Text of an article, with the customized scraper for Huffpost
+    if source == 'huffpost':
+        return preprocess_text(NewsArticleSpiderRunner.run_spider(url)[0])
+    return preprocess_text(download_parse_article(url))
+
+def article_vectors(ids):
+    # Vectors of articles of the corpus, None for the ids the searched index does not hold
+    if os.environ.get('NEWSREC_SHARDED') == '1':
+        return [None] * len(ids)
+
+    index, embeddings, row_ids = served_index.snapshot(with_ids=True)
+    # ID-mapped indexes and their re-ranking vectors are keyed on the article ids, positional ones on rows
+    rows = ids if row_ids is None else row_ids.to_rows(ids).tolist()
+    vectors = []
+    for row in rows:
+        try:
+            if row < 0:
+                raise IndexError(row)
+            if embeddings is not None:
+                vector = np.asarray(embeddings[np.array([row])], dtype=np.float32)[0]
+            else:
+                vector = index.reconstruct(row)
+        except (IndexError, RuntimeError):
+            vector = None
+        vectors.append(None if vector is None or np.isnan(vector).any() else vector)
+    return vectors
+
+def api_queries(payload):
+    # Paragraphs, URLs (strings or objects with a 'url' and a 'source') and article ids of a request
+    queries = []
+    for i, text in enumerate(payload.get('paragraphs') or []):
+        query = {'type': 'paragraph', 'index': i, 'paragraph': text}
+        if not isinstance(text, str):
+            query['error'] = "Expected a string"
+        elif len(text) < 100:
+            query['error'] = "Paragraph too Short. Minimum 100 characters required."
+        queries.append(query)
+    for i, url in enumerate(payload.get('urls') or []):
+        url, source = (url.get('url'), url.get('source')) if isinstance(url, dict) else (url, None)
+        query = {'type': 'url', 'index': i, 'url': url, 'source': source}
+        if not isinstance(url, str):
+            query['error'] = "Expected a URL"
+        queries.append(query)
+    for i, article_id in enumerate(payload.get('ids') or []):
+        query = {'type': 'id', 'index': i, 'id': article_id}
+        if not isinstance(article_id, int) or isinstance(article_id, bool):
+            query['error'] = "Expected an integer id"
+        queries.append(query)
+    return queries
+
+def rank_queries(queries, depth, filters, version):
+    """
+    Rank the articles of a batch of queries, running every stage once for the whole batch
+
+    Parameters:
+    - queries (list): the queries of api_queries, given an 'error' when they cannot be ranked
+    - depth (int): the number of ranked articles per query
+    - filters (dict): the category and date filters, see ArticleMetadata.select
+    - version: the version of the searched index
+
+    Returns:
+    None: the ids and distances of the articles are set as the 'ranking' of every query
+    """
+    pending = []
+    for query in queries:
+        query['ranking'] = None
+        if 'error' in query:
+            continue
+        if query['type'] == 'paragraph':
+            value = normalize_query(query['paragraph'])
+        elif query['type'] == 'url':
+            value = (query['source'], canonical_url(query['url']))
+        else:
+            value = query['id']
+        # A ranking cached for a deeper page also serves the pages before it
+        query['key'] = ('api', query['type'], value, repr(sorted(filters.items())))
+        cached = result_cache.get(query['key'], version)
+        if cached is not None and cached[0] >= depth:
+            query['ranking'] = cached[1][:depth]
+        else:
+            pending.append(query)
+
+    # Precomputed related articles of known ids, when the table is deep enough and no filter applies,
+    # the vectors of the ids are searched otherwise
+    for query in [query for query in pending if query['type'] == 'id']:
+        try:
+            neighbors = None if filters else neighbor_table.related(query['id'], depth)
+        except (OSError, ValueError):
+            neighbors = None
+        if neighbors is not None and len(neighbors[0]) >= depth:
+            query['ranking'] = [(article_id, distance) for article_id, distance in zip(*neighbors)]
+
+    # Scrape the URLs concurrently
+    urls = [query for query in pending if query['type'] == 'url']
+    def scrape(query):
+        try:
+            query['text'] = scrape_url(query['url'], query['source'])
+        except Exception as e:
+            query['error'] = f"Could not read the article: {e}"
+    list(scrape_pool.map(scrape, [query for query in urls if query['source'] != 'huffpost']))
+    for query in urls:
+        if query['source'] == 'huffpost':
+            scrape(query)
+
+    # Summarize and encode the paragraphs and the articles in batches
+    for query in pending:
+        if query['type'] == 'paragraph':
+            query['text'] = query['paragraph']
+    texts = [query for query in pending if 'text' in query]
+    if texts:
+        summaries, embeddings = process_and_encode_articles([query['text'] for query in texts], batch_size=API_BATCH_SIZE)
+        for query, embedding in zip(texts, embeddings):
+            query['vector'] = embedding
+
+    # Vectors of the other known ids
+    ids = [query for query in pending if query['type'] == 'id' and query['ranking'] is None]
+    for query, vector in zip(ids, article_vectors([query['id'] for query in ids])):
+        if vector is None:
+            query['error'] = f"Unknown article {query['id']}"
+        else:
+            query['vector'] = vector
+
+    # Search all the vectors at once, one more result to leave out the article of an id query
+    searched = [query for query in pending if 'vector' in query]
+    if searched:
+        D, I = search_index(np.stack([query['vector'] for query in searched]).astype(np.float32), depth + 1, filters,
+                            version)
+        for query, distances, indices in zip(searched, D, I):
+            ranking = [(int(i), float(d)) for i, d in zip(indices, distances) if i >= 0 and i != query.get('id')]
+            query['ranking'] = ranking[:depth]
+
+    for query in pending:
+        if query['ranking'] is not None:
+            result_cache.put(query['key'], (depth, query['ranking']), version)
+
+@app.route('/api/recommend', methods=['POST'])
+def api_recommend():
+    """
+    Recommend articles for a batch of paragraphs, URLs and article ids
+
+    The JSON body holds 'paragraphs', 'urls' and 'ids' lists, the number of results per query 'k' (default 5),
+    the 'offset' of the page (default 0) and optional 'filters' ('category', 'start_date', 'end_date').
+    """
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict):
+        return jsonify(error="Expected a JSON object"), 400
+    if any(not isinstance(payload.get(name) or [], list) for name in ('paragraphs', 'urls', 'ids')):
+        return jsonify(error="paragraphs, urls and ids must be lists"), 400
+    if not isinstance(payload.get('filters') or {}, dict):
+        return jsonify(error="filters must be an object"), 400
+    queries = api_queries(payload)
+    k, offset = payload.get('k', 5), payload.get('offset', 0)
+    if not queries:
+        return jsonify(error="No paragraphs, urls or ids given"), 400
+    if len(queries) > API_MAX_QUERIES:
+        return jsonify(error=f"At most {API_MAX_QUERIES} queries per request"), 400
+    if not isinstance(k, int) or not isinstance(offset, int) or k < 1 or offset < 0 or k + offset > API_MAX_RESULTS:
+        return jsonify(error=f"k must be positive, offset non-negative and k + offset at most {API_MAX_RESULTS}"), 400
+
+    try:
+        filters = request_filters(payload.get('filters') or {})
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    if filters and not filters_supported():
+        return jsonify(error="Filters are not available, the article metadata is missing"), 400
+    # One more article than the page tells whether a next page exists
+    rank_queries(queries, offset + k + 1, filters, index_version())
+
+    # Read the headline and link of every recommended article at once
+    for query in queries:
+        query['page'] = (query['ranking'] or [])[offset:offset + k]
+    ids = sorted({article_id for query in queries for article_id, _ in query['page']})
+    articles = read_articles(ids) if ids else pd.DataFrame(columns=['Index', 'headline', 'link'])
+    articles = articles.astype(object).where(articles.notna(), None)
+    articles = {row['Index']: row for row in articles.to_dict('records')}
+
+    results = []
+    for query in queries:
+        result = {'type': query['type'], 'index': query['index']}
+        if query['type'] != 'paragraph':
+            result[query['type']] = query[query['type']]
+        if query['ranking'] is None:
+            result['error'] = query.get('error', "Could not rank the query")
+        else:
+            result['results'] = [{'id': article_id, 'headline': articles[article_id]['headline'],
+                                  'link': articles[article_id]['link'], 'distance': distance}
+                                 for article_id, distance in query['page'] if article_id in articles]
+            result['next_offset'] = offset + k if len(query['ranking']) > offset + k else None
+        results.append(result)
+    return jsonify(k=k, offset=offset, results=results)
+
+
+@app.route('/stats')
+def stats():
+    # Report the hit/miss counters of the summary and embedding cache and of the query caches
+    return jsonify(embedding_cache=embedding_cache.stats(), result_cache=result_cache.stats(),
+                   search_cache=search_cache.stats())
+
+
 # @app.route('/search_url', methods=['POST'])
 # def search_url():
 #
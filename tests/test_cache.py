@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+
+from utils import cache
+from utils.cache import QueryCache
+
+
+def test_new_index_version_empties_the_cache():
+    query_cache = QueryCache(max_entries=10, ttl_s=60)
+    query_cache.put('query', [1, 2, 3], version=('v1', 1))
+    assert query_cache.get('query', version=('v1', 1)) == [1, 2, 3]
+
+    # Changes applied to the served index bump its generation
+    assert query_cache.get('query', version=('v1', 2)) is None
+    query_cache.put('query', [4], version=('v1', 2))
+    assert query_cache.get('query', version=('v2', 0)) is None
+    assert query_cache.stats()['entries'] == 0
+    assert (query_cache.hits, query_cache.misses) == (1, 2)
+
+
+def test_entries_expire_and_least_recently_used_are_evicted(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache.time, 'monotonic', lambda: now[0])
+    query_cache = QueryCache(max_entries=2, ttl_s=60)
+    query_cache.put('a', 1)
+    query_cache.put('b', 2)
+    assert query_cache.get('a') == 1
+    query_cache.put('c', 3)
+    assert query_cache.get('b') is None
+    assert query_cache.get('a') == 1
+
+    now[0] += 61
+    assert query_cache.get('a') is None and query_cache.get('c') is None
+
+
+def test_rebuilt_shards_change_the_sharded_version(tmp_path):
+    pytest.importorskip('faiss')
+    from utils.indexer import ShardedIndex, build_shards
+
+    rng = np.random.default_rng(0)
+    for number in (1, 2):
+        np.save(tmp_path / f'NYTimes_part_{number}.npy', rng.standard_normal((20, 4)).astype(np.float32))
+    build_shards(str(tmp_path))
+    sharded = ShardedIndex(str(tmp_path), check_interval=0)
+    version = sharded.version
+    assert sharded.search(np.load(tmp_path / 'NYTimes_part_2.npy')[:1], 1)[1].tolist() == [[21]]
+    assert sharded.version == version
+
+    # Rewritten partition and shard files give a new version, searched on the rebuilt shards
+    np.save(tmp_path / 'NYTimes_part_2.npy', rng.standard_normal((30, 4)).astype(np.float32))
+    build_shards(str(tmp_path))
+    assert sharded.version != version
+    assert sharded.ntotal == 50
@@ -0,0 +1,50 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from utils import dedup
+from utils.dedup import NearDuplicateIndex, drop_near_duplicates, load_or_create
+
+WORDS = [f'word{i}' for i in range(2000)]
+
+
+def article(rng, words=150):
+    return ' '.join(rng.choice(WORDS, words))
+
+
+def edited(text, rng):
+    # A copy with one word replaced, well above the similarity threshold
+    words = text.split()
+    words[rng.integers(len(words))] = 'edited'
+    return ' '.join(words)
+
+
+@pytest.mark.parametrize('merge_keys', [dedup.MIN_MERGE_KEYS, 0])
+def test_save_load_extends_the_kept_articles(tmp_path, monkeypatch, merge_keys):
+    # Band keys looked up in the hash buckets, or merged into the sorted keys with every batch
+    monkeypatch.setattr(dedup, 'MIN_MERGE_KEYS', merge_keys)
+    rng = np.random.default_rng(0)
+    texts = [article(rng) for _ in range(50)]
+    index = NearDuplicateIndex()
+    kept = drop_near_duplicates(pd.DataFrame({'text': texts + [edited(texts[3], rng)]}), index)
+    assert len(kept) == 50
+    assert index.ids.tolist() == list(range(1, 51))
+
+    path = str(tmp_path / 'near_duplicates.npz')
+    index.save(path)
+    loaded = load_or_create(path)
+    assert loaded.threshold == index.threshold
+    assert (loaded.ids == index.ids).all() and (loaded.signatures == index.signatures).all()
+
+    # A later ingest removes the copies of saved articles and numbers its articles after them
+    fresh = [article(rng) for _ in range(3)]
+    batch = pd.DataFrame({'text': [edited(texts[10], rng)] + fresh + [edited(fresh[0], rng)]})
+    kept = drop_near_duplicates(batch, loaded)
+    assert kept['text'].tolist() == fresh
+    assert loaded.ids.tolist()[-3:] == [51, 52, 53]
+    assert loaded.next_id == 54
+
+
+def test_load_or_create_without_a_saved_index(tmp_path):
+    index = load_or_create(str(tmp_path / 'missing.npz'), threshold=0.9)
+    assert len(index) == 0 and index.threshold == 0.9 and index.next_id == 1
@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+
+faiss = pytest.importorskip('faiss')
+
+from utils.indexer import ChangeLog, ServedIndex, build_index, compact_index, read_version
+
+ARTICLES, DIM = 200, 8
+
+
+@pytest.fixture
+def embeddings_path(tmp_path):
+    rng = np.random.default_rng(0)
+    path = tmp_path / 'embeddings.npy'
+    np.save(path, rng.standard_normal((ARTICLES, DIM)).astype(np.float32))
+    # Article ids that are not the row positions
+    np.save(tmp_path / 'embeddings.ids.npy', np.arange(ARTICLES, dtype=np.int64) * 3 + 10)
+    return str(path)
+
+
+def nearest(served, vectors):
+    return served.get().search(np.asarray(vectors, dtype=np.float32), 1)[1][:, 0].tolist()
+
+
+def test_change_log_round_trip(embeddings_path, tmp_path):
+    index_dir = str(tmp_path / 'index')
+    build_index(embeddings_path, index_dir, 'flat', id_mapped=True)
+    served, log = ServedIndex(index_dir, check_interval=0), ChangeLog(index_dir)
+    embeddings, ids = np.load(embeddings_path), np.load(str(tmp_path / 'embeddings.ids.npy'))
+    assert nearest(served, embeddings[:2]) == ids[:2].tolist()
+
+    rng = np.random.default_rng(1)
+    moved, added = rng.standard_normal((2, DIM)).astype(np.float32) * 10
+    log.remove([ids[0]])
+    log.upsert([ids[1]], moved[None])
+    log.add([10000], added[None])
+    assert nearest(served, [moved, added]) == [ids[1], 10000]
+    assert nearest(served, [embeddings[0]]) != [ids[0]]
+    assert served.get().ntotal == ARTICLES
+
+    # Compaction publishes the changes as a new version with an empty log
+    version = read_version(index_dir)['version']
+    stamp = compact_index(index_dir)
+    assert stamp['version'] != version
+    assert log.read(stamp['version']) == ([], 0)
+    assert nearest(served, [moved, added]) == [ids[1], 10000]
+    assert served.version == stamp['version']
+    assert nearest(served, [embeddings[0]]) != [ids[0]]
+
+
+def test_change_log_needs_id_mapped_index(embeddings_path, tmp_path):
+    index_dir = str(tmp_path / 'index')
+    build_index(embeddings_path, index_dir, 'flat')
+    with pytest.raises(ValueError):
+        ChangeLog(index_dir).add([10000], np.zeros((1, DIM), dtype=np.float32))
+
+
+def test_positional_index_translates_rows(embeddings_path, tmp_path):
+    index_dir = str(tmp_path / 'index')
+    build_index(embeddings_path, index_dir, 'flat')
+    served = ServedIndex(index_dir, check_interval=0)
+    index, _, row_ids = served.snapshot(with_ids=True)
+    embeddings, ids = np.load(embeddings_path), np.load(str(tmp_path / 'embeddings.ids.npy'))
+
+    rows = index.search(embeddings[[5, 7]], 1)[1]
+    assert row_ids.to_ids(rows)[:, 0].tolist() == ids[[5, 7]].tolist()
+    assert row_ids.to_rows([ids[7], 11, ids[5]]).tolist() == [7, -1, 5]
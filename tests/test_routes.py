@@ -0,0 +1,75 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+routes = pytest.importorskip('app.routes')
+
+from utils.cache import QueryCache
+
+ARTICLES = 12
+
+
+class NoNeighbors:
+    # A related articles table that was not built
+    def related(self, article_id, k):
+        return None
+
+
+@pytest.fixture
+def client(monkeypatch):
+    # Articles 1..12 ranked in id order for every query, without the models or an index
+    def search_index(vec, k, filters=None, version=None):
+        ids = np.full((len(vec), k), -1, dtype=np.int64)
+        found = np.arange(1, min(k, ARTICLES) + 1)
+        ids[:, :len(found)] = found
+        return np.where(ids < 0, np.inf, ids).astype(np.float32), ids
+
+    def article_vectors(ids):
+        return [np.zeros(4, dtype=np.float32) if 1 <= article_id <= ARTICLES else None for article_id in ids]
+
+    def read_articles(ids):
+        return pd.DataFrame({'Index': ids, 'headline': [f'headline {i}' for i in ids],
+                             'link': [f'link {i}' for i in ids]})
+
+    monkeypatch.setattr(routes, 'search_index', search_index)
+    monkeypatch.setattr(routes, 'article_vectors', article_vectors)
+    monkeypatch.setattr(routes, 'read_articles', read_articles)
+    monkeypatch.setattr(routes, 'neighbor_table', NoNeighbors())
+    monkeypatch.setattr(routes, 'result_cache', QueryCache())
+    monkeypatch.setattr(routes, 'index_version', lambda: 'test')
+    return routes.app.test_client()
+
+
+def recommend(client, **payload):
+    response = client.post('/api/recommend', json=payload)
+    assert response.status_code == 200
+    return response.get_json()['results'][0]
+
+
+def test_recommend_pages(client):
+    # The article of an id query is left out of its ranking, 11 articles remain
+    result = recommend(client, ids=[1], k=5)
+    assert [article['id'] for article in result['results']] == [2, 3, 4, 5, 6]
+    assert result['next_offset'] == 5
+
+    result = recommend(client, ids=[1], k=5, offset=5)
+    assert [article['id'] for article in result['results']] == [7, 8, 9, 10, 11]
+    assert result['next_offset'] == 10
+
+    result = recommend(client, ids=[1], k=5, offset=10)
+    assert [article['id'] for article in result['results']] == [12]
+    assert result['next_offset'] is None
+
+
+def test_recommend_last_full_page(client):
+    # A page ending on the last article has no next page
+    result = recommend(client, ids=[1], k=5, offset=6)
+    assert [article['id'] for article in result['results']] == [8, 9, 10, 11, 12]
+    assert result['next_offset'] is None
+
+
+def test_recommend_invalid_page(client):
+    response = client.post('/api/recommend', json={'ids': [1], 'k': 0})
+    assert response.status_code == 400
+    response = client.post('/api/recommend', json={'ids': [1], 'k': 5, 'offset': -1})
+    assert response.status_code == 400
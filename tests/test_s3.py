@@ -0,0 +1,193 @@
+import io
+import json
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+boto3 = pytest.importorskip('boto3')
+moto = pytest.importorskip('moto')
+mock_aws = getattr(moto, 'mock_aws', None) or moto.mock_s3
+
+from utils import s3
+from utils.s3 import SYNC_MANIFEST_KEY, PartitionCache, S3PartitionReader, file_sha256, read_parquet_rows, sync_to_s3
+from utils.util import partition_large_dataset, read_from_local_partitions, write_parquet_partitions
+
+BUCKET = 'newsrec-test'
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    with mock_aws():
+        # Clients created outside of the mock would reach AWS
+        s3.get_client.cache_clear()
+        client = s3.get_client()
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+    s3.get_client.cache_clear()
+
+
+def partition(first_id, rows):
+    ids = np.arange(first_id, first_id + rows)
+    return pd.DataFrame({'Index': ids, 'headline': [f'headline {i}' for i in ids], 'link': [f'link {i}' for i in ids]})
+
+
+def put_csv(client, key, df):
+    client.put_object(Bucket=BUCKET, Key=key, Body=df.to_csv(index=False).encode('utf-8'))
+
+
+def put_manifest(client, partitions):
+    manifest = {'partitions': [{'file': key, 'first_id': int(df['Index'].iloc[0]), 'last_id': int(df['Index'].iloc[-1])}
+                               for key, df in partitions]}
+    client.put_object(Bucket=BUCKET, Key='manifest.json', Body=json.dumps(manifest).encode('utf-8'))
+
+
+class CountingClient:
+    # Forwards to the S3 client and records the ranges of the GET requests
+    def __init__(self, client):
+        self.client = client
+        self.ranges = []
+
+    def get_object(self, **kwargs):
+        self.ranges.append(kwargs.get('Range'))
+        return self.client.get_object(**kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+
+def test_cache_revalidates_etag(client, tmp_path):
+    cache = PartitionCache(str(tmp_path))
+    put_csv(client, 'part_1.csv', partition(1, 10))
+
+    with cache.open(client, BUCKET, 'part_1.csv') as f:
+        assert pd.read_csv(f)['Index'].tolist() == list(range(1, 11))
+    with cache.open(client, BUCKET, 'part_1.csv') as f:
+        assert pd.read_csv(f)['Index'].tolist() == list(range(1, 11))
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    # A new version of the object changes its ETag and is downloaded again
+    put_csv(client, 'part_1.csv', partition(1, 5))
+    with cache.open(client, BUCKET, 'part_1.csv') as f:
+        assert pd.read_csv(f)['Index'].tolist() == list(range(1, 6))
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def test_cache_evicts_least_recently_used(client, tmp_path):
+    put_csv(client, 'part_1.csv', partition(1, 100))
+    put_csv(client, 'part_2.csv', partition(101, 100))
+    size = len(partition(1, 100).to_csv(index=False))
+    cache = PartitionCache(str(tmp_path), max_bytes=int(1.5 * size))
+
+    cache.open(client, BUCKET, 'part_1.csv').close()
+    cache.open(client, BUCKET, 'part_2.csv').close()
+    assert not (tmp_path / BUCKET / 'part_1.csv').exists()
+    assert (tmp_path / BUCKET / 'part_2.csv').exists()
+
+    # The evicted partition is downloaded again
+    cache.open(client, BUCKET, 'part_1.csv').close()
+    assert (cache.hits, cache.misses) == (0, 3)
+
+
+def test_read_rows_in_target_order(client, tmp_path):
+    partitions = [('NYTimes_part_1.csv', partition(1, 10)), ('NYTimes_part_2.csv', partition(11, 10))]
+    for key, df in partitions:
+        put_csv(client, key, df)
+    put_manifest(client, partitions)
+    reader = S3PartitionReader(BUCKET, 'NYTimes', cache=PartitionCache(str(tmp_path)))
+
+    df = reader.read_rows([15, 2, 12], columns=['headline'])
+    assert df['Index'].tolist() == [15, 2, 12]
+    assert df['headline'].tolist() == ['headline 15', 'headline 2', 'headline 12']
+
+
+def test_read_rows_without_matches(client, tmp_path):
+    partitions = [('NYTimes_part_1.csv', partition(1, 10))]
+    put_csv(client, *partitions[0])
+    put_manifest(client, partitions)
+    reader = S3PartitionReader(BUCKET, 'NYTimes', cache=PartitionCache(str(tmp_path)))
+
+    for target_indices in ([], [50]):
+        df = reader.read_rows(target_indices, columns=['headline', 'link'])
+        assert df.empty
+        assert list(df.columns) == ['Index', 'headline', 'link']
+
+
+def test_parquet_range_reads(client):
+    df = partition(1, 10000)
+    rng = np.random.default_rng(0)
+    df['text'] = [rng.bytes(100).hex() for _ in range(len(df))]
+    buffer = io.BytesIO()
+    pq.write_table(pa.Table.from_pandas(df, preserve_index=False), buffer, row_group_size=1000)
+    client.put_object(Bucket=BUCKET, Key='part_1.parquet', Body=buffer.getvalue())
+
+    counting = CountingClient(client)
+    rows = read_parquet_rows(counting, BUCKET, 'part_1.parquet', [2500, 7, 2501])
+    assert sorted(rows['Index'].tolist()) == [7, 2500, 2501]
+    assert rows.set_index('Index').loc[2500, 'headline'] == 'headline 2500'
+
+    # Only the footer and the headline, link and Index chunks of two row groups are downloaded
+    assert all(request_range is not None for request_range in counting.ranges)
+    downloaded = sum(int(end) - int(start) + 1
+                     for start, end in (request_range[len('bytes='):].split('-') for request_range in counting.ranges))
+    assert downloaded < len(buffer.getvalue()) / 10
+
+    assert read_parquet_rows(client, BUCKET, 'part_1.parquet', [20000]).empty
+
+
+def test_read_rows_from_parquet_partitions(client, tmp_path):
+    df = partition(1, 300).drop(columns=['Index'])
+    for column in ('text', 'short_description', 'date'):
+        df[column] = column
+    df.to_csv(tmp_path / 'dataset.csv', index=False)
+    folder = tmp_path / 'partitions'
+    partition_large_dataset(str(tmp_path / 'dataset.csv'), str(folder), rows_per_partition=100, max_workers=1)
+    write_parquet_partitions(str(folder), row_group_size=10, max_workers=1)
+    sync_to_s3(BUCKET, [(str(folder), '')])
+
+    reader = S3PartitionReader(BUCKET, 'NYTimes', cache=PartitionCache(str(tmp_path / 'cache')), file_format='parquet')
+    df = reader.read_rows([250, 3, 101])
+    assert df['Index'].tolist() == [250, 3, 101]
+    assert df['headline'].tolist() == ['headline 250', 'headline 3', 'headline 101']
+
+
+def test_local_layout_follows_rewritten_partitions(tmp_path):
+    (tmp_path / 'NYTimes_part_1.csv').write_text(partition(1, 10).to_csv(index=False))
+    (tmp_path / 'NYTimes_part_2.csv').write_text(partition(11, 10).to_csv(index=False))
+    assert read_from_local_partitions([15], folder_path=str(tmp_path))['Index'].tolist() == [15]
+
+    # Partitions of 5 rows written again without a manifest
+    for number in range(1, 5):
+        (tmp_path / f'NYTimes_part_{number}.csv').write_text(partition(5 * number - 4, 5).to_csv(index=False))
+    assert read_from_local_partitions([15, 20], folder_path=str(tmp_path))['Index'].tolist() == [15, 20]
+
+
+def test_sync_uploads_changed_files_only(client, tmp_path):
+    folder = tmp_path / 'partitions'
+    folder.mkdir()
+    (folder / 'part_1.csv').write_text(partition(1, 10).to_csv(index=False))
+    (folder / 'part_2.csv').write_text(partition(11, 10).to_csv(index=False))
+    sources = [(str(folder), 'partitions/')]
+
+    report = sync_to_s3(BUCKET, sources)
+    assert (report['uploaded'], report['skipped']) == (2, 0)
+
+    # Nothing changed, every file is skipped
+    report = sync_to_s3(BUCKET, sources)
+    assert (report['uploaded'], report['skipped']) == (0, 2)
+
+    # A changed file is uploaded again and its checksum recorded
+    (folder / 'part_2.csv').write_text(partition(11, 5).to_csv(index=False))
+    report = sync_to_s3(BUCKET, sources)
+    assert (report['uploaded'], report['skipped']) == (1, 1)
+
+    manifest = json.loads(client.get_object(Bucket=BUCKET, Key=SYNC_MANIFEST_KEY)['Body'].read())
+    assert set(manifest) == {'partitions/part_1.csv', 'partitions/part_2.csv'}
+    assert manifest['partitions/part_2.csv']['sha256'] == file_sha256(str(folder / 'part_2.csv'))
+    body = client.get_object(Bucket=BUCKET, Key='partitions/part_2.csv')['Body'].read()
+    assert pd.read_csv(io.BytesIO(body))['Index'].tolist() == list(range(11, 16))
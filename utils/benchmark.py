@@ -0,0 +1,438 @@
+import time
+import argparse
+import numpy as np
+import pandas as pd
+
+
+def load_texts(csv_path, samples=None, column='text'):
+        """
+        Load article texts from a CSV file for benchmarking
+
+        Parameters:
+        - csv_path (str): the path of a CSV file with a text column
+        - samples (int): the number of texts to load, all if None
+        - column (str): the name of the text column
+
+        Returns:
+        list: the article texts
+        """
+        df = pd.read_csv(csv_path, nrows=samples)
+        return list(df[column].dropna())
+
+
+def _timed(function, *args, **kwargs):
+        # Run a function and return its result and the elapsed wall time in seconds
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        return result, time.perf_counter() - start
+
+
+def _overlap(ids_a, ids_b):
+        # Mean fraction of shared neighbours between two rows of search results
+        return float(np.mean([len(set(a) & set(b)) / len(a) for a, b in zip(ids_a, ids_b)]))
+
+
+def benchmark_direct_embed(texts, index, k=5, model_name='bart', pooling='mean'):
+        """
+        Compare the summarize-then-embed pipeline with the direct embedding mode
+
+        Parameters:
+        - texts (list): the article texts used as queries
+        - index (faiss.Index): the index searched with both embeddings
+        - k (int): the number of neighbours compared
+        - model_name (str): the name of the summarization model ('bart' or 't5')
+        - pooling (str): the chunk pooling of the direct mode
+
+        Returns:
+        dict: the mean latency per article of both modes and their top-k overlap
+        """
+        from utils.vectorizer import preprocess_text, run_pipeline
+
+        preprocessed_texts = [preprocess_text(text) for text in texts]
+
+        # The cache is bypassed so that both modes run their models
+        summarize_latency, direct_latency = [], []
+        summarize_vectors, direct_vectors = [], []
+        for text in preprocessed_texts:
+            (_, vector), elapsed = _timed(run_pipeline, [text], model_name, use_cache=False)
+            summarize_vectors.append(vector)
+            summarize_latency.append(elapsed)
+
+            (_, vector), elapsed = _timed(run_pipeline, [text], model_name, mode='direct', pooling=pooling,
+                                          use_cache=False)
+            direct_vectors.append(vector)
+            direct_latency.append(elapsed)
+
+        _, summarize_ids = index.search(np.vstack(summarize_vectors), k)
+        _, direct_ids = index.search(np.vstack(direct_vectors), k)
+
+        report = {
+            'articles': len(texts),
+            'summarize_latency_s': float(np.mean(summarize_latency)),
+            'direct_latency_s': float(np.mean(direct_latency)),
+            'speedup': float(np.mean(summarize_latency) / np.mean(direct_latency)),
+            f'top{k}_overlap': _overlap(summarize_ids, direct_ids),
+        }
+        print(report)
+        return report
+
+
+def _token_overlap(a, b):
+        # Jaccard similarity of the words of two summaries
+        a, b = set(a.split()), set(b.split())
+        return len(a & b) / len(a | b) if a | b else 1.0
+
+
+def benchmark_quantization(texts, model_name='bart'):
+        """
+        Compare the int8 quantized summarizer and encoder with the fp32 models
+
+        Parameters:
+        - texts (list): the article texts to summarize and encode
+        - model_name (str): the name of the summarization model ('bart' or 't5')
+
+        Returns:
+        dict: the speedup, the model sizes and the summary/embedding drift of the quantized models
+        """
+        from utils.models import get_summarizer, get_encoder, model_size
+        from utils.vectorizer import preprocess_text, MAX_INPUT_LENGTH, GENERATION_KWARGS
+
+        preprocessed_texts = [preprocess_text(text) for text in texts]
+
+        summaries, latency, sizes = {}, {}, {}
+        for precision, quantized in (('fp32', False), ('int8', True)):
+            tokenizer, model = get_summarizer(model_name, quantized=quantized)
+            sizes[f'summarizer_{precision}_mb'] = model_size(model) / 2**20
+
+            summaries[precision], elapsed = [], 0.0
+            for text in preprocessed_texts:
+                input_ids = tokenizer("summarize: " + text, return_tensors='pt',
+                                      max_length=MAX_INPUT_LENGTH[model_name], truncation=True).input_ids
+                summary_ids, seconds = _timed(model.generate, input_ids, **GENERATION_KWARGS)
+                summaries[precision].append(tokenizer.decode(summary_ids[0], skip_special_tokens=True))
+                elapsed += seconds
+            latency[precision] = elapsed / len(texts)
+
+        # Encode the same fp32 summaries with both encoders so that only the encoder drift is measured
+        embeddings = {}
+        for precision, quantized in (('fp32', False), ('int8', True)):
+            encoder = get_encoder(quantized=quantized)
+            sizes[f'encoder_{precision}_mb'] = model_size(encoder) / 2**20
+            embeddings[precision], latency[f'encoder_{precision}'] = _timed(
+                encoder.encode, summaries['fp32'], convert_to_numpy=True, normalize_embeddings=True)
+
+        report = dict(sizes,
+                      articles=len(texts),
+                      summarizer_speedup=latency['fp32'] / latency['int8'],
+                      encoder_speedup=latency['encoder_fp32'] / latency['encoder_int8'],
+                      summary_exact_match=float(np.mean([a == b for a, b in zip(summaries['fp32'], summaries['int8'])])),
+                      summary_word_overlap=float(np.mean([_token_overlap(a, b) for a, b in
+                                                          zip(summaries['fp32'], summaries['int8'])])),
+                      embedding_cosine=float(np.mean(np.sum(embeddings['fp32'] * embeddings['int8'], axis=1))))
+        print(report)
+        return report
+
+
+def _legacy_vectorizer_preprocess(text):
+        # Former utils/vectorizer.preprocess_text, kept as the reference of benchmark_normalizer
+        import re
+        from nltk.corpus import stopwords
+        from nltk.tokenize import word_tokenize
+        from nltk.stem import WordNetLemmatizer
+
+        text = re.sub(r'[^a-zA-Z\s]', '', text.lower())
+        stop_words = set(stopwords.words('english'))
+        lemmatizer = WordNetLemmatizer()
+        return ' '.join([lemmatizer.lemmatize(word) for word in word_tokenize(text) if word not in stop_words])
+
+
+def _legacy_clean_preprocess(text):
+        # Former utils/clean.preprocess_text, kept as the reference of benchmark_normalizer
+        import re
+        from nltk.corpus import stopwords
+
+        text = re.sub(r'\s+', ' ', re.sub(r'[^\w\s]', ' ', text.lower()))
+        stop = stopwords.words('english')
+        return ' '.join([word for word in text.split() if word not in stop])
+
+
+def benchmark_normalizer(texts, n_jobs=1):
+        """
+        Compare the batch normaliser with the former preprocess_text implementations
+
+        Parameters:
+        - texts (list): the article texts to normalise
+        - n_jobs (int): the number of processes of the batch normaliser
+
+        Returns:
+        dict: the throughput of every implementation and whether their outputs match
+        """
+        from utils.normalizer import normalize_batch
+
+        report = {'articles': len(texts)}
+        for profile, legacy in (('vectorizer', _legacy_vectorizer_preprocess), ('clean', _legacy_clean_preprocess)):
+            expected, legacy_seconds = _timed(lambda: [legacy(text) for text in texts])
+            normalized, seconds = _timed(normalize_batch, texts, profile, n_jobs)
+            report[f'{profile}_legacy_texts_per_s'] = len(texts) / legacy_seconds
+            report[f'{profile}_batch_texts_per_s'] = len(texts) / seconds
+            report[f'{profile}_speedup'] = legacy_seconds / seconds
+            report[f'{profile}_outputs_match'] = normalized == expected
+        print(report)
+        return report
+
+
+def _legacy_prepare_df(df):
+        # Former utils/clean.prepare_df, kept as the reference of benchmark_prepare
+        from utils.clean import extract_key
+
+        df = df[['web_url', 'headline', 'section_name', 'subsection_name', 'abstract', 'byline', 'pub_date', 'text']]
+        df = df.dropna(subset=['web_url', 'headline', 'section_name', 'abstract', 'byline', 'pub_date'])
+        df = df.rename(columns={'web_url': 'link', 'section_name': 'category', 'subsection_name': 'sub_category',
+                                'abstract': 'short_description', 'byline': 'authors', 'pub_date': 'date'})
+        df['headline'] = df['headline'].apply(lambda x: extract_key(x, 'main'))
+        df['authors'] = df['authors'].apply(lambda x: extract_key(x, 'original'))
+        df['authors'] = df['authors'].replace('', None)
+        df['authors'] = df['authors'].str.replace('By ', '')
+        df['date'] = pd.to_datetime(df['date']).dt.date
+        df = df[(df['text'].apply(len) >= 50) & (df['short_description'].apply(len) >= 2)]
+        return df.drop_duplicates(subset='text', keep='first')
+
+
+def benchmark_prepare(csv_path, samples=None, chunksize=50000, n_jobs=4):
+        """
+        Compare the vectorised prepare_df with the former one, and measure the throughput of prepare_dump
+
+        The former extract_key cannot parse the dict strings of values with an apostrophe, those headlines and
+        authors are None in its output and are left out of the comparison.
+
+        Parameters:
+        - csv_path (str): the raw NYT archive dump
+        - samples (int): the number of rows compared in memory, all if None
+        - chunksize (int): the number of rows cleaned at once by prepare_dump
+        - n_jobs (int): the number of processes of prepare_dump
+
+        Returns:
+        dict: the rows per second of every implementation and whether their outputs match
+        """
+        import tempfile
+        from utils.clean import RAW_COLUMNS, prepare_df, prepare_dump
+
+        df = pd.read_csv(csv_path, usecols=RAW_COLUMNS, nrows=samples)
+        expected, legacy_seconds = _timed(_legacy_prepare_df, df)
+        prepared, seconds = _timed(prepare_df, df)
+
+        report = {'rows': len(df), 'legacy_rows_per_s': len(df) / legacy_seconds,
+                  'vectorized_rows_per_s': len(df) / seconds, 'speedup': legacy_seconds / seconds}
+        parsed = expected['headline'].notna() & expected['authors'].notna()
+        report['recovered_fields'] = int((~parsed).sum())
+        report['outputs_match'] = (prepared.index.equals(expected.index) and
+                                   prepared[parsed].astype(str).equals(expected[parsed].astype(str)))
+
+        with tempfile.TemporaryDirectory() as output_folder_path:
+            manifest, dump_seconds = _timed(prepare_dump, csv_path, output_folder_path, chunksize, n_jobs)
+        report['dump_rows'] = manifest['rows']
+        report['dump_rows_per_s'] = manifest['rows'] / dump_seconds
+        print(report)
+        return report
+
+
+def _recall(ids, ground_truth):
+        # Fraction of the exact top-k neighbours found by an approximate search
+        return float(np.mean([len(set(a) & set(b)) / len(b) for a, b in zip(ids, ground_truth)]))
+
+
+def benchmark_index_types(embeddings, specs, k=5, queries=1000):
+        """
+        Compare index types against the exact flat index on the project's embeddings
+
+        Parameters:
+        - embeddings (numpy.ndarray): the indexed vectors, a sample of them is used as queries
+        - specs (list): the index specs to compare, see indexer.parse_index_spec
+        - k (int): the number of neighbours retrieved
+        - queries (int): the number of query vectors
+
+        Returns:
+        list: one dict per spec with its build time, serialized size, QPS and recall@k
+        """
+        import faiss
+        from utils.indexer import make_index
+
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        sample = embeddings[np.random.default_rng(0).choice(len(embeddings), min(queries, len(embeddings)), replace=False)]
+
+        _, ground_truth = make_index(embeddings).search(sample, k)
+
+        reports = []
+        for spec in ['flat'] + [spec for spec in specs if spec != 'flat']:
+            index, build_seconds = _timed(make_index, embeddings, spec)
+            (_, ids), search_seconds = _timed(index.search, sample, k)
+            report = {'spec': spec,
+                      'build_s': build_seconds,
+                      'memory_mb': faiss.serialize_index(index).nbytes / 2**20,
+                      'qps': len(sample) / search_seconds,
+                      f'recall@{k}': _recall(ids, ground_truth)}
+            print(report)
+            reports.append(report)
+        return reports
+
+
+def benchmark_compression(embeddings, specs, k=5, queries=1000, rerank_factor=4):
+        """
+        Compare the bytes per vector and the recall of compressed indexes, with and without exact re-ranking
+
+        Parameters:
+        - embeddings (numpy.ndarray): the indexed vectors, a sample of them is used as queries
+        - specs (list): the index specs to compare, see indexer.parse_index_spec
+        - k (int): the number of neighbours retrieved
+        - queries (int): the number of query vectors
+        - rerank_factor (int): the number of candidates per result that are re-ranked
+
+        Returns:
+        list: one dict per spec with its bytes per vector, compression ratio and recall@k
+        """
+        import faiss
+        from utils.indexer import make_index, rerank_search
+
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        store = embeddings.astype(np.float16)
+        sample = embeddings[np.random.default_rng(0).choice(len(embeddings), min(queries, len(embeddings)), replace=False)]
+
+        _, ground_truth = make_index(embeddings).search(sample, k)
+        float_bytes = embeddings.shape[1] * embeddings.itemsize
+
+        reports = []
+        for spec in specs:
+            index = make_index(embeddings, spec)
+            bytes_per_vector = faiss.serialize_index(index).nbytes / index.ntotal
+            _, ids = index.search(sample, k)
+            (_, reranked), seconds = _timed(rerank_search, sample, k, index, store, rerank_factor)
+            report = {'spec': spec,
+                      'bytes_per_vector': bytes_per_vector,
+                      'compression': float_bytes / bytes_per_vector,
+                      f'recall@{k}': _recall(ids, ground_truth),
+                      f'reranked_recall@{k}': _recall(reranked, ground_truth),
+                      'reranked_qps': len(sample) / seconds,
+                      'rerank_store_bytes_per_vector': store.shape[1] * store.itemsize}
+            print(report)
+            reports.append(report)
+        return reports
+
+
+def benchmark_filtered_search(embeddings, spec='flat', selectivities=(0.001, 0.01, 0.1, 0.5), k=5, queries=200):
+        """
+        Compare the latency and recall of the filtered search strategies at several filter selectivities
+
+        The filters are random subsets of the articles: the exact search on the vectors of the subset,
+        the search with an ID selector, and a search over-fetching 10 * k results before filtering them.
+        The strategy that actually ran is reported, the exact search falls back to the selector on sharded indexes.
+
+        Parameters:
+        - embeddings (numpy.ndarray): the indexed vectors, a sample of them is used as queries
+        - spec (str or dict): the index spec, see indexer.parse_index_spec
+        - selectivities (tuple): the fractions of the articles accepted by the filters
+        - k (int): the number of neighbours retrieved
+        - queries (int): the number of query vectors
+
+        Returns:
+        list: one dict per selectivity with the latency in ms per query and the recall@k of every strategy
+        """
+        import faiss
+        from utils.indexer import make_index
+        from utils.metadata import filtered_search
+
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        ids = np.arange(1, len(embeddings) + 1, dtype=np.int64)
+        rng = np.random.default_rng(0)
+        sample = embeddings[rng.choice(len(embeddings), min(queries, len(embeddings)), replace=False)]
+        index = make_index(embeddings, spec, ids=ids)
+
+        reports = []
+        for selectivity in selectivities:
+            selected = np.sort(rng.choice(ids, max(k, int(selectivity * len(ids))), replace=False))
+            _, rows = faiss.knn(sample, embeddings[selected - 1], k)
+            ground_truth = selected[rows]
+
+            report = {'spec': spec, 'selectivity': selectivity, 'articles': len(selected)}
+            for strategy, exact_selectivity in (('exact', 1.0), ('selector', 0.0)):
+                (_, I, ran), seconds = _timed(filtered_search, sample, k, index, selected, exact_selectivity,
+                                              return_strategy=True)
+                report[f'{strategy}_ran'] = ran
+                report[f'{strategy}_ms'] = seconds * 1000 / len(sample)
+                report[f'{strategy}_recall@{k}'] = _recall(I, ground_truth)
+
+            (_, I), seconds = _timed(index.search, sample, 10 * k)
+            I = [row[np.isin(row, selected)][:k] for row in I]
+            report['post_filter_ms'] = seconds * 1000 / len(sample)
+            report[f'post_filter_recall@{k}'] = _recall(I, ground_truth)
+
+            print(report)
+            reports.append(report)
+        return reports
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks of the recommendation pipeline')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    direct_parser = subparsers.add_parser('direct-embed', help='latency and top-k overlap of the direct embedding mode')
+    direct_parser.add_argument('csv_path', help='CSV file with a text column used as queries')
+    direct_parser.add_argument('--samples', type=int, default=50)
+    direct_parser.add_argument('--k', type=int, default=5)
+    direct_parser.add_argument('--model', default='bart', choices=['bart', 't5'])
+    direct_parser.add_argument('--pooling', default='mean', choices=['mean', 'weighted'])
+
+    quantize_parser = subparsers.add_parser('quantization', help='speedup, memory and drift of the int8 models')
+    quantize_parser.add_argument('csv_path', help='CSV file with a text column')
+    quantize_parser.add_argument('--samples', type=int, default=20)
+    quantize_parser.add_argument('--model', default='bart', choices=['bart', 't5'])
+
+    normalizer_parser = subparsers.add_parser('normalizer', help='throughput of the batch text normaliser')
+    normalizer_parser.add_argument('csv_path', help='CSV file with a text column')
+    normalizer_parser.add_argument('--samples', type=int, default=2000)
+    normalizer_parser.add_argument('--jobs', type=int, default=1)
+
+    prepare_parser = subparsers.add_parser('prepare', help='throughput of the raw dump cleaning pipeline')
+    prepare_parser.add_argument('csv_path', help='raw NYT archive dump')
+    prepare_parser.add_argument('--samples', type=int, default=None, help='rows compared in memory, all if omitted')
+    prepare_parser.add_argument('--chunksize', type=int, default=50000)
+    prepare_parser.add_argument('--jobs', type=int, default=4)
+
+    index_parser = subparsers.add_parser('index-types', help='build time, memory, QPS and recall of index types')
+    index_parser.add_argument('--embeddings', default='dataset/embeddings.npy')
+    index_parser.add_argument('--specs', nargs='+', default=['ivf_flat', 'hnsw', 'ivf_pq'],
+                              help="index specs, e.g. 'ivf_flat:nlist=256,nprobe=8' 'hnsw:efSearch=32'")
+    index_parser.add_argument('--k', type=int, default=5)
+    index_parser.add_argument('--queries', type=int, default=1000)
+
+    compression_parser = subparsers.add_parser('compression', help='bytes per vector and recall of compressed indexes')
+    compression_parser.add_argument('--embeddings', default='dataset/embeddings.npy')
+    compression_parser.add_argument('--specs', nargs='+', default=['sq_fp16', 'sq8', 'pq', 'ivf_pq'],
+                                    help="index specs, e.g. 'pq:m=24' 'ivf_sq8:nprobe=32'")
+    compression_parser.add_argument('--k', type=int, default=5)
+    compression_parser.add_argument('--queries', type=int, default=1000)
+    compression_parser.add_argument('--rerank-factor', type=int, default=4)
+
+    filtered_parser = subparsers.add_parser('filtered-search', help='latency and recall of filtered search')
+    filtered_parser.add_argument('--embeddings', default='dataset/embeddings.npy')
+    filtered_parser.add_argument('--spec', default='flat', help="index spec, e.g. 'hnsw' or 'ivf_flat:nprobe=8'")
+    filtered_parser.add_argument('--selectivities', nargs='+', type=float, default=[0.001, 0.01, 0.1, 0.5])
+    filtered_parser.add_argument('--k', type=int, default=5)
+    filtered_parser.add_argument('--queries', type=int, default=200)
+
+    args = parser.parse_args()
+
+    if args.benchmark == 'direct-embed':
+        from utils.indexer import get_index
+        benchmark_direct_embed(load_texts(args.csv_path, args.samples), get_index(), args.k, args.model, args.pooling)
+    elif args.benchmark == 'quantization':
+        benchmark_quantization(load_texts(args.csv_path, args.samples), args.model)
+    elif args.benchmark == 'normalizer':
+        benchmark_normalizer(load_texts(args.csv_path, args.samples), args.jobs)
+    elif args.benchmark == 'prepare':
+        benchmark_prepare(args.csv_path, args.samples, args.chunksize, args.jobs)
+    elif args.benchmark == 'index-types':
+        benchmark_index_types(np.load(args.embeddings), args.specs, args.k, args.queries)
+    elif args.benchmark == 'compression':
+        benchmark_compression(np.load(args.embeddings), args.specs, args.k, args.queries, args.rerank_factor)
+    elif args.benchmark == 'filtered-search':
+        benchmark_filtered_search(np.load(args.embeddings), args.spec, args.selectivities, args.k, args.queries)
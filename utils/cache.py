@@ -0,0 +1,343 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+import numpy as np
+
+# Location and size of the summary/embedding cache, a size of 0 disables it
+CACHE_PATH = os.environ.get('NEWSREC_CACHE_PATH', 'dataset/cache.sqlite')
+CACHE_MAX_MB = int(os.environ.get('NEWSREC_CACHE_MB', 512))
+
+# Number of entries and time to live of the in-process query caches, 0 entries disables them
+QUERY_CACHE_ENTRIES = int(os.environ.get('NEWSREC_QUERY_CACHE_ENTRIES', 1024))
+QUERY_CACHE_TTL_S = float(os.environ.get('NEWSREC_QUERY_CACHE_TTL_S', 600))
+
+
+def cache_key(preprocessed_text, model_name, params):
+        """
+        Build the content-addressed key of a preprocessed text
+
+        Parameters:
+        - preprocessed_text (str): the preprocessed article text
+        - model_name (str): the name of the summarization model
+        - params (dict): the generation and encoding parameters that affect the output
+
+        Returns:
+        str: the hex sha256 digest of the text, model name and parameters
+        """
+        payload = json.dumps([model_name, params], sort_keys=True)
+        digest = hashlib.sha256(payload.encode('utf-8'))
+        digest.update(preprocessed_text.encode('utf-8'))
+        return digest.hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Persistent cache of summaries and embeddings stored in a single SQLite file
+
+    Entries are evicted least recently used first once the stored entries exceed max_bytes.
+    The file can be shared by several processes.
+    """
+
+    def __init__(self, path=CACHE_PATH, max_bytes=CACHE_MAX_MB * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._conn = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def _connection(self):
+        # Open one connection per process, connections must not be shared across a fork
+        if self._conn is None or self._pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, summary TEXT, '
+                               'embedding BLOB, size INTEGER, last_access REAL)')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access)')
+            self._pid = os.getpid()
+        return self._conn
+
+    def get_many(self, keys):
+        """
+        Look up several keys at once
+
+        Parameters:
+        - keys (list): the cache keys
+
+        Returns:
+        dict: the (summary, embedding) tuple of every key found in the cache
+        """
+        if not self.enabled:
+            return {}
+
+        keys = list(dict.fromkeys(keys))
+        found = {}
+        with self._lock:
+            conn = self._connection()
+            # Stay below SQLite's limit on the number of query parameters
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                rows = conn.execute(f"SELECT key, summary, embedding FROM entries WHERE key IN "
+                                    f"({','.join('?' * len(chunk))})", chunk).fetchall()
+                for key, summary, embedding in rows:
+                    found[key] = (summary, np.frombuffer(embedding, dtype=np.float32))
+
+            if found:
+                now = time.time()
+                conn.executemany('UPDATE entries SET last_access = ? WHERE key = ?', [(now, key) for key in found])
+                conn.commit()
+
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def get(self, key):
+        """
+        Look up a single key
+
+        Parameters:
+        - key (str): the cache key
+
+        Returns:
+        tuple: the cached summary and embedding, or None on a miss
+        """
+        return self.get_many([key]).get(key)
+
+    def put_many(self, items):
+        """
+        Store several entries at once and evict old entries if the cache is full
+
+        Parameters:
+        - items (list): (key, summary, embedding) tuples, the summary may be None
+
+        Returns:
+        None
+        """
+        if not self.enabled:
+            return
+
+        now = time.time()
+        rows = []
+        for key, summary, embedding in items:
+            blob = np.ascontiguousarray(embedding, dtype=np.float32).tobytes()
+            rows.append((key, summary, blob, len(blob) + len((summary or '').encode('utf-8')), now))
+
+        with self._lock:
+            conn = self._connection()
+            conn.executemany('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)', rows)
+            conn.commit()
+            self._evict(conn)
+
+    def put(self, key, summary, embedding):
+        """
+        Store a single entry
+
+        Parameters:
+        - key (str): the cache key
+        - summary (str): the summary of the text
+        - embedding (numpy.ndarray): the embedding of the summary
+
+        Returns:
+        None
+        """
+        self.put_many([(key, summary, embedding)])
+
+    def _evict(self, conn):
+        total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        # Delete least recently used entries until the cache fits again
+        stale = []
+        for key, size in conn.execute('SELECT key, size FROM entries ORDER BY last_access'):
+            if total <= self.max_bytes:
+                break
+            stale.append((key,))
+            total -= size
+        conn.executemany('DELETE FROM entries WHERE key = ?', stale)
+        conn.commit()
+
+    def stats(self):
+        """
+        Report the hit/miss counters of this process and the size of the cache
+
+        Parameters:
+        None
+
+        Returns:
+        dict: hits, misses, hit ratio, number of entries and stored bytes
+        """
+        lookups = self.hits + self.misses
+        stats = {'hits': self.hits, 'misses': self.misses,
+                 'hit_ratio': self.hits / lookups if lookups else 0.0,
+                 'entries': 0, 'bytes': 0, 'max_bytes': self.max_bytes}
+        if self.enabled:
+            with self._lock:
+                stats['entries'], stats['bytes'] = self._connection().execute(
+                    'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries').fetchone()
+        return stats
+
+    def clear(self):
+        """
+        Delete every entry and reset the counters
+        """
+        self.hits = self.misses = 0
+        if self.enabled:
+            with self._lock:
+                conn = self._connection()
+                conn.execute('DELETE FROM entries')
+                conn.commit()
+
+
+embedding_cache = EmbeddingCache()
+
+
+def normalize_query(text):
+        """
+        Normalise a pasted text into a query cache key: lowercase it and collapse whitespace
+
+        Parameters:
+        - text (str): the input text
+
+        Returns:
+        str: the normalised text
+        """
+        return ' '.join(text.lower().split())
+
+
+def canonical_url(url):
+        """
+        Canonicalise an article URL into a query cache key
+
+        The scheme and host are lowercased, the fragment, tracking parameters and trailing slash are removed.
+
+        Parameters:
+        - url (str): the article URL
+
+        Returns:
+        str: the canonical URL
+        """
+        parts = urlsplit(url.strip())
+        query = urlencode(sorted((name, value) for name, value in parse_qsl(parts.query)
+                                 if not name.lower().startswith('utm_')))
+        return urlunsplit((parts.scheme.lower() or 'https', parts.netloc.lower(), parts.path.rstrip('/') or '/',
+                           query, ''))
+
+
+class QueryCache:
+    """
+    In-process LRU cache of query results whose entries expire after ttl_s seconds
+
+    Every lookup passes the version of the index the results come from, and the cache is emptied
+    when it changes, so results of a replaced or updated index are never served.
+    """
+
+    def __init__(self, max_entries=QUERY_CACHE_ENTRIES, ttl_s=QUERY_CACHE_TTL_S):
+        self.max_entries = max_entries
+        self.ttl_s = ttl_s
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0
+
+    def _check_version(self, version):
+        if version != self.version:
+            self._entries.clear()
+            self.version = version
+
+    def get(self, key, version=None):
+        """
+        Look up a key
+
+        Parameters:
+        - key (hashable): the cache key
+        - version (hashable): the version of the index, the cache is emptied if it changed
+
+        Returns:
+        object: the cached value, or None on a miss
+        """
+        if not self.enabled:
+            return None
+
+        with self._lock:
+            self._check_version(version)
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                del self._entries[key]
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value, version=None):
+        """
+        Store a value, evicting the least recently used entry if the cache is full
+
+        Parameters:
+        - key (hashable): the cache key
+        - value (object): the value
+        - version (hashable): the version of the index the value comes from
+
+        Returns:
+        None
+        """
+        if not self.enabled:
+            return
+
+        with self._lock:
+            self._check_version(version)
+            self._entries[key] = (time.monotonic() + self.ttl_s, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        """
+        Report the hit/miss counters and the size of the cache
+
+        Parameters:
+        None
+
+        Returns:
+        dict: hits, misses, hit ratio, number of entries and index version
+        """
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+                'entries': len(self._entries), 'max_entries': self.max_entries, 'ttl_s': self.ttl_s,
+                'version': None if self.version is None else str(self.version)}
+
+    def clear(self):
+        """
+        Delete every entry and reset the counters
+        """
+        with self._lock:
+            self.hits = self.misses = 0
+            self._entries.clear()
+
+
+# Final (headline, link) results of a normalised text or canonical URL
+result_cache = QueryCache()
+
+# Top-k ids of a query embedding and filter
+search_cache = QueryCache()
@@ -1,8 +1,24 @@
 import pandas as pd
 import numpy as np
+import os
+import re
+import ast
 import json
+import argparse
+import pyarrow as pa
+import pyarrow.compute as pc
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 
+from utils.normalizer import normalize_text
+from utils.dedup import DEDUP_PATH, minhash_signatures, drop_near_duplicates, load_or_create
+from utils.util import PARTITIONS_DIR, PARTITION_COLUMNS, CATEGORY_COLUMNS, detect_encoding, write_partitions
+from utils.util import write_parquet_partitions
+
+# Columns of the raw NYT archive dumps read by prepare_df
+RAW_COLUMNS = ['web_url', 'headline', 'section_name', 'subsection_name', 'abstract', 'byline', 'pub_date', 'text']
+
 # Function to extract keys from a json string
 def extract_key(json_string, key):
     
@@ -22,11 +38,27 @@ def extract_key(json_string, key):
     except (json.JSONDecodeError, AttributeError):
         return None
 
+# Function to extract a key from a column of dict strings, e.g. "{'main': 'Title', 'kicker': None}"
+def extract_field(series, key):
+    
+    # Match the string literal of the key, written with single or double quotes by repr, in one pass over the column
+    pattern = rf"""'{re.escape(key)}': (?P<value>'[^'\\]*(?:\\.[^'\\]*)*'|"[^"\\]*(?:\\.[^"\\]*)*")"""
+    literals = pc.struct_field(pc.extract_regex(pa.array(series, type=pa.string(), from_pandas=True), pattern), [0])
+    values = pd.Series(pc.utf8_slice_codeunits(literals, 1, -1).to_numpy(zero_copy_only=False), index=series.index,
+                       dtype=object)
+    
+    # Unescape the few values with backslashes, missing keys and None values stay None
+    escaped = pc.fill_null(pc.match_substring(literals, '\\'), False).to_numpy(zero_copy_only=False)
+    if escaped.any():
+        values[escaped] = [ast.literal_eval(literal) for literal in pc.filter(literals, escaped).to_pylist()]
+    
+    return values
+
 # Function to clean raw dataset
 def prepare_df(df):
     
     # Select useful columns
-    df = df[['web_url', 'headline', 'section_name', 'subsection_name', 'abstract', 'byline', 'pub_date', 'text']]
+    df = df[RAW_COLUMNS]
     
     # Drop NA
     df = df.dropna(subset=['web_url', 'headline', 'section_name', 'abstract', 'byline', 'pub_date'])
@@ -36,10 +68,10 @@ def prepare_df(df):
                'abstract':'short_description', 'byline':'authors', 'pub_date':'date'})
     
     # Extract headline
-    df['headline'] = df['headline'].apply(lambda x: extract_key(x, 'main'))
+    df['headline'] = extract_field(df['headline'], 'main')
     
     # Extract authors
-    df['authors'] = df['authors'].apply(lambda x: extract_key(x, 'original'))
+    df['authors'] = extract_field(df['authors'], 'original')
     
     # Replace empty strings with None in the 'authors' column
     df['authors'] = df['authors'].replace('', None)
@@ -51,27 +83,93 @@ def prepare_df(df):
     df['date'] = pd.to_datetime(df['date']).dt.date
     
     # Remove rows with texts less than 50 characters
-    df = df[(df['text'].apply(len)>=50) & (df['short_description'].apply(len)>=2)]
+    df = df[(df['text'].str.len()>=50) & (df['short_description'].str.len()>=2)]
     
     # Remove rows with repeated texts
     df = df.drop_duplicates(subset='text', keep='first')
     
     return(df)
 
-# Function to preprocess scraped texts
-def preprocess_text(text):
-    
-    # Convert all characters to lowercase
-    text = text.lower()
-    
-    # Remove all non-alphanumeric characters (except spaces)
-    text = re.sub(r'[^\w\s]', ' ', text)
+# Function to clean a chunk in a worker process, with the MinHash signatures of its texts if requested
+def _prepare_chunk(chunk, minhash=None):
     
-    # Reduce multiple spaces to a single space
-    text = re.sub(r'\s+', ' ', text)
+    df = prepare_df(chunk)
+    return df, (minhash_signatures(df['text'], **minhash) if minhash else None)
+
+# Function to clean chunks in a pool of processes, yielding them and their signatures in order, a few in flight
+def _prepared_chunks(chunks, n_jobs=4, minhash=None):
+    
+    with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.submit(_prepare_chunk, chunk, minhash))
+            if len(pending) > 2 * n_jobs:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+# Function to clean chunks in a pool of processes, yielding them in order
+def clean_chunks(chunks, n_jobs=4, near_duplicates=None):
     
-    # Remove stop words
-    stop = stopwords.words('english')
-    text = ' '.join([word for word in text.split() if word not in stop])
+    # The signatures are computed by the workers, the near duplicates are removed in order by the main process
+    minhash = near_duplicates.params if near_duplicates is not None else None
+    for df, signatures in _prepared_chunks(chunks, n_jobs, minhash):
+        yield df if near_duplicates is None else drop_near_duplicates(df, near_duplicates, signatures=signatures)
+
+# Function to clean a raw dump chunk by chunk into partitions described by a manifest
+def prepare_dump(file_path, output_folder_path=PARTITIONS_DIR, chunksize=50000, n_jobs=4, rows_per_partition=None,
+                 bytes_per_partition=None, base_file_path='NYTimes', near_duplicates=None):
+    
+    encoding = detect_encoding(file_path)
+    chunks = pd.read_csv(file_path, encoding=encoding, usecols=RAW_COLUMNS, chunksize=chunksize)
+    minhash = near_duplicates.params if near_duplicates is not None else None
+    
+    # Remove the texts repeated across chunks, prepare_df only sees the repeats inside a chunk, then the near
+    # duplicates. The kept articles are numbered after the articles of the near duplicate index, like
+    # write_partitions numbers them, so the index records the Index of the partitions.
+    first_id = near_duplicates.next_id if near_duplicates is not None else 1
+    
+    def unique_chunks():
+        seen, next_id = set(), first_id
+        for df, signatures in _prepared_chunks(chunks, n_jobs, minhash):
+            hashes = pd.util.hash_pandas_object(df['text'], index=False).to_numpy()
+            keep = np.array([h not in seen for h in hashes.tolist()], dtype=bool)
+            seen.update(hashes[keep].tolist())
+            df = df.loc[keep, PARTITION_COLUMNS + CATEGORY_COLUMNS]
+            if near_duplicates is not None:
+                df = drop_near_duplicates(df, near_duplicates, signatures=signatures[keep], first_id=next_id)
+            next_id += len(df)
+            yield df
+    
+    return write_partitions(unique_chunks(), output_folder_path, rows_per_partition, bytes_per_partition, n_jobs,
+                            base_file_path, os.path.basename(file_path), encoding, first_id)
+
+# Function to preprocess scraped texts
+def preprocess_text(text):
     
-    return(text)
\ No newline at end of file
+    # Lowercase, turn punctuation into spaces and remove stop words
+    return normalize_text(text, profile='clean')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Clean a raw NYT archive dump into partitions described by a manifest')
+    parser.add_argument('csv_file')
+    parser.add_argument('--output', default=PARTITIONS_DIR)
+    parser.add_argument('--rows', type=int, default=None, help='articles per partition')
+    parser.add_argument('--mb', type=int, default=64, help='target partition size in MB, used without --rows')
+    parser.add_argument('--chunksize', type=int, default=50000)
+    parser.add_argument('--jobs', type=int, default=4)
+    parser.add_argument('--near-duplicates', action='store_true', help='remove the near-duplicate articles')
+    parser.add_argument('--threshold', type=float, default=None, help='Jaccard similarity of near duplicates')
+    parser.add_argument('--dedup-index', default=DEDUP_PATH, help='index of the previous ingests, extended and saved')
+    parser.add_argument('--parquet', action='store_true',
+                        help='also write a Parquet copy of every partition, read from S3 with byte-range requests')
+    args = parser.parse_args()
+
+    index = load_or_create(args.dedup_index, args.threshold) if args.near_duplicates else None
+    prepare_dump(args.csv_file, args.output, args.chunksize, args.jobs, args.rows, args.mb * 1024 * 1024,
+                 near_duplicates=index)
+    if index is not None:
+        index.save(args.dedup_index)
+    if args.parquet:
+        write_parquet_partitions(args.output, max_workers=args.jobs)
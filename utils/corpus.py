@@ -0,0 +1,166 @@
+import os
+import json
+import hashlib
+import argparse
+import multiprocessing
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from tqdm import tqdm
+
+from utils.models import ENCODER_DIM
+
+
+def available_cores():
+        """
+        Return the number of CPU cores this process may run on
+        """
+        try:
+            return len(os.sched_getaffinity(0))
+        except AttributeError:
+            return os.cpu_count() or 1
+
+
+def manifest_path(output_path):
+        """
+        Return the path of the progress manifest written next to an embeddings file
+        """
+        return output_path + '.manifest.json'
+
+
+def _save_manifest(path, manifest):
+        # Write to a temporary file first so that a crash never leaves a truncated manifest
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, path)
+
+
+def corpus_fingerprint(texts):
+        """
+        Return the sha256 digest of the texts of a corpus, in order, to check that a resumed run encodes the same corpus
+        """
+        hashes = pd.util.hash_pandas_object(pd.Series(texts, dtype=object), index=False).to_numpy()
+        return hashlib.sha256(hashes.tobytes()).hexdigest()
+
+
+def _load_manifest(output_path, settings):
+        # Resume only if the previous run encoded the same texts with the same settings
+        path = manifest_path(output_path)
+        if not (os.path.exists(path) and os.path.exists(output_path)):
+            return None
+        with open(path) as f:
+            manifest = json.load(f)
+        if any(manifest.get(key) != value for key, value in settings.items()):
+            print('Corpus or settings changed since the last run, encoding from scratch')
+            return None
+        return manifest
+
+
+def _init_worker(threads):
+        # Split the cores between the workers instead of letting every worker use all of them
+        import torch
+        torch.set_num_threads(threads)
+
+
+def _encode_shard(output_path, start, texts, model_name, batch_size, normalize, mode, pooling):
+        from utils.vectorizer import process_and_encode_articles
+
+        summaries, embeddings = process_and_encode_articles(texts, model_name, batch_size, normalize, mode, pooling)
+
+        # Write the shard into its rows of the shared memory-mapped output
+        output = np.load(output_path, mmap_mode='r+')
+        output[start:start + len(texts)] = embeddings
+        output.flush()
+        del output
+        return start
+
+
+def encode_corpus(df, output_path='dataset/embeddings.npy', shard_size=256, num_workers=None, threads_per_worker=2,
+                  model_name='bart', batch_size=8, normalize=False, mode='summarize', pooling='mean'):
+        """
+        Encode the 'text' column of a dataset with a pool of processes, resuming from the last completed shard
+
+        The embeddings are written into a memory-mapped .npy file with the same layout as encode_dataset,
+        and the completed shards are recorded in a manifest next to it. The 'Index' column, if any, is saved to
+        an ids file next to it, e.g. 'embeddings.ids.npy'.
+
+        Parameters:
+        - df (pandas.DataFrame): the dataset containing a 'text' column with article texts
+        - output_path (str): the path of the embeddings numpy file
+        - shard_size (int): the number of articles per shard
+        - num_workers (int): the number of worker processes, by default the available cores divided by threads_per_worker
+        - threads_per_worker (int): the number of torch threads of each worker
+        - model_name (str): the name of the summarization model ('bart' or 't5')
+        - batch_size (int): the summarization batch size inside each shard
+        - normalize (bool): whether to L2-normalise the embeddings
+        - mode (str): 'summarize' to embed the summaries, 'long' to summarize long articles with a map-reduce pass,
+          'direct' to embed the articles without summarizing them
+        - pooling (str): 'mean' or 'weighted' chunk pooling of the direct mode
+
+        Returns:
+        None
+        """
+
+        texts = list(df['text'])
+        if num_workers is None:
+            num_workers = max(1, available_cores() // threads_per_worker)
+
+        settings = {'rows': len(texts), 'fingerprint': corpus_fingerprint(texts), 'dim': ENCODER_DIM,
+                    'shard_size': shard_size, 'model_name': model_name, 'batch_size': batch_size,
+                    'normalize': normalize, 'mode': mode, 'pooling': pooling}
+        manifest = _load_manifest(output_path, settings)
+        if manifest is None:
+            # Allocate the full output up front, rows are filled in as shards complete
+            os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+            output = np.lib.format.open_memmap(output_path, mode='w+', dtype=np.float32,
+                                               shape=(len(texts), ENCODER_DIM))
+            del output
+            manifest = dict(settings, completed=[])
+            _save_manifest(manifest_path(output_path), manifest)
+
+        completed = set(manifest['completed'])
+        pending = [start for start in range(0, len(texts), shard_size) if start not in completed]
+        print(f'{len(completed)} shards already encoded, {len(pending)} shards to go with {num_workers} workers')
+
+        # Spawn fresh workers, forking a process that already runs torch threads can deadlock
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=num_workers, mp_context=context, initializer=_init_worker,
+                                 initargs=(threads_per_worker,)) as pool:
+            futures = [pool.submit(_encode_shard, output_path, start, texts[start:start + shard_size],
+                                   model_name, batch_size, normalize, mode, pooling) for start in pending]
+
+            # Record every shard as it completes, a failed shard does not lose the shards completed after it
+            errors = []
+            for future in tqdm(as_completed(futures), total=len(futures), desc="Encoding Shards"):
+                try:
+                    manifest['completed'].append(future.result())
+                except Exception as e:
+                    errors.append(e)
+                    continue
+                _save_manifest(manifest_path(output_path), manifest)
+
+        if errors:
+            raise RuntimeError(f'{len(errors)} shards failed, run again to resume from the completed ones') from errors[0]
+
+        if 'Index' in df:
+            np.save(os.path.splitext(output_path)[0] + '.ids.npy', df['Index'].to_numpy())
+        print(f'Encoded {len(texts)} articles to {output_path}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Encode a dataset of articles into dataset/embeddings.npy')
+    parser.add_argument('csv_files', nargs='+', help='CSV files with a text column, concatenated in the given order')
+    parser.add_argument('--output', default='dataset/embeddings.npy')
+    parser.add_argument('--shard-size', type=int, default=256)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--threads-per-worker', type=int, default=2)
+    parser.add_argument('--model', default='bart', choices=['bart', 't5'])
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--mode', default='summarize', choices=['summarize', 'long', 'direct'])
+    parser.add_argument('--pooling', default='mean', choices=['mean', 'weighted'], help='chunk pooling of --mode direct')
+    args = parser.parse_args()
+
+    df = pd.concat([pd.read_csv(path) for path in args.csv_files], ignore_index=True)
+    encode_corpus(df, args.output, args.shard_size, args.workers, args.threads_per_worker, args.model, args.batch_size,
+                  mode=args.mode, pooling=args.pooling)
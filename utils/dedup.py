@@ -0,0 +1,389 @@
+import os
+import re
+import zlib
+import argparse
+from collections import defaultdict
+import numpy as np
+import pandas as pd
+
+# MinHash LSH index of the kept articles, extended by every ingest
+DEDUP_PATH = 'dataset/near_duplicates.npz'
+
+# Articles whose estimated Jaccard similarity of word shingles with a kept article reaches the threshold are removed
+NEAR_DUPLICATE_THRESHOLD = 0.8
+NUM_PERM = 128
+SHINGLE_SIZE = 5
+
+# Band keys added since the last merge are kept in hash buckets until they outnumber the sorted keys
+MIN_MERGE_KEYS = 1 << 16
+
+TOKEN_PATTERN = re.compile(r'\w+')
+EMPTY = np.iinfo(np.uint32).max
+
+
+def _shingle_hashes(text, shingle_size):
+        # Distinct 64-bit hashes of the word shingles of a text, a text shorter than a shingle is one shingle
+        tokens = TOKEN_PATTERN.findall(str(text).lower())
+        hashes = np.fromiter((zlib.crc32(token.encode('utf-8')) for token in tokens), dtype=np.uint64,
+                             count=len(tokens))
+        width = min(shingle_size, len(hashes))
+        if width == 0:
+            return hashes
+
+        # Rolling combination of the token hashes, wrapping around 2**64
+        shingles = hashes[:len(hashes) - width + 1].copy()
+        for offset in range(1, width):
+            shingles = shingles * np.uint64(0x100000001B3) + hashes[offset:len(hashes) - width + 1 + offset]
+        return np.unique(shingles)
+
+
+def _permutations(num_perm, seed):
+        # Odd multipliers and offsets of the multiply-shift hash functions standing for the permutations
+        rng = np.random.default_rng(seed)
+        a = rng.integers(1, 2 ** 63, size=num_perm, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+        b = rng.integers(0, 2 ** 63, size=num_perm, dtype=np.uint64)
+        return a[:, None], b[:, None]
+
+
+def minhash_signatures(texts, num_perm=NUM_PERM, shingle_size=SHINGLE_SIZE, seed=1, block_size=1 << 16):
+        """
+        Compute the MinHash signatures of the word shingles of texts
+
+        Parameters:
+        - texts (iterable): the texts
+        - num_perm (int): the number of hash functions, the length of the signatures
+        - shingle_size (int): the number of words per shingle
+        - seed (int): the seed of the hash functions, signatures are only comparable with the same seed
+        - block_size (int): the number of shingles hashed at once, bounding the memory to 8 * num_perm * block_size
+
+        Returns:
+        numpy.ndarray: the uint32 signatures, one row per text, rows of texts without words are all 2**32 - 1
+        """
+        a, b = _permutations(num_perm, seed)
+        shingles = [_shingle_hashes(text, shingle_size) for text in texts]
+        signatures = np.full((len(shingles), num_perm), EMPTY, dtype=np.uint32)
+        buffer = np.empty(num_perm * block_size, dtype=np.uint64)
+
+        # Hash the shingles of consecutive texts together, a minimum per text is taken over its own columns
+        start = 0
+        while start < len(shingles):
+            end, total = start + 1, len(shingles[start])
+            while end < len(shingles) and total + len(shingles[end]) <= block_size:
+                total += len(shingles[end])
+                end += 1
+
+            rows = [row for row in range(start, end) if len(shingles[row])]
+            if rows:
+                block = np.concatenate([shingles[row] for row in rows])
+                offsets = np.cumsum([0] + [len(shingles[row]) for row in rows[:-1]])
+                if num_perm * len(block) > len(buffer):
+                    # A single text longer than a block
+                    buffer = np.empty(num_perm * len(block), dtype=np.uint64)
+                hashed = buffer[:num_perm * len(block)].reshape(num_perm, len(block))
+                np.multiply(a, block[None, :], out=hashed)
+                hashed += b
+                hashed >>= np.uint64(32)
+                signatures[rows] = np.minimum.reduceat(hashed, offsets, axis=1).T
+            start = end
+        return signatures
+
+
+def lsh_params(threshold, num_perm=NUM_PERM):
+        """
+        Choose the number of bands and rows per band of the LSH index for a similarity threshold
+
+        The rows per band are the largest whose S-curve threshold (1 / bands) ** (1 / rows) stays at or below the
+        similarity threshold, so few near duplicates are missed, the candidates are then verified on their signatures.
+
+        Parameters:
+        - threshold (float): the Jaccard similarity of near duplicates
+        - num_perm (int): the length of the signatures
+
+        Returns:
+        tuple: the number of bands and of rows per band
+        """
+        rows = 1
+        for candidate in range(1, num_perm + 1):
+            if (1 / (num_perm // candidate)) ** (1 / candidate) <= threshold:
+                rows = candidate
+        return num_perm // rows, rows
+
+
+class NearDuplicateIndex:
+    """
+    MinHash LSH index of the kept articles, finding the near duplicates of new articles batch by batch
+
+    Articles are kept in the order they are added, an article is removed when it is as similar as the threshold to a
+    kept article of the index or of its own batch. The index can be saved and extended by later ingests.
+    """
+
+    def __init__(self, threshold=NEAR_DUPLICATE_THRESHOLD, num_perm=NUM_PERM, shingle_size=SHINGLE_SIZE, seed=1):
+        self.threshold = threshold
+        self.params = {'num_perm': num_perm, 'shingle_size': shingle_size, 'seed': seed}
+        self.bands, self.rows = lsh_params(threshold, num_perm)
+        rng = np.random.default_rng(seed)
+        self._multipliers = rng.integers(0, 2 ** 63, size=(self.bands, self.rows), dtype=np.uint64) | np.uint64(1)
+        self._salts = rng.integers(0, 2 ** 63, size=self.bands, dtype=np.uint64)
+
+        # Signatures and ids of the kept articles, in buffers grown by doubling
+        self._signatures = np.empty((0, num_perm), dtype=np.uint32)
+        self._ids = np.empty(0, dtype=np.int64)
+        self._size = 0
+
+        # Sorted band keys of the kept articles and their rows, and the buckets of the keys added since the last merge
+        self._keys = np.empty(0, dtype=np.uint64)
+        self._key_rows = np.empty(0, dtype=np.int64)
+        self._buckets = defaultdict(list)
+        self._bucketed = 0
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def ids(self):
+        """
+        The ids of the kept articles
+        """
+        return self._ids[:self._size]
+
+    @property
+    def next_id(self):
+        """
+        The id following the largest id of the kept articles, 1 for an empty index
+        """
+        return int(self.ids.max()) + 1 if self._size else 1
+
+    @property
+    def signatures(self):
+        """
+        The signatures of the kept articles
+        """
+        return self._signatures[:self._size]
+
+    def sign(self, texts):
+        """
+        Compute the signatures of texts with the hash functions of the index, see minhash_signatures
+        """
+        return minhash_signatures(texts, **self.params)
+
+    def _band_keys(self, signatures):
+        # One 64-bit key per band, different bands of equal values get different keys
+        bands = signatures[:, :self.bands * self.rows].reshape(len(signatures), self.bands, self.rows)
+        keys = (bands.astype(np.uint64) * self._multipliers[None]).sum(axis=2, dtype=np.uint64)
+        return keys ^ self._salts
+
+    def _similar(self, signature, rows, signatures):
+        # The most similar of the rows if its estimated Jaccard similarity reaches the threshold, else None
+        if not rows:
+            return None
+        rows = sorted(rows)
+        similarity = np.mean(signatures[rows] == signature, axis=1)
+        best = int(np.argmax(similarity))
+        return rows[best] if similarity[best] >= self.threshold else None
+
+    def add(self, signatures, ids=None, first_id=None):
+        """
+        Add a batch of articles, keeping those that are not near duplicates of a kept article
+
+        Parameters:
+        - signatures (numpy.ndarray): the signatures of the articles, see sign
+        - ids (numpy.ndarray): the ids of the articles, the kept articles are numbered if None
+        - first_id (int): the id of the first kept article when they are numbered, next_id if None
+
+        Returns:
+        numpy.ndarray: the id of the kept article every article duplicates, -1 for the kept articles
+        """
+        signatures = np.asarray(signatures, dtype=np.uint32)
+        keys = self._band_keys(signatures)
+        duplicate_of = np.full(len(signatures), -1, dtype=np.int64)
+        empty = (signatures == EMPTY).all(axis=1)
+
+        # Candidates among the kept articles, looked up for the whole batch at once
+        flat = keys.ravel()
+        left = np.searchsorted(self._keys, flat, side='left')
+        right = np.searchsorted(self._keys, flat, side='right')
+        candidates = {}
+        for position in np.flatnonzero(right > left).tolist():
+            candidates.setdefault(position // self.bands, set()).update(
+                self._key_rows[left[position]:right[position]].tolist())
+        if self._buckets:
+            for position, key in enumerate(flat.tolist()):
+                if key in self._buckets:
+                    candidates.setdefault(position // self.bands, set()).update(self._buckets[key])
+
+        # Candidates among the kept articles of the batch, the articles are taken in order
+        buckets, kept = {}, []
+        for row in range(len(signatures)):
+            if empty[row]:
+                continue
+            match = self._similar(signatures[row], candidates.get(row), self.signatures)
+            if match is not None:
+                duplicate_of[row] = self._ids[match]
+                continue
+
+            row_keys = keys[row].tolist()
+            batch_rows = {kept_row for key in row_keys for kept_row in buckets.get(key, ())}
+            match = self._similar(signatures[row], batch_rows, signatures)
+            if match is not None:
+                duplicate_of[row] = -2 - match
+                continue
+
+            for key in row_keys:
+                buckets.setdefault(key, []).append(row)
+            kept.append(row)
+
+        kept = np.asarray(kept, dtype=np.int64)
+        if ids is None:
+            batch_ids = np.full(len(signatures), -1, dtype=np.int64)
+            first_id = self.next_id if first_id is None else first_id
+            batch_ids[kept] = np.arange(first_id, first_id + len(kept))
+        else:
+            batch_ids = np.asarray(ids, dtype=np.int64)
+
+        # Articles duplicating an article of the batch point to its id
+        within = duplicate_of <= -2
+        duplicate_of[within] = batch_ids[-2 - duplicate_of[within]]
+
+        self._append(signatures[kept], batch_ids[kept], keys[kept])
+        return duplicate_of
+
+    def _append(self, signatures, ids, keys):
+        # Store the kept articles and bucket their band keys, merged into the sorted keys once they outnumber them
+        if self._size + len(signatures) > len(self._signatures):
+            capacity = max(2 * len(self._signatures), self._size + len(signatures), 1024)
+            self._signatures = np.resize(self._signatures, (capacity, self._signatures.shape[1]))
+            self._ids = np.resize(self._ids, capacity)
+
+        rows = np.arange(self._size, self._size + len(signatures))
+        self._signatures[rows], self._ids[rows] = signatures, ids
+        self._size += len(signatures)
+
+        # Large batches, e.g. a loaded index, are merged at once, small ones are bucketed
+        if self._bucketed + keys.size > max(len(self._keys), MIN_MERGE_KEYS):
+            self._merge(keys.ravel(), np.repeat(rows, self.bands))
+            return
+        for row, row_keys in zip(rows.tolist(), keys.tolist()):
+            for key in row_keys:
+                self._buckets[key].append(row)
+        self._bucketed += keys.size
+
+    def _merge(self, keys, key_rows):
+        # Sort the bucketed and the given keys into the sorted keys, every key is merged a logarithmic number of times
+        lengths = [len(rows) for rows in self._buckets.values()]
+        bucketed = np.repeat(np.fromiter(self._buckets, dtype=np.uint64, count=len(self._buckets)), lengths)
+        bucketed_rows = np.fromiter((row for rows in self._buckets.values() for row in rows), dtype=np.int64,
+                                    count=sum(lengths))
+        keys = np.concatenate([self._keys, bucketed, keys])
+        key_rows = np.concatenate([self._key_rows, bucketed_rows, key_rows])
+        order = np.argsort(keys, kind='stable')
+        self._keys, self._key_rows = keys[order], key_rows[order]
+        self._buckets, self._bucketed = defaultdict(list), 0
+
+    def save(self, path=DEDUP_PATH):
+        """
+        Save the signatures and ids of the kept articles, the band keys are rebuilt on load
+        """
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path + '.tmp', 'wb') as f:
+            np.savez(f, signatures=self.signatures, ids=self.ids, threshold=self.threshold,
+                     **{name: value for name, value in self.params.items()})
+        os.replace(path + '.tmp', path)
+        print(f'Saved the signatures of {len(self)} articles to {path}')
+
+    @classmethod
+    def load(cls, path=DEDUP_PATH, threshold=None):
+        """
+        Load a saved index
+
+        Parameters:
+        - path (str): the path of the index
+        - threshold (float): the similarity threshold of the following additions, the saved one if None
+
+        Returns:
+        NearDuplicateIndex: the index
+        """
+        with np.load(path) as data:
+            index = cls(float(data['threshold']) if threshold is None else threshold, int(data['num_perm']),
+                        int(data['shingle_size']), int(data['seed']))
+            index._append(data['signatures'], data['ids'], index._band_keys(data['signatures']))
+        return index
+
+
+def load_or_create(path=DEDUP_PATH, threshold=None):
+        """
+        Load the saved index to extend it with new articles, or create an empty one
+
+        Parameters:
+        - path (str): the path of the index
+        - threshold (float): the similarity threshold, the saved one or NEAR_DUPLICATE_THRESHOLD if None
+
+        Returns:
+        NearDuplicateIndex: the index
+        """
+        if path and os.path.exists(path):
+            return NearDuplicateIndex.load(path, threshold)
+        return NearDuplicateIndex(NEAR_DUPLICATE_THRESHOLD if threshold is None else threshold)
+
+
+def drop_near_duplicates(df, index, column='text', id_column='Index', signatures=None, first_id=None):
+        """
+        Remove the near duplicates of a chunk of articles, and add the kept articles to the index
+
+        Parameters:
+        - df (pandas.DataFrame): the chunk of articles
+        - index (NearDuplicateIndex): the index of the kept articles, possibly loaded from a previous ingest
+        - column (str): the column of the texts
+        - id_column (str): the column of the article ids, the kept articles are numbered if missing
+        - signatures (numpy.ndarray): the signatures of the texts if already computed, e.g. by a worker process
+        - first_id (int): the id of the first kept article when they are numbered, e.g. the Index it will be given
+
+        Returns:
+        pandas.DataFrame: the kept articles
+        """
+        if signatures is None:
+            signatures = index.sign(df[column])
+        duplicate_of = index.add(signatures, df[id_column].to_numpy() if id_column in df else None, first_id)
+        return df[duplicate_of < 0]
+
+
+def dedup_csv(input_path, output_path, index, chunksize=50000, column='text', id_column='Index'):
+        """
+        Stream a CSV dataset chunk by chunk into a copy without its near duplicates
+
+        Parameters:
+        - input_path (str): the cleaned dataset, e.g. a partition or a dataset prepared by clean.prepare_df
+        - output_path (str): the path of the copy
+        - index (NearDuplicateIndex): the index of the kept articles, extended with the kept articles of the dataset
+        - chunksize (int): the number of rows read at once
+        - column (str): the column of the texts
+        - id_column (str): the column of the article ids
+
+        Returns:
+        tuple: the number of articles read and removed
+        """
+        read, written = 0, 0
+        with open(output_path + '.tmp', 'w', encoding='utf-8', newline='') as f:
+            for chunk in pd.read_csv(input_path, chunksize=chunksize):
+                kept = drop_near_duplicates(chunk, index, column, id_column)
+                kept.to_csv(f, index=False, header=read == 0)
+                read, written = read + len(chunk), written + len(kept)
+        os.replace(output_path + '.tmp', output_path)
+
+        print(f'Removed {read - written} near duplicates out of {read} articles')
+        return read, read - written
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Remove the near-duplicate articles of cleaned CSV datasets')
+    parser.add_argument('csv_files', nargs='+', help='cleaned datasets, processed in order')
+    parser.add_argument('--output-dir', required=True, help='folder of the copies without near duplicates')
+    parser.add_argument('--index', default=DEDUP_PATH, help='index of the previous ingests, extended and saved')
+    parser.add_argument('--threshold', type=float, default=None, help='Jaccard similarity of near duplicates')
+    parser.add_argument('--chunksize', type=int, default=50000)
+    args = parser.parse_args()
+
+    index = load_or_create(args.index, args.threshold)
+    os.makedirs(args.output_dir, exist_ok=True)
+    for path in args.csv_files:
+        dedup_csv(path, os.path.join(args.output_dir, os.path.basename(path)), index, args.chunksize)
+    index.save(args.index)
@@ -1,17 +1,179 @@
 import os
+import re
+import json
+import time
+import base64
+import hashlib
+import argparse
+import threading
 import numpy as np
 import faiss
+from concurrent.futures import ThreadPoolExecutor
 
+# Directory of the published index files and of the version stamp pointing to the current one
+INDEX_DIR = 'dataset/index'
+VERSION_FILE = 'VERSION'
 
-def get_index():
+# Additions and removals applied on top of a published ID-mapped index version
+CHANGE_LOG = 'changes-{version}.jsonl'
+
+# Embedding partitions searched by a ShardedIndex, one .npy file (and optional .ids.npy file) per partition
+SHARDS_DIR = 'dataset/partitioned_embeddings'
+
+
+# Default parameters of every index type accepted by make_index
+INDEX_TYPES = {
+    'flat': {},
+    'ivf_flat': {'nlist': None, 'nprobe': 16},
+    'hnsw': {'M': 32, 'efConstruction': 40, 'efSearch': 64},
+    'ivf_pq': {'nlist': None, 'nprobe': 16, 'm': 48, 'nbits': 8},
+    'sq8': {},
+    'sq_fp16': {},
+    'ivf_sq8': {'nlist': None, 'nprobe': 16},
+    'pq': {'m': 48, 'nbits': 8},
+}
+
+# Index types storing compressed codes instead of the float vectors, their results can be re-ranked exactly
+COMPRESSED_TYPES = {'ivf_pq', 'sq8', 'sq_fp16', 'ivf_sq8', 'pq'}
+
+
+def parse_index_spec(spec=None):
         """
-        Create and return a Faiss index based on embeddings stored in 'dataset/embeddings.npy'
+        Normalise an index spec and fill in the default parameters of its type
+
+        Parameters:
+        - spec (None, str or dict): None for a flat index, a string such as 'hnsw' or 'ivf_flat:nlist=1024,nprobe=16',
+          or a dict such as {'type': 'ivf_pq', 'nlist': 1024, 'm': 48}
+
+        Returns:
+        dict: the index type and all its parameters
+        """
+        if spec is None:
+            spec = {'type': 'flat'}
+        elif isinstance(spec, str):
+            index_type, _, params = spec.partition(':')
+            spec = {'type': index_type}
+            for param in filter(None, params.split(',')):
+                name, value = param.split('=')
+                spec[name.strip()] = int(value)
+
+        if spec['type'] not in INDEX_TYPES:
+            raise ValueError(f"Index type should be one of {list(INDEX_TYPES)}")
+
+        unknown = set(spec) - set(INDEX_TYPES[spec['type']]) - {'type'}
+        if unknown:
+            raise ValueError(f"Unknown parameters for a {spec['type']} index: {sorted(unknown)}")
+
+        return dict(INDEX_TYPES[spec['type']], **spec)
+
+
+def _factory_string(spec, ntotal):
+        # Rule of thumb of the faiss documentation: about 4 * sqrt(n) inverted lists
+        nlist = spec.get('nlist') or max(1, int(4 * np.sqrt(ntotal)))
+        return {
+            'flat': 'Flat',
+            'ivf_flat': f"IVF{nlist},Flat",
+            'hnsw': f"HNSW{spec.get('M')},Flat",
+            'ivf_pq': f"IVF{nlist},PQ{spec.get('m')}x{spec.get('nbits')}",
+            'sq8': 'SQ8',
+            'sq_fp16': 'SQfp16',
+            'ivf_sq8': f"IVF{nlist},SQ8",
+            'pq': f"PQ{spec.get('m')}x{spec.get('nbits')}",
+        }[spec['type']]
+
+
+def set_search_params(index, spec):
+        """
+        Apply the search-time parameters of a spec (nprobe, efSearch) to an index
 
         Parameters:
+        - index (faiss.Index): the index
+        - spec (None, str or dict): the index spec, see parse_index_spec
+
+        Returns:
         None
+        """
+        spec = parse_index_spec(spec)
+        params = []
+        if 'nprobe' in spec:
+            params.append(f"nprobe={spec['nprobe']}")
+        if 'efSearch' in spec:
+            params.append(f"efSearch={spec['efSearch']}")
+        if params:
+            faiss.ParameterSpace().set_index_parameters(index, ','.join(params))
+
+
+def search_params(index, selector):
+        """
+        Build the search parameters that restrict a search of the index to the ids accepted by a selector
+
+        The nprobe and efSearch of the index are kept, search parameters otherwise reset them.
+
+        Parameters:
+        - index (faiss.Index): the index to search
+        - selector (faiss.IDSelector): the selector of the searched ids
 
         Returns:
-        faiss.IndexFlatL2: a Faiss flat L2 index containing the loaded embeddings
+        faiss.SearchParameters: the parameters to pass to index.search
+        """
+        ivf = faiss.try_extract_index_ivf(index)
+        if ivf is not None:
+            return faiss.SearchParametersIVF(sel=selector, nprobe=ivf.nprobe)
+
+        inner = faiss.downcast_index(index.index) if isinstance(index, faiss.IndexIDMap) else index
+        if isinstance(inner, faiss.IndexHNSW):
+            return faiss.SearchParametersHNSW(sel=selector, efSearch=inner.hnsw.efSearch)
+        return faiss.SearchParameters(sel=selector)
+
+
+def make_index(embeddings, spec=None, train_size=100000, ids=None):
+        """
+        Create, train and fill an index of the given type
+
+        Parameters:
+        - embeddings (numpy.ndarray): the vectors to index
+        - spec (None, str or dict): the index spec, see parse_index_spec
+        - train_size (int): the maximum number of vectors used to train IVF and PQ indexes
+        - ids (numpy.ndarray): the article ids of the vectors, the index returns row positions if None
+
+        Returns:
+        faiss.Index: the filled index
+        """
+        spec = parse_index_spec(spec)
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+
+        index = faiss.index_factory(embeddings.shape[1], _factory_string(spec, len(embeddings)), faiss.METRIC_L2)
+        if spec['type'] == 'hnsw':
+            index.hnsw.efConstruction = spec['efConstruction']
+
+        if not index.is_trained:
+            # Train on a random sample, the clustering does not need the whole corpus
+            sample = embeddings
+            if len(embeddings) > train_size:
+                sample = embeddings[np.random.default_rng(0).choice(len(embeddings), train_size, replace=False)]
+            index.train(sample)
+
+        if ids is None:
+            index.add(embeddings)
+        else:
+            # IVF indexes store the ids in their lists, the others are wrapped in an id map that supports removals
+            if not spec['type'].startswith('ivf_'):
+                index = faiss.IndexIDMap2(index)
+            index.add_with_ids(embeddings, np.asarray(ids, dtype=np.int64))
+        set_search_params(index, spec)
+        return index
+
+
+def get_index(spec=None, id_mapped=False):
+        """
+        Create and return a Faiss index based on embeddings stored in 'dataset/embeddings.npy'
+
+        Parameters:
+        - spec (None, str or dict): the index type and parameters, a flat L2 index if None (see parse_index_spec)
+        - id_mapped (bool): whether the index returns the article ids (see load_ids) instead of row positions
+
+        Returns:
+        faiss.Index: a Faiss index containing the loaded embeddings
         """
 
         # Check if the embeddings file exists
@@ -21,45 +183,830 @@ def get_index():
         else:
             print('No existing embeddings found')
 
-        # Create a Faiss index (a simple flat L2 index)
-        index = faiss.IndexFlatL2(embeddings.shape[1])
+        # Create the index and add the vectors to it
+        ids = load_ids('dataset/embeddings.npy', len(embeddings)) if id_mapped else None
+        return make_index(embeddings, spec, ids=ids)
 
-        # Add vectors to the index
-        index.add(embeddings)
-
-        return index
-
-def similarity_search(vec, k, index):
+def similarity_search(vec, k, index, embeddings=None, rerank_factor=4):
         """
         Perform similarity search on a Faiss index
 
         Parameters:
         - vec (numpy.ndarray): the vector for which to search similar vectors
         - k (int): the number of nearest neighbors to retrieve
-        - index (faiss.IndexFlatL2): the Faiss index to search
+        - index (faiss.Index): the Faiss index to search
+        - embeddings (numpy.ndarray): the (float16) vectors of the index, if given the top k * rerank_factor
+          candidates of a compressed index are re-ranked by their exact distance
+        - rerank_factor (int): the number of candidates per result that are re-ranked
 
         Returns:
         tuple: a tuple containing two arrays, which are D (distances) and I (indices) of the k nearest neighbors
         """
 
-        # Search the index (D is distance, I is index of neighbors)
-        D, I = index.search(vec, k)
+        if embeddings is None:
+            # Search the index (D is distance, I is index of neighbors)
+            D, I = index.search(vec, k)
+            return D, I
+
+        return rerank_search(vec, k, index, embeddings, rerank_factor)
+
+
+def rerank_search(vec, k, index, embeddings, rerank_factor=4):
+        """
+        Search a compressed index for candidates and re-rank them by their exact L2 distance
+
+        Parameters:
+        - vec (numpy.ndarray): the query vectors
+        - k (int): the number of nearest neighbors to retrieve
+        - index (faiss.Index): the compressed Faiss index to search
+        - embeddings (numpy.ndarray or StoreOverlay): the vectors of the index, row i holding the vector of id i
+        - rerank_factor (int): the number of candidates per result that are re-ranked
+
+        Returns:
+        tuple: the exact distances and the ids of the k nearest candidates, padded with inf and -1
+        """
+        vec = np.ascontiguousarray(vec, dtype=np.float32)
+        approximate, candidates = index.search(vec, k * rerank_factor)
+        return rerank_candidates(vec, k, approximate, candidates, embeddings)
+
+
+def rerank_candidates(vec, k, approximate, candidates, embeddings):
+        """
+        Re-rank the candidates of a compressed index search by their exact L2 distance
+
+        Parameters:
+        - vec (numpy.ndarray): the query vectors
+        - k (int): the number of nearest neighbors to keep
+        - approximate (numpy.ndarray): the distances of the candidates returned by the index
+        - candidates (numpy.ndarray): the ids of the candidates, -1 for missing results
+        - embeddings (numpy.ndarray or StoreOverlay): the vectors of the index, row i holding the vector of id i
+
+        Returns:
+        tuple: the exact distances and the ids of the k nearest candidates, padded with inf and -1
+        """
+        D = np.full((len(vec), k), np.inf, dtype=np.float32)
+        I = np.full((len(vec), k), -1, dtype=np.int64)
+        for row, (query, ids, index_distances) in enumerate(zip(vec, candidates, approximate)):
+            # Sorted ids read the memory-mapped vectors in file order
+            found = ids >= 0
+            order = np.argsort(ids[found])
+            ids, index_distances = ids[found][order], index_distances[found][order]
+            distances = np.sum((np.asarray(embeddings[ids], dtype=np.float32) - query) ** 2, axis=1)
+
+            # Candidates without a stored vector keep the distance of the index
+            distances = np.where(np.isnan(distances), index_distances, distances)
+            best = np.argsort(distances)[:k]
+            D[row, :len(best)] = distances[best]
+            I[row, :len(best)] = ids[best]
         return D, I
 
-def index_dataset(df):
+
+def save_embeddings_fp16(embeddings, output_path, block_size=65536, ids=None):
+        """
+        Save embeddings as a float16 .npy file, half the size of the float32 file
+
+        Parameters:
+        - embeddings (numpy.ndarray or str): the embeddings or the path of a float32 embeddings file
+        - output_path (str): the path of the float16 file
+        - block_size (int): the number of rows converted at once
+        - ids (numpy.ndarray): the article ids of the embeddings, the vector of id i is written to row i if given
+
+        Returns:
+        None
+        """
+        if isinstance(embeddings, str):
+            embeddings = np.load(embeddings, mmap_mode='r')
+
+        rows = len(embeddings) if ids is None else int(np.max(ids)) + 1
+        # Convert block by block so that no full float32 copy is needed
+        output = np.lib.format.open_memmap(output_path, mode='w+', dtype=np.float16, shape=(rows, embeddings.shape[1]))
+        for start in range(0, len(embeddings), block_size):
+            if ids is None:
+                output[start:start + block_size] = embeddings[start:start + block_size]
+            else:
+                output[ids[start:start + block_size]] = embeddings[start:start + block_size]
+        output.flush()
+        del output
+
+
+class StoreOverlay:
+    """
+    The float16 re-ranking vectors of a published version, overlaid with the vectors of the changes applied since
+
+    Indexing it with an array of ids returns float32 rows, NaN for ids that have no stored vector.
+    """
+
+    def __init__(self, store, overrides):
+        self.store = store
+        self.overrides = overrides
+
+    def __getitem__(self, ids):
+        ids = np.asarray(ids)
+        vectors = np.full((len(ids), self.store.shape[1]), np.nan, dtype=np.float32)
+        inside = ids < len(self.store)
+        vectors[inside] = self.store[ids[inside]]
+        for row, article_id in enumerate(ids.tolist()):
+            if article_id in self.overrides:
+                vectors[row] = self.overrides[article_id]
+        return vectors
+
+
+def index_dataset(df, spec=None):
+        """
+        Create a Faiss index of a dataset, encoding it first if 'dataset/embeddings.npy' does not exist
+
+        Parameters:
+        - df (pandas.DataFrame): the dataset containing a 'text' column with article texts
+        - spec (None, str or dict): the index type and parameters, a flat L2 index if None (see parse_index_spec)
+
+        Returns:
+        faiss.Index: a Faiss index containing the embeddings of the dataset
+        """
         # Check if the embeddings file exists
-        if os.path.exists('dataset/embeddings.npy'):
-            # Load the embeddings
-            embeddings = np.load('dataset/embeddings.npy')
-        else:
+        if not os.path.exists('dataset/embeddings.npy'):
             # Call the function to encode the dataset
-            embeddings = encode_dataset(df)
-            np.save('dataset/embeddings.npy', embeddings)
+            from utils.vectorizer import encode_dataset
+            encode_dataset(df, 'dataset/embeddings.npy')
 
-        # Create a Faiss index - here we use a simple flat L2 index
-        index = faiss.IndexFlatL2(embeddings.shape[1])
+        # Load the embeddings
+        embeddings = np.load('dataset/embeddings.npy')
 
-        # Add vectors to the index
-        index.add(embeddings)
+        # Create the index and add the vectors to it
+        return make_index(embeddings, spec)
 
-        return index
+
+def publish_index(index, index_dir=INDEX_DIR, keep=2, spec=None, embeddings=None, ids=None, id_mapped=False):
+        """
+        Write an index to a new versioned file and point the version stamp to it
+
+        Every version gets its own file that is never modified afterwards, so processes that memory-mapped
+        an older version keep a valid mapping. The stamp is replaced atomically.
+
+        Parameters:
+        - index (faiss.Index): the index to publish
+        - index_dir (str): the directory of the index files
+        - keep (int): the number of versions kept on disk
+        - spec (None, str or dict): the spec the index was built with, stored in the stamp
+        - embeddings (numpy.ndarray): vectors saved as float16 next to the index to re-rank its results
+        - ids (numpy.ndarray): the article ids of the embeddings. ID-mapped indexes key their re-ranking vectors on
+          them, positional indexes save them next to the index to translate their rows to article ids
+        - id_mapped (bool): whether the index returns article ids, only ID-mapped indexes accept a change log
+
+        Returns:
+        dict: the version stamp of the published index
+        """
+        os.makedirs(index_dir, exist_ok=True)
+        now = time.time()
+        version = time.strftime('%Y%m%d-%H%M%S', time.localtime(now)) + f'-{int(now * 1000) % 1000:03d}'
+        file_name = f'index-{version}.faiss'
+
+        # Write to a temporary file first so that readers never see a partial index
+        path = os.path.join(index_dir, file_name)
+        faiss.write_index(index, path + '.tmp')
+        os.replace(path + '.tmp', path)
+
+        stamp = {'version': version, 'file': file_name, 'ntotal': int(index.ntotal), 'dim': int(index.d),
+                 'spec': parse_index_spec(spec), 'id_mapped': id_mapped}
+
+        if embeddings is not None:
+            stamp['embeddings'] = f'embeddings-{version}.f16.npy'
+            store_path = os.path.join(index_dir, stamp['embeddings'])
+            save_embeddings_fp16(embeddings, store_path + '.tmp.npy', ids=ids if id_mapped else None)
+            os.replace(store_path + '.tmp.npy', store_path)
+
+        if ids is not None and not id_mapped:
+            stamp['ids'] = f'ids-{version}.npy'
+            ids_path = os.path.join(index_dir, stamp['ids'])
+            np.save(ids_path + '.tmp.npy', np.asarray(ids, dtype=np.int64))
+            os.replace(ids_path + '.tmp.npy', ids_path)
+
+        stamp_path = os.path.join(index_dir, VERSION_FILE)
+        with open(stamp_path + '.tmp', 'w') as f:
+            json.dump(stamp, f)
+        os.replace(stamp_path + '.tmp', stamp_path)
+
+        # Remove old versions, processes still mapping them keep their pages until they swap
+        versions = sorted(name[len('index-'):-len('.faiss')] for name in os.listdir(index_dir)
+                          if name.startswith('index-') and name.endswith('.faiss'))
+        for old_version in versions[:-keep]:
+            for name in (f'index-{old_version}.faiss', f'embeddings-{old_version}.f16.npy', f'ids-{old_version}.npy',
+                         CHANGE_LOG.format(version=old_version)):
+                if os.path.exists(os.path.join(index_dir, name)):
+                    os.remove(os.path.join(index_dir, name))
+
+        print(f"Published index version {version} with {index.ntotal} vectors")
+        return stamp
+
+
+def load_ids(embeddings_path, rows):
+        """
+        Load the article ids saved next to an embeddings file, e.g. 'embeddings.ids.npy' for 'embeddings.npy'
+
+        Parameters:
+        - embeddings_path (str): the path of the embeddings numpy file
+        - rows (int): the number of embeddings
+
+        Returns:
+        numpy.ndarray: the int64 ids, the dataset 'Index' values 1..rows if no ids file exists
+        """
+        path = os.path.splitext(embeddings_path)[0] + '.ids.npy'
+        if os.path.exists(path):
+            return np.load(path).astype(np.int64)
+
+        # Row i of the embeddings is the article with Index i + 1 (see util.partition_large_dataset)
+        return np.arange(1, rows + 1, dtype=np.int64)
+
+
+class RowIds:
+    """
+    The article ids of the rows of a positional index, translating search results to ids and ids back to rows
+
+    The ids may be a memory-mapped array, they are only sorted in memory when they are not increasing.
+    """
+
+    def __init__(self, ids):
+        self.ids = ids
+        increasing = len(ids) < 2 or bool(np.all(np.diff(ids) > 0))
+        self._order = None if increasing else np.argsort(ids, kind='stable')
+        self._sorted = ids if increasing else np.asarray(ids)[self._order]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def to_ids(self, rows):
+        """
+        Translate row positions to article ids, keeping the -1 of missing results
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        found = (rows >= 0) & (rows < len(self.ids))
+        ids = np.full(rows.shape, -1, dtype=np.int64)
+        ids[found] = np.asarray(self.ids)[rows[found]]
+        return ids
+
+    def to_rows(self, ids):
+        """
+        Translate article ids to row positions, -1 for ids that are not in the index
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        if not len(self._sorted):
+            return np.full(ids.shape, -1, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self._sorted, ids), len(self._sorted) - 1)
+        found = np.asarray(self._sorted)[positions] == ids
+        rows = positions if self._order is None else self._order[positions]
+        return np.where(found, rows, -1).astype(np.int64)
+
+
+def build_index(embeddings_path='dataset/embeddings.npy', index_dir=INDEX_DIR, spec=None, rerank=None, id_mapped=False):
+        """
+        Build an index from an embeddings file and publish it
+
+        Parameters:
+        - embeddings_path (str): the path of the embeddings numpy file
+        - index_dir (str): the directory of the index files
+        - spec (None, str or dict): the index type and parameters, a flat L2 index if None (see parse_index_spec)
+        - rerank (bool): whether to publish float16 vectors to re-rank the results, by default for compressed indexes
+        - id_mapped (bool): whether to key the index on the article ids (see load_ids) so that it accepts a ChangeLog.
+          Positional indexes are memory-mapped by the serving processes, their rows are translated with the ids
+
+        Returns:
+        dict: the version stamp of the published index
+        """
+        spec = parse_index_spec(spec)
+        if rerank is None:
+            rerank = spec['type'] in COMPRESSED_TYPES
+
+        embeddings = np.load(embeddings_path, mmap_mode='r')
+        ids = load_ids(embeddings_path, len(embeddings))
+        index = make_index(embeddings, spec, ids=ids if id_mapped else None)
+        return publish_index(index, index_dir, spec=spec, embeddings=embeddings if rerank else None, ids=ids,
+                             id_mapped=id_mapped)
+
+
+def _encode_vectors(embeddings):
+        return base64.b64encode(np.ascontiguousarray(embeddings, dtype=np.float32).tobytes()).decode('ascii')
+
+
+def _decode_vectors(data, rows):
+        return np.frombuffer(base64.b64decode(data), dtype=np.float32).reshape(rows, -1)
+
+
+class ChangeLog:
+    """
+    Append-only log of the articles added to and removed from the published ID-mapped index
+
+    Every published version has its own log, a JSON line per operation with the vectors base64-encoded.
+    The serving processes read the new lines of the log of the version they serve and apply them without a restart,
+    compact_index folds the log into a new version. The log assumes a single writing process.
+    """
+
+    def __init__(self, index_dir=INDEX_DIR):
+        self.index_dir = index_dir
+
+    def path(self, version):
+        return os.path.join(self.index_dir, CHANGE_LOG.format(version=version))
+
+    def _append(self, entry, removes=False):
+        stamp = read_version(self.index_dir)
+        if stamp is None or not stamp.get('id_mapped'):
+            raise ValueError(f"No ID-mapped index published in {self.index_dir}, build it with id_mapped=True")
+        if removes and stamp['spec']['type'] == 'hnsw':
+            raise ValueError("HNSW indexes do not support removals, rebuild the index instead")
+
+        # A single write per entry so that readers only ever see complete lines
+        with open(self.path(stamp['version']), 'ab') as f:
+            f.write((json.dumps(entry) + '\n').encode('utf-8'))
+
+    def add(self, ids, embeddings):
+        """
+        Add new articles to the index
+
+        Parameters:
+        - ids (list): the article ids, which must not be in the index yet
+        - embeddings (numpy.ndarray): the embeddings of the articles, one row per id
+
+        Returns:
+        None
+        """
+        ids = [int(article_id) for article_id in ids]
+        self._append({'op': 'add', 'ids': ids, 'vectors': _encode_vectors(embeddings)})
+
+    def remove(self, ids):
+        """
+        Remove articles from the index
+
+        Parameters:
+        - ids (list): the article ids
+
+        Returns:
+        None
+        """
+        self._append({'op': 'remove', 'ids': [int(article_id) for article_id in ids]}, removes=True)
+
+    def upsert(self, ids, embeddings):
+        """
+        Add articles to the index, replacing the vectors of the ids already in it
+
+        Parameters:
+        - ids (list): the article ids
+        - embeddings (numpy.ndarray): the embeddings of the articles, one row per id
+
+        Returns:
+        None
+        """
+        ids = [int(article_id) for article_id in ids]
+        self._append({'op': 'upsert', 'ids': ids, 'vectors': _encode_vectors(embeddings)}, removes=True)
+
+    def read(self, version, offset=0):
+        """
+        Read the complete entries of the log of a version written after an offset
+
+        Parameters:
+        - version (str): the index version
+        - offset (int): the byte offset of the first unread entry
+
+        Returns:
+        tuple: the entries and the offset after the last complete one
+        """
+        try:
+            with open(self.path(version), 'rb') as f:
+                f.seek(offset)
+                data = f.read()
+        except FileNotFoundError:
+            return [], offset
+
+        # Leave a line that is still being written for the next read
+        complete = data[:data.rfind(b'\n') + 1]
+        return [json.loads(line) for line in complete.splitlines() if line.strip()], offset + len(complete)
+
+
+def apply_changes(index, entries, overrides=None):
+        """
+        Apply change log entries to an ID-mapped index in place
+
+        Parameters:
+        - index (faiss.Index): the ID-mapped index
+        - entries (list): the entries read from a ChangeLog
+        - overrides (dict): updated with the float16 vector of every added id, for re-ranking
+
+        Returns:
+        None
+        """
+        for entry in entries:
+            ids = np.asarray(entry['ids'], dtype=np.int64)
+            if entry['op'] in ('remove', 'upsert'):
+                index.remove_ids(ids)
+            if entry['op'] in ('add', 'upsert'):
+                vectors = np.ascontiguousarray(_decode_vectors(entry['vectors'], len(ids)))
+                index.add_with_ids(vectors, ids)
+                if overrides is not None:
+                    overrides.update(zip(ids.tolist(), vectors.astype(np.float16)))
+
+
+def compact_index(index_dir=INDEX_DIR, keep=2):
+        """
+        Fold the change log of the current ID-mapped index into a newly published version
+
+        Parameters:
+        - index_dir (str): the directory of the index files
+        - keep (int): the number of versions kept on disk
+
+        Returns:
+        dict: the version stamp of the published index
+        """
+        stamp = read_version(index_dir)
+        if stamp is None or not stamp.get('id_mapped'):
+            raise ValueError(f"No ID-mapped index published in {index_dir}")
+
+        log = ChangeLog(index_dir)
+        index = faiss.read_index(os.path.join(index_dir, stamp['file']))
+        entries, offset = log.read(stamp['version'])
+        overrides = {}
+        apply_changes(index, entries, overrides)
+
+        store = None
+        if stamp.get('embeddings'):
+            # The store is indexed by id, grow it to the largest added id
+            store = np.load(os.path.join(index_dir, stamp['embeddings']), mmap_mode='r')
+            rows = max([len(store)] + [article_id + 1 for article_id in overrides])
+            store = np.concatenate([store, np.zeros((rows - len(store), store.shape[1]), dtype=np.float16)])
+            for article_id, vector in overrides.items():
+                store[article_id] = vector
+
+        new_stamp = publish_index(index, index_dir, keep, stamp['spec'], embeddings=store, id_mapped=True)
+
+        # Carry entries written during the compaction over to the log of the new version
+        entries, _ = log.read(stamp['version'], offset)
+        if entries:
+            with open(log.path(new_stamp['version']), 'ab') as f:
+                f.write(''.join(json.dumps(entry) + '\n' for entry in entries).encode('utf-8'))
+        return new_stamp
+
+
+def read_version(index_dir=INDEX_DIR):
+        """
+        Read the version stamp of the current index
+
+        Parameters:
+        - index_dir (str): the directory of the index files
+
+        Returns:
+        dict: the version stamp, or None if no index was published
+        """
+        try:
+            with open(os.path.join(index_dir, VERSION_FILE)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+
+def load_index(path):
+        """
+        Load an index file read-only, memory-mapped where the index type supports it
+
+        Parameters:
+        - path (str): the path of the index file
+
+        Returns:
+        faiss.Index: the loaded index
+        """
+        try:
+            return faiss.read_index(path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+        except RuntimeError:
+            return faiss.read_index(path)
+
+
+class ServedIndex:
+    """
+    The index used to serve requests, loaded once and swapped when a new version is published
+
+    The version stamp is checked at most every check_interval seconds. The new index is loaded
+    before it replaces the current one, so requests never wait for a load or see a partial index.
+    Memory-mapped pages are shared through the page cache by every worker process serving the same version.
+
+    The rows of these positional indexes are translated to article ids with the ids published next to them.
+    ID-mapped indexes are loaded in memory instead, and the new entries of their ChangeLog are applied
+    to a copy of the served index at the same interval, which then replaces it.
+    """
+
+    def __init__(self, index_dir=INDEX_DIR, check_interval=5.0):
+        self.index_dir = index_dir
+        self.check_interval = check_interval
+        self.version = None
+        # Whether the served index returns article ids rather than row positions
+        self.id_mapped = False
+        # Incremented whenever the served index changes, by a new version or by applied changes
+        self.generation = 0
+        # The served index, its re-ranking vectors and the RowIds of a positional index, replaced together
+        self._state = (None, None, None)
+        self._store = None
+        self._overrides = {}
+        self._log = ChangeLog(index_dir)
+        self._log_offset = 0
+        self._checked = 0.0
+        self._lock = threading.Lock()
+
+    def snapshot(self, with_ids=False):
+        """
+        Return the current index and its float16 re-ranking vectors (None if not published) as one consistent pair,
+        loading a newly published version first if there is one
+
+        With with_ids, the RowIds of the index are returned third, None if the index is ID-mapped.
+        """
+        if self._state[0] is None or time.monotonic() - self._checked > self.check_interval:
+            with self._lock:
+                if self._state[0] is None or time.monotonic() - self._checked > self.check_interval:
+                    self._refresh()
+        return self._state if with_ids else self._state[:2]
+
+    def get(self):
+        """
+        Return the current index, loading a newly published version first if there is one
+        """
+        return self.snapshot()[0]
+
+    def _refresh(self):
+        self._checked = time.monotonic()
+        stamp = read_version(self.index_dir)
+
+        if stamp is None:
+            # Nothing published yet, build the index from the embeddings once
+            if self._state[0] is None:
+                print('No published index found, building it from the embeddings')
+                index = get_index()
+                self._state = (index, None, RowIds(load_ids('dataset/embeddings.npy', index.ntotal)))
+                self.generation += 1
+            return
+
+        if stamp['version'] != self.version:
+            self._load_version(stamp)
+        elif stamp.get('id_mapped'):
+            self._apply_log(stamp)
+
+    def _load_version(self, stamp):
+        try:
+            path = os.path.join(self.index_dir, stamp['file'])
+            # ID-mapped indexes are updated by their change log and cannot be read-only mappings
+            index = faiss.read_index(path) if stamp.get('id_mapped') else load_index(path)
+            store = None
+            if stamp.get('embeddings'):
+                store = np.load(os.path.join(self.index_dir, stamp['embeddings']), mmap_mode='r')
+            row_ids = None
+            if stamp.get('ids'):
+                row_ids = RowIds(np.load(os.path.join(self.index_dir, stamp['ids']), mmap_mode='r'))
+            elif not stamp.get('id_mapped'):
+                # Published without ids, row i is the article with Index i + 1 (see load_ids)
+                row_ids = RowIds(np.arange(1, index.ntotal + 1, dtype=np.int64))
+        except (RuntimeError, FileNotFoundError):
+            # Replaced again before it could be loaded, the next check picks up the newest version
+            print(f"Could not load index version {stamp['version']}")
+            if self._state[0] is None:
+                raise
+            return
+
+        # The index is not served yet, so its change log is applied in place
+        overrides, offset = {}, 0
+        if stamp.get('id_mapped'):
+            entries, offset = self._log.read(stamp['version'])
+            apply_changes(index, entries, overrides)
+
+        set_search_params(index, stamp.get('spec'))
+        self._swap(index, store, row_ids, overrides, offset, stamp['version'])
+        print(f"Serving index version {self.version}")
+
+    def _apply_log(self, stamp):
+        entries, offset = self._log.read(stamp['version'], self._log_offset)
+        if not entries:
+            return
+
+        # Requests keep searching the current index while its copy is updated
+        index = faiss.clone_index(self._state[0])
+        overrides = dict(self._overrides)
+        apply_changes(index, entries, overrides)
+        set_search_params(index, stamp.get('spec'))
+        self._swap(index, self._store, None, overrides, offset, self.version)
+        print(f"Applied {len(entries)} changes to index version {self.version}")
+
+    def _swap(self, index, store, row_ids, overrides, offset, version):
+        embeddings = StoreOverlay(store, overrides) if store is not None and overrides else store
+        self._store, self._overrides, self._log_offset = store, overrides, offset
+        self._state, self.version, self.id_mapped = (index, embeddings, row_ids), version, row_ids is None
+        self.generation += 1
+
+
+served_index = ServedIndex()
+
+
+def shard_paths(partitions_dir=SHARDS_DIR):
+        """
+        List the embedding partitions of a directory in partition order ('part_2' before 'part_10')
+
+        Parameters:
+        - partitions_dir (str): the directory of the partitions
+
+        Returns:
+        list: the paths of the partition .npy files, without the ids and float16 files
+        """
+        names = [name for name in os.listdir(partitions_dir)
+                 if name.endswith('.npy') and not name.endswith(('.ids.npy', '.f16.npy'))]
+        names.sort(key=lambda name: [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', name)])
+        return [os.path.join(partitions_dir, name) for name in names]
+
+
+def _shard_ids(path, offset, rows):
+        # Ids saved next to the partition, or the dataset 'Index' values of its rows in the concatenated corpus
+        ids_path = os.path.splitext(path)[0] + '.ids.npy'
+        if os.path.exists(ids_path):
+            return np.load(ids_path).astype(np.int64)
+        return np.arange(offset + 1, offset + rows + 1, dtype=np.int64)
+
+
+def shard_files_version(partitions_dir=SHARDS_DIR):
+        """
+        Identify the current files of the embedding partitions and of their shard indexes
+
+        Parameters:
+        - partitions_dir (str): the directory of the partitions
+
+        Returns:
+        str: a digest of the name, size and modification time of every partition, ids and index file
+        """
+        files = []
+        for entry in os.scandir(partitions_dir):
+            if entry.name.endswith(('.npy', '.faiss')):
+                stat = entry.stat()
+                files.append((entry.name, stat.st_size, stat.st_mtime_ns))
+        return hashlib.sha256(repr(sorted(files)).encode('utf-8')).hexdigest()[:16]
+
+
+def build_shards(partitions_dir=SHARDS_DIR, spec=None):
+        """
+        Build the index of every embedding partition and save it next to it, e.g. 'part_1.faiss' for 'part_1.npy'
+
+        Parameters:
+        - partitions_dir (str): the directory of the partitions
+        - spec (None, str or dict): the index type and parameters, a flat L2 index if None (see parse_index_spec)
+
+        Returns:
+        int: the number of indexed vectors
+        """
+        paths, total = shard_paths(partitions_dir), 0
+        for path in paths:
+            embeddings = np.load(path, mmap_mode='r')
+            index = make_index(embeddings, spec, ids=_shard_ids(path, total, len(embeddings)))
+            faiss.write_index(index, os.path.splitext(path)[0] + '.faiss.tmp')
+            os.replace(os.path.splitext(path)[0] + '.faiss.tmp', os.path.splitext(path)[0] + '.faiss')
+            total += len(embeddings)
+        print(f'Built {len(paths)} shards with {total} vectors')
+        return total
+
+
+class ShardedIndex:
+    """
+    An index split into one index per embedding partition, searched in parallel
+
+    Every shard is keyed on the global article ids, and loaded on its first search: memory-mapped from the
+    .faiss file written by build_shards, or built from the partition if there is none. Queries fan out
+    to the shards through a thread pool, faiss releases the GIL while it searches, and the per-shard
+    top-k results are merged. It implements search() like a faiss index, so it can be passed to similarity_search.
+
+    The partition files are checked at most every check_interval seconds, the shards are loaded again
+    once build_shards rewrote them.
+    """
+
+    def __init__(self, partitions_dir=SHARDS_DIR, spec=None, max_workers=None, check_interval=5.0):
+        self.partitions_dir = partitions_dir
+        self.spec = parse_index_spec(spec)
+        self.max_workers = max_workers
+        self.check_interval = check_interval
+        self._paths = None
+        self._ntotal = 0
+        self._shards = {}
+        self._pool = None
+        self._version = None
+        self._checked = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def version(self):
+        """
+        The version of the partition files (see shard_files_version), the loaded shards are dropped when it changes
+        """
+        self._check_files()
+        return self._version
+
+    def _check_files(self):
+        if self._version is None or time.monotonic() - self._checked > self.check_interval:
+            with self._lock:
+                if self._version is None or time.monotonic() - self._checked > self.check_interval:
+                    self._checked = time.monotonic()
+                    version = shard_files_version(self.partitions_dir)
+                    if version != self._version:
+                        # Searches running on the previous shards keep their own references
+                        self._version, self._paths, self._shards = version, None, {}
+
+    def _load_paths(self):
+        self._check_files()
+        paths = self._paths
+        if paths is None:
+            with self._lock:
+                if self._paths is None:
+                    # Global id offsets come from the partition headers, without reading the vectors
+                    paths, offsets, total = shard_paths(self.partitions_dir), [], 0
+                    if not paths:
+                        raise FileNotFoundError(f"No embedding partitions in {self.partitions_dir}")
+                    for path in paths:
+                        offsets.append(total)
+                        total += len(np.load(path, mmap_mode='r'))
+                    if self._pool is None:
+                        self._pool = ThreadPoolExecutor(max_workers=self.max_workers or min(len(paths), os.cpu_count()))
+                    self._paths, self._ntotal = list(zip(paths, offsets)), total
+                paths = self._paths
+        return paths
+
+    def _shard(self, path, offset):
+        shards = self._shards
+        if path not in shards:
+            with self._lock:
+                if path not in shards:
+                    index_path = os.path.splitext(path)[0] + '.faiss'
+                    if os.path.exists(index_path):
+                        index = load_index(index_path)
+                    else:
+                        embeddings = np.load(path, mmap_mode='r')
+                        index = make_index(embeddings, self.spec, ids=_shard_ids(path, offset, len(embeddings)))
+                    set_search_params(index, self.spec)
+                    shards[path] = index
+        return shards[path]
+
+    def _search_shard(self, path, offset, vec, k, selector):
+        shard = self._shard(path, offset)
+        if selector is None:
+            return shard.search(vec, k)
+        return shard.search(vec, k, params=search_params(shard, selector))
+
+    def search(self, vec, k, selector=None):
+        """
+        Search every shard and merge their results
+
+        Parameters:
+        - vec (numpy.ndarray): the query vectors
+        - k (int): the number of nearest neighbors to retrieve
+        - selector (faiss.IDSelector): restricts the search to the global ids it accepts
+
+        Returns:
+        tuple: the distances and the global article ids of the k nearest neighbors
+        """
+        paths = self._load_paths()
+        vec = np.ascontiguousarray(vec, dtype=np.float32)
+        results = list(self._pool.map(lambda shard: self._search_shard(*shard, vec, k, selector), paths))
+
+        D = np.concatenate([distances for distances, _ in results], axis=1)
+        I = np.concatenate([ids for _, ids in results], axis=1)
+
+        # Shards with fewer than k vectors pad their results with -1 at an infinite distance
+        D = np.where(I < 0, np.inf, D)
+        best = np.argsort(D, axis=1, kind='stable')[:, :k]
+        return np.take_along_axis(D, best, axis=1), np.take_along_axis(I, best, axis=1)
+
+    @property
+    def ntotal(self):
+        """
+        The number of vectors of all the shards
+        """
+        self._load_paths()
+        return self._ntotal
+
+    @property
+    def loaded(self):
+        """
+        The number of shards loaded so far
+        """
+        return len(self._shards)
+
+
+sharded_index = ShardedIndex()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build and publish the index served by the app')
+    parser.add_argument('--embeddings', default='dataset/embeddings.npy')
+    parser.add_argument('--index-dir', default=INDEX_DIR)
+    parser.add_argument('--spec', default='flat', help="index type and parameters, e.g. 'hnsw:M=32,efSearch=64'")
+    parser.add_argument('--rerank', dest='rerank', action='store_true', default=None,
+                        help='publish float16 vectors to re-rank results, by default for compressed index types')
+    parser.add_argument('--no-rerank', dest='rerank', action='store_false',
+                        help='do not publish float16 vectors, even for compressed index types')
+    parser.add_argument('--id-mapped', action='store_true',
+                        help="key the index on the dataset 'Index' column so that it accepts incremental changes")
+    parser.add_argument('--compact', action='store_true',
+                        help='fold the change log into a new version of the current index instead of building one')
+    parser.add_argument('--shards', metavar='PARTITIONS_DIR', default=None,
+                        help='build one index per embedding partition of the directory instead of a single index')
+    args = parser.parse_args()
+
+    if args.compact:
+        compact_index(args.index_dir)
+    elif args.shards:
+        build_shards(args.shards, args.spec)
+    else:
+        build_index(args.embeddings, args.index_dir, args.spec, args.rerank, args.id_mapped)
@@ -0,0 +1,183 @@
+import os
+import argparse
+import threading
+import numpy as np
+import pandas as pd
+import faiss
+
+from utils.indexer import ShardedIndex, search_params, rerank_candidates
+
+# Category and date of every article, keyed on the dataset 'Index' column
+METADATA_PATH = 'dataset/metadata.npz'
+
+# Filters selecting at most this fraction of the index are searched exactly on their vectors
+EXACT_SELECTIVITY = 0.02
+
+
+def build_metadata(df, output_path=METADATA_PATH):
+        """
+        Save the category, sub-category and date of every article of a dataset prepared by clean.prepare_df
+
+        Parameters:
+        - df (pandas.DataFrame): the dataset with 'Index', 'category', 'sub_category' and 'date' columns
+        - output_path (str): the path of the metadata file
+
+        Returns:
+        int: the number of articles
+        """
+        categories = pd.Categorical(df['category'].fillna(''))
+        sub_categories = pd.Categorical(df['sub_category'].fillna('') if 'sub_category' in df else [''] * len(df))
+
+        os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+        np.savez(output_path,
+                 ids=df['Index'].to_numpy(dtype=np.int64),
+                 category=categories.codes.astype(np.int16),
+                 categories=np.asarray(categories.categories, dtype=str),
+                 sub_category=sub_categories.codes.astype(np.int16),
+                 sub_categories=np.asarray(sub_categories.categories, dtype=str),
+                 date=pd.to_datetime(df['date']).to_numpy().astype('datetime64[D]'))
+        print(f'Saved the metadata of {len(df)} articles to {output_path}')
+        return len(df)
+
+
+class ArticleMetadata:
+    """
+    Column arrays of the article metadata, loaded on first use, used to select the ids matching a filter
+    """
+
+    def __init__(self, path=METADATA_PATH):
+        self.path = path
+        self._columns = None
+        self._lock = threading.Lock()
+
+    @property
+    def available(self):
+        return os.path.exists(self.path)
+
+    def _load(self):
+        if self._columns is None:
+            with self._lock:
+                if self._columns is None:
+                    with np.load(self.path) as data:
+                        self._columns = {name: data[name] for name in data.files}
+        return self._columns
+
+    @property
+    def categories(self):
+        """
+        The categories of the articles
+        """
+        return [category for category in self._load()['categories'].tolist() if category]
+
+    def _codes(self, names, column):
+        # Codes of the requested values, unknown values select nothing
+        values = self._load()[column].tolist()
+        return [values.index(name) for name in names if name in values]
+
+    def select(self, categories=None, sub_categories=None, start_date=None, end_date=None):
+        """
+        Return the ids of the articles matching every given filter
+
+        Parameters:
+        - categories (list): the accepted categories, any if None
+        - sub_categories (list): the accepted sub-categories, any if None
+        - start_date (str or datetime.date): the first accepted date, no lower bound if None
+        - end_date (str or datetime.date): the last accepted date, no upper bound if None
+
+        Returns:
+        numpy.ndarray: the sorted int64 ids of the matching articles
+        """
+        columns = self._load()
+        mask = np.ones(len(columns['ids']), dtype=bool)
+        if categories:
+            mask &= np.isin(columns['category'], self._codes(categories, 'categories'))
+        if sub_categories:
+            mask &= np.isin(columns['sub_category'], self._codes(sub_categories, 'sub_categories'))
+        if start_date is not None:
+            mask &= columns['date'] >= np.datetime64(pd.Timestamp(start_date).date(), 'D')
+        if end_date is not None:
+            mask &= columns['date'] <= np.datetime64(pd.Timestamp(end_date).date(), 'D')
+        return np.sort(columns['ids'][mask])
+
+
+article_metadata = ArticleMetadata()
+
+
+# Serializes the creation of the id maps of IVF indexes shared by the request threads
+_direct_map_lock = threading.Lock()
+
+
+def _subset_vectors(index, ids):
+        # Vectors of the selected ids, None if the index cannot reconstruct them (sharded or removed ids)
+        if isinstance(index, ShardedIndex):
+            return None
+        ivf = faiss.try_extract_index_ivf(index)
+        if ivf is not None and ivf.direct_map.type == faiss.DirectMap.NoMap:
+            # IVF indexes find the list entry of an id through a map built on the first exact search, a hash table
+            # accepts any ids and the removals of a change log
+            with _direct_map_lock:
+                if ivf.direct_map.type == faiss.DirectMap.NoMap:
+                    ivf.set_direct_map_type(faiss.DirectMap.Hashtable)
+        try:
+            return index.reconstruct_batch(ids)
+        except RuntimeError:
+            return None
+
+
+def filtered_search(vec, k, index, ids, exact_selectivity=EXACT_SELECTIVITY, embeddings=None, rerank_factor=4,
+                    return_strategy=False):
+        """
+        Search the k nearest neighbors among the given ids only
+
+        Selective filters are searched exactly on the vectors of their ids, like a sub-index built for the filter.
+        Broader filters search the index with an ID selector, which skips the other ids inside the search.
+        The selector is used as well when the vectors cannot be reconstructed, e.g. on a sharded index.
+
+        Parameters:
+        - vec (numpy.ndarray): the query vectors
+        - k (int): the number of nearest neighbors to retrieve
+        - index (faiss.Index or ShardedIndex): the searched index
+        - ids (numpy.ndarray): the sorted ids accepted by the filter, e.g. from ArticleMetadata.select, translated to
+          rows for a positional index (see indexer.RowIds)
+        - exact_selectivity (float): the largest fraction of the index searched exactly
+        - embeddings (numpy.ndarray): the (float16) vectors of a compressed index, if given the top k * rerank_factor
+          accepted candidates are re-ranked by their exact distance, see indexer.rerank_search
+        - rerank_factor (int): the number of candidates per result that are re-ranked
+        - return_strategy (bool): whether to also return the strategy that ran, 'exact' or 'selector'
+
+        Returns:
+        tuple: the distances and ids of the k nearest accepted neighbors, padded with inf and -1, and the strategy
+        """
+        vec = np.ascontiguousarray(vec, dtype=np.float32)
+        ids = np.asarray(ids, dtype=np.int64)
+        fetch = k if embeddings is None else k * rerank_factor
+        strategy = 'selector'
+        if len(ids) == 0:
+            D, I = np.full((len(vec), k), np.inf, dtype=np.float32), np.full((len(vec), k), -1, dtype=np.int64)
+            return (D, I, strategy) if return_strategy else (D, I)
+
+        vectors = _subset_vectors(index, ids) if len(ids) <= exact_selectivity * index.ntotal else None
+        if vectors is not None:
+            strategy = 'exact'
+            D, rows = faiss.knn(vec, vectors, min(fetch, len(ids)))
+            D, I = np.where(rows < 0, np.inf, D), np.where(rows < 0, -1, ids[rows])
+            pad = fetch - D.shape[1]
+            D, I = (np.pad(D, ((0, 0), (0, pad)), constant_values=np.inf),
+                    np.pad(I, ((0, 0), (0, pad)), constant_values=-1))
+        elif isinstance(index, ShardedIndex):
+            D, I = index.search(vec, fetch, selector=faiss.IDSelectorBatch(ids))
+        else:
+            D, I = index.search(vec, fetch, params=search_params(index, faiss.IDSelectorBatch(ids)))
+
+        if embeddings is not None:
+            D, I = rerank_candidates(vec, k, D, I, embeddings)
+        return (D, I, strategy) if return_strategy else (D, I)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Save the category and date of every article for filtered search')
+    parser.add_argument('csv_files', nargs='+', help="CSV files with 'Index', 'category' and 'date' columns")
+    parser.add_argument('--output', default=METADATA_PATH)
+    args = parser.parse_args()
+
+    build_metadata(pd.concat([pd.read_csv(path) for path in args.csv_files], ignore_index=True), args.output)
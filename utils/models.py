@@ -0,0 +1,262 @@
+import os
+import threading
+from collections import OrderedDict
+
+import torch
+from transformers import AutoConfig, AutoModel
+from transformers import T5ForConditionalGeneration, T5TokenizerFast, BartForConditionalGeneration, BartTokenizerFast
+from sentence_transformers import SentenceTransformer, models
+
+# Summarization models, keyed by the model_name accepted by summarize_text
+SUMMARIZERS = {
+    'bart': ('facebook/bart-large-cnn', BartTokenizerFast, BartForConditionalGeneration),
+    't5': ('t5-large', T5TokenizerFast, T5ForConditionalGeneration),
+}
+
+# Sentence embedding model used to encode the summaries and the size of its vectors
+ENCODER_NAME = 'all-MiniLM-L6-v2'
+ENCODER_DIM = 384
+ENCODER_CHECKPOINT = 'sentence-transformers/' + ENCODER_NAME
+ENCODER_MAX_SEQ_LENGTH = 256
+
+# Opt-in int8 dynamic quantization of the models and where the quantized weights are cached
+QUANTIZE = os.environ.get('NEWSREC_QUANTIZE') == '1'
+QUANTIZED_DIR = os.environ.get('NEWSREC_QUANTIZED_DIR', 'models/quantized')
+
+
+def model_size(model):
+        """
+        Estimate the memory held by a torch model
+
+        Parameters:
+        - model (torch.nn.Module): the loaded model
+
+        Returns:
+        int: the size of the weights and buffers in bytes, including int8 packed weights
+        """
+        size = 0
+        seen = set()
+        for value in model.state_dict().values():
+            # Quantized linear layers store their weight and bias as a tuple
+            for tensor in (value if isinstance(value, tuple) else (value,)):
+                if torch.is_tensor(tensor) and tensor.data_ptr() not in seen:
+                    seen.add(tensor.data_ptr())
+                    size += tensor.numel() * tensor.element_size()
+        return size
+
+
+def quantize_model(model):
+        """
+        Apply int8 dynamic quantization to the linear layers of a model for CPU inference
+
+        Parameters:
+        - model (torch.nn.Module): the fp32 model
+
+        Returns:
+        torch.nn.Module: the quantized model
+        """
+        return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def quantized_path(name):
+        """
+        Return the path of the cached int8 weights of a model
+        """
+        return os.path.join(QUANTIZED_DIR, name.replace('/', '--') + '.int8.pt')
+
+
+def _load_quantized(name, build, load_fp32):
+        # Rebuild the quantized model from its cached weights, or quantize the fp32 model and cache it.
+        # build returns the model architecture without pretrained weights.
+        path = quantized_path(name)
+        if os.path.exists(path):
+            model = quantize_model(build())
+            model.load_state_dict(torch.load(path))
+        else:
+            model = quantize_model(load_fp32())
+            os.makedirs(QUANTIZED_DIR, exist_ok=True)
+            torch.save(model.state_dict(), path + '.tmp')
+            os.replace(path + '.tmp', path)
+            print(f"Saved quantized weights of {name} to {path}")
+        model.eval()
+        return model
+
+
+class ModelRegistry:
+    """
+    Process-wide store of loaded models
+
+    Every model is loaded at most once per process and shared by all threads. When max_bytes is set,
+    the least recently used models are evicted once the loaded models exceed it.
+    """
+
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes
+        self._models = OrderedDict()
+        self._lock = threading.Lock()
+        self._load_locks = {}
+
+    def get(self, key, loader):
+        """
+        Return the model stored under key, loading it with loader on first use
+
+        Parameters:
+        - key (hashable): the registry key of the model
+        - loader (callable): a function returning a tuple of the model entry and its size in bytes
+
+        Returns:
+        object: the model entry returned by loader
+        """
+        with self._lock:
+            if key in self._models:
+                self._models.move_to_end(key)
+                return self._models[key][0]
+            load_lock = self._load_locks.setdefault(key, threading.Lock())
+
+        # Only one thread loads a given model, the others wait for it
+        with load_lock:
+            with self._lock:
+                if key in self._models:
+                    self._models.move_to_end(key)
+                    return self._models[key][0]
+
+            entry, size = loader()
+
+            with self._lock:
+                self._models[key] = (entry, size)
+                self._load_locks.pop(key, None)
+                self._evict(keep=key)
+
+        return entry
+
+    def _evict(self, keep):
+        # Drop least recently used models until the memory cap is respected. Threads still
+        # holding a reference to an evicted model can finish with it, it is freed afterwards.
+        if self.max_bytes is None:
+            return
+        for key in list(self._models):
+            if self.memory_usage() <= self.max_bytes:
+                break
+            if key != keep:
+                del self._models[key]
+                print(f"Evicted model {key} from registry")
+
+    def memory_usage(self):
+        """
+        Return the estimated memory held by the loaded models in bytes
+        """
+        return sum(size for _, size in self._models.values())
+
+    def loaded(self):
+        """
+        Return the keys of the loaded models, least recently used first
+        """
+        with self._lock:
+            return list(self._models)
+
+    def clear(self):
+        """
+        Drop every loaded model
+        """
+        with self._lock:
+            self._models.clear()
+
+
+def _memory_limit():
+        # Memory cap of the registry in MB, unlimited when not set
+        limit = os.environ.get('NEWSREC_MODEL_MEMORY_MB')
+        return int(limit) * 1024 * 1024 if limit else None
+
+
+registry = ModelRegistry(max_bytes=_memory_limit())
+
+
+def _load_summarizer(model_name, quantized):
+        checkpoint, tokenizer_class, model_class = SUMMARIZERS[model_name]
+        tokenizer = tokenizer_class.from_pretrained(checkpoint)
+        if quantized:
+            model = _load_quantized(checkpoint, lambda: model_class(AutoConfig.from_pretrained(checkpoint)),
+                                    lambda: model_class.from_pretrained(checkpoint))
+        else:
+            model = model_class.from_pretrained(checkpoint)
+            model.eval()
+        return (tokenizer, model), model_size(model)
+
+
+class _TransformerSkeleton(models.Transformer):
+    """
+    Transformer module of the encoder built from its config, without loading the pretrained weights
+    """
+
+    def _load_model(self, model_name_or_path, config, cache_dir, **model_args):
+        self.auto_model = AutoModel.from_config(config)
+
+
+def _build_encoder():
+        # Same modules as the pretrained encoder (transformer, mean pooling, normalization), with random weights
+        transformer = _TransformerSkeleton(ENCODER_CHECKPOINT, max_seq_length=ENCODER_MAX_SEQ_LENGTH)
+        pooling = models.Pooling(transformer.get_word_embedding_dimension(), pooling_mode='mean')
+        return SentenceTransformer(modules=[transformer, pooling, models.Normalize()])
+
+
+def _load_encoder(quantized):
+        if quantized:
+            model = _load_quantized(ENCODER_NAME, _build_encoder, lambda: SentenceTransformer(ENCODER_NAME))
+        else:
+            model = SentenceTransformer(ENCODER_NAME)
+            model.eval()
+        return model, model_size(model)
+
+
+def get_summarizer(model_name='bart', quantized=None):
+        """
+        Return the shared fast tokenizer and model of a summarization model
+
+        Parameters:
+        - model_name (str): the name of the summarization model ('bart' or 't5')
+        - quantized (bool): whether to use the int8 model, by default set by NEWSREC_QUANTIZE
+
+        Returns:
+        tuple: the tokenizer and the model
+        """
+        model_name = model_name.lower()
+        if model_name not in SUMMARIZERS:
+            raise ValueError("Model name should be 'bart' or 't5'")
+        if quantized is None:
+            quantized = QUANTIZE
+
+        precision = 'int8' if quantized else 'fp32'
+        return registry.get(('summarizer', model_name, precision), lambda: _load_summarizer(model_name, quantized))
+
+
+def get_encoder(quantized=None):
+        """
+        Return the shared SentenceTransformer used to encode summaries
+
+        Parameters:
+        - quantized (bool): whether to use the int8 model, by default set by NEWSREC_QUANTIZE
+
+        Returns:
+        SentenceTransformer: the sentence embedding model
+        """
+        if quantized is None:
+            quantized = QUANTIZE
+
+        precision = 'int8' if quantized else 'fp32'
+        return registry.get(('encoder', ENCODER_NAME, precision), lambda: _load_encoder(quantized))
+
+
+def warm_up(model_names=('bart',)):
+        """
+        Eagerly load the summarization models and the encoder, e.g. at app startup
+
+        Parameters:
+        - model_names (iterable): the summarization models to load
+
+        Returns:
+        None
+        """
+        for model_name in model_names:
+            get_summarizer(model_name)
+        get_encoder()
+        print(f"Models loaded: {registry.loaded()}")
@@ -0,0 +1,206 @@
+import os
+import time
+import argparse
+import threading
+import numpy as np
+import faiss
+from tqdm import tqdm
+
+from utils.indexer import make_index, load_ids
+
+# Precomputed top-k related articles of every article in the corpus
+NEIGHBORS_PATH = 'dataset/neighbors.npy'
+
+
+def _table_dtype(k):
+        # One record per article: its id, the ids of its k nearest articles and their float16 L2 distances
+        return np.dtype([('id', np.int64), ('neighbors', np.int32, (k,)), ('distances', np.float16, (k,))])
+
+
+def _search_blocks(index, embeddings, rows, k, block_size, desc):
+        # Search the index with the given rows of the embeddings in blocks, faiss spreads every block over the cores
+        D = np.empty((len(rows), k), dtype=np.float32)
+        I = np.empty((len(rows), k), dtype=np.int64)
+        for start in tqdm(range(0, len(rows), block_size), desc=desc):
+            block = np.ascontiguousarray(embeddings[rows[start:start + block_size]], dtype=np.float32)
+            D[start:start + block_size], I[start:start + block_size] = index.search(block, k)
+        return D, I
+
+
+def _drop_self(D, I, ids):
+        # Remove every article from its own neighbours, or the farthest neighbour if it was not found
+        keep = I != ids[:, None]
+        keep[keep.all(axis=1), -1] = False
+        k = I.shape[1] - 1
+        return D[keep].reshape(-1, k), I[keep].reshape(-1, k)
+
+
+def build_neighbor_table(embeddings_path='dataset/embeddings.npy', output_path=NEIGHBORS_PATH, k=10, block_size=4096,
+                         num_threads=None):
+        """
+        Compute the k nearest articles of every article with an exact search and save them as a table
+
+        Parameters:
+        - embeddings_path (str): the path of the embeddings numpy file, its ids are read with indexer.load_ids
+        - output_path (str): the path of the table
+        - k (int): the number of related articles per article
+        - block_size (int): the number of articles searched at once
+        - num_threads (int): the number of threads of the search, all cores if None
+
+        Returns:
+        int: the number of articles in the table
+        """
+        if num_threads:
+            faiss.omp_set_num_threads(num_threads)
+
+        embeddings = np.load(embeddings_path, mmap_mode='r')
+        ids = load_ids(embeddings_path, len(embeddings))
+        index = make_index(embeddings, 'flat', ids=ids)
+
+        D, I = _search_blocks(index, embeddings, np.arange(len(ids)), k + 1, block_size, 'Searching Neighbors')
+        D, I = _drop_self(D, I, ids)
+
+        table = np.empty(len(ids), dtype=_table_dtype(k))
+        table['id'], table['neighbors'], table['distances'] = ids, I, D
+        _save_table(table, output_path)
+        return len(table)
+
+
+def refresh_neighbor_table(embeddings_path='dataset/embeddings.npy', table_path=NEIGHBORS_PATH, block_size=4096,
+                           num_threads=None):
+        """
+        Add the articles of the embeddings file that are not in the table yet, without recomputing the others
+
+        The new articles are searched against the whole corpus, and the articles already in the table are searched
+        against the new articles only, to merge those that are closer than their current neighbours.
+
+        Parameters:
+        - embeddings_path (str): the path of the embeddings numpy file, its ids are read with indexer.load_ids
+        - table_path (str): the path of the table built by build_neighbor_table
+        - block_size (int): the number of articles searched at once
+        - num_threads (int): the number of threads of the search, all cores if None
+
+        Returns:
+        int: the number of articles added to the table
+        """
+        if num_threads:
+            faiss.omp_set_num_threads(num_threads)
+
+        table = np.load(table_path)
+        k = table.dtype['neighbors'].shape[0]
+
+        embeddings = np.load(embeddings_path, mmap_mode='r')
+        ids = load_ids(embeddings_path, len(embeddings))
+        new_rows = np.flatnonzero(~np.isin(ids, table['id']))
+        if len(new_rows) == 0:
+            print('No new articles to add to the neighbor table')
+            return 0
+
+        # Neighbours of the new articles among all the articles
+        index = make_index(embeddings, 'flat', ids=ids)
+        D, I = _search_blocks(index, embeddings, new_rows, k + 1, block_size, 'Searching New Neighbors')
+        D, I = _drop_self(D, I, ids[new_rows])
+        added = np.empty(len(new_rows), dtype=table.dtype)
+        added['id'], added['neighbors'], added['distances'] = ids[new_rows], I, D
+
+        # New articles closer to the existing ones than their current neighbours
+        known = np.isin(table['id'], ids)
+        order = np.argsort(ids)
+        rows = order[np.searchsorted(ids[order], table['id'][known])]
+        new_index = make_index(embeddings[new_rows], 'flat', ids=ids[new_rows])
+        D, I = _search_blocks(new_index, embeddings, rows, min(k, len(new_rows)), block_size, 'Merging Neighbors')
+
+        distances = np.concatenate([table['distances'][known].astype(np.float32), D], axis=1)
+        neighbors = np.concatenate([table['neighbors'][known], I], axis=1)
+        best = np.argsort(distances, axis=1, kind='stable')[:, :k]
+        table['distances'][known] = np.take_along_axis(distances, best, axis=1)
+        table['neighbors'][known] = np.take_along_axis(neighbors, best, axis=1)
+
+        _save_table(np.concatenate([table, added]), table_path)
+        return len(added)
+
+
+def _save_table(table, output_path):
+        # Replace the table atomically, processes that mapped the old file keep reading it until they reload
+        os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+        np.save(output_path + '.tmp.npy', table)
+        os.replace(output_path + '.tmp.npy', output_path)
+        print(f'Saved the neighbors of {len(table)} articles to {output_path}')
+
+
+class NeighborTable:
+    """
+    Memory-mapped table of the precomputed related articles, reloaded when the file is replaced
+
+    The file modification time is checked at most every check_interval seconds.
+    """
+
+    def __init__(self, path=NEIGHBORS_PATH, check_interval=5.0):
+        self.path = path
+        self.check_interval = check_interval
+        # The table and the row of every article id, replaced together
+        self._state = None
+        self._mtime = None
+        self._checked = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def available(self):
+        return os.path.exists(self.path)
+
+    def _load(self):
+        if self._state is None or time.monotonic() - self._checked > self.check_interval:
+            with self._lock:
+                if self._state is None or time.monotonic() - self._checked > self.check_interval:
+                    self._checked = time.monotonic()
+                    try:
+                        mtime = os.path.getmtime(self.path)
+                    except FileNotFoundError:
+                        # Not built yet, serve an empty table until it is
+                        self._state, self._mtime = (None, np.empty(0, dtype=np.int64)), None
+                        return self._state
+                    if mtime != self._mtime:
+                        table = np.load(self.path, mmap_mode='r')
+                        ids = np.asarray(table['id'])
+                        rows = np.full(int(ids.max()) + 1 if len(ids) else 0, -1, dtype=np.int64)
+                        rows[ids] = np.arange(len(ids))
+                        self._state, self._mtime = (table, rows), mtime
+        return self._state
+
+    def related(self, article_id, k=None):
+        """
+        Return the precomputed nearest articles of an article
+
+        Parameters:
+        - article_id (int): the article id
+        - k (int): the number of related articles, all the stored ones if None
+
+        Returns:
+        tuple: the ids and the distances of the related articles, or None if the article is not in the table
+        or the table was not built
+        """
+        table, rows = self._load()
+        if not 0 <= article_id < len(rows) or rows[article_id] < 0:
+            return None
+
+        record = table[rows[article_id]]
+        return record['neighbors'][:k].tolist(), record['distances'][:k].astype(float).tolist()
+
+
+neighbor_table = NeighborTable()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Precompute the related articles of every article')
+    parser.add_argument('--embeddings', default='dataset/embeddings.npy')
+    parser.add_argument('--output', default=NEIGHBORS_PATH)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--block-size', type=int, default=4096)
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--refresh', action='store_true', help='only add the articles missing from the table')
+    args = parser.parse_args()
+
+    if args.refresh:
+        refresh_neighbor_table(args.embeddings, args.output, args.block_size, args.threads)
+    else:
+        build_neighbor_table(args.embeddings, args.output, args.k, args.block_size, args.threads)
@@ -0,0 +1,97 @@
+import re
+from functools import lru_cache, partial
+from multiprocessing import Pool
+
+import pandas as pd
+from nltk.corpus import stopwords
+from nltk.stem import WordNetLemmatizer
+
+# Normalisation profiles of the two pipelines:
+# - 'vectorizer' deletes everything but letters and lemmatizes the words (utils/vectorizer.py)
+# - 'clean' turns punctuation into spaces and keeps digits (utils/clean.py)
+PROFILES = {
+    'vectorizer': (re.compile(r'[^a-zA-Z\s]'), '', True),
+    'clean': (re.compile(r'[^\w\s]'), ' ', False),
+}
+
+
+@lru_cache(maxsize=None)
+def stop_words():
+        """
+        Return the English stopwords, loaded once per process
+
+        Parameters:
+        None
+
+        Returns:
+        frozenset: the stopwords
+        """
+        return frozenset(stopwords.words('english'))
+
+
+@lru_cache(maxsize=None)
+def _lemmatizer():
+        return WordNetLemmatizer()
+
+
+@lru_cache(maxsize=2**18)
+def lemmatize(word):
+        """
+        Return the lemma of a word, memoised across calls
+
+        Parameters:
+        - word (str): the word to lemmatize
+
+        Returns:
+        str: the lemma
+        """
+        return _lemmatizer().lemmatize(word)
+
+
+def normalize_text(text, profile='vectorizer'):
+        """
+        Normalise a text: lowercase it, strip unwanted characters, remove stopwords and optionally lemmatize
+
+        Parameters:
+        - text (str): the input text
+        - profile (str): 'vectorizer' or 'clean', see PROFILES
+
+        Returns:
+        str: the normalised text
+        """
+        pattern, replacement, lemmatized = PROFILES[profile]
+        stop = stop_words()
+
+        # Splitting on whitespace also collapses repeated spaces
+        words = pattern.sub(replacement, text.lower()).split()
+        if lemmatized:
+            return ' '.join([lemmatize(word) for word in words if word not in stop])
+        return ' '.join([word for word in words if word not in stop])
+
+
+def normalize_batch(texts, profile='vectorizer', n_jobs=1, chunksize=256):
+        """
+        Normalise a batch of texts, optionally with a pool of processes
+
+        Parameters:
+        - texts (list or pandas.Series): the input texts
+        - profile (str): 'vectorizer' or 'clean', see PROFILES
+        - n_jobs (int): the number of processes, normalise in this process if 1
+        - chunksize (int): the number of texts sent to a process at once
+
+        Returns:
+        list or pandas.Series: the normalised texts, a Series with the same index if texts is a Series
+        """
+        if isinstance(texts, str):
+            raise TypeError("Input cannot be str")
+
+        function = partial(normalize_text, profile=profile)
+        if n_jobs > 1:
+            with Pool(n_jobs) as pool:
+                normalized = pool.map(function, texts, chunksize=chunksize)
+        else:
+            normalized = [function(text) for text in texts]
+
+        if isinstance(texts, pd.Series):
+            return pd.Series(normalized, index=texts.index, name=texts.name)
+        return normalized
@@ -0,0 +1,430 @@
+import io
+import os
+import json
+import time
+import argparse
+import hashlib
+import threading
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+from utils.util import MANIFEST_FILE, PARTITION_COLUMNS, locate_partitions, fixed_size_partitions, _in_order
+
+# Endpoint of an S3 compatible stand-in (e.g. MinIO or moto_server), AWS if unset
+S3_ENDPOINT_URL = os.environ.get('NEWSREC_S3_ENDPOINT_URL') or None
+
+# Checksums of the objects uploaded by sync_to_s3, stored in the bucket
+SYNC_MANIFEST_KEY = 'sync-manifest.json'
+
+# Local copies of the S3 partitions, least recently used partitions are evicted above the size
+S3_CACHE_DIR = os.environ.get('NEWSREC_S3_CACHE_DIR', 'dataset/s3_cache')
+S3_CACHE_MAX_MB = int(os.environ.get('NEWSREC_S3_CACHE_MB', 2048))
+
+
+@lru_cache(maxsize=None)
+def get_client(aws_access_key_id=None, aws_secret_access_key=None, endpoint_url=S3_ENDPOINT_URL,
+               max_pool_connections=32):
+        """
+        Return the S3 client of a set of credentials, created once and shared by all threads
+
+        Parameters:
+        - aws_access_key_id (str): AWS access key ID, the default credential chain if None
+        - aws_secret_access_key (str): AWS secret access key corresponding to the provided access key
+        - endpoint_url (str): the endpoint of an S3 compatible stand-in, AWS if None
+        - max_pool_connections (int): the size of the HTTP connection pool
+
+        Returns:
+        botocore.client.S3: the client
+        """
+        return boto3.client('s3', aws_access_key_id=aws_access_key_id, aws_secret_access_key=aws_secret_access_key,
+                            endpoint_url=endpoint_url,
+                            config=Config(max_pool_connections=max_pool_connections,
+                                          retries={'max_attempts': 5, 'mode': 'adaptive'}))
+
+
+class PartitionCache:
+    """
+    Local disk cache of S3 objects, validated against their ETag on every use
+
+    A cached object is only downloaded again if its ETag changed (a conditional GET answered with 304
+    otherwise). Files are evicted least recently used first once they exceed max_bytes.
+    """
+
+    def __init__(self, cache_dir=S3_CACHE_DIR, max_bytes=S3_CACHE_MAX_MB * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def _path(self, bucket, key):
+        return os.path.join(self.cache_dir, bucket, key)
+
+    def open(self, client, bucket, key):
+        """
+        Open an up to date local copy of an S3 object
+
+        The copy is opened before any eviction can remove it, so it stays readable until it is closed.
+
+        Parameters:
+        - client (botocore.client.S3): the S3 client
+        - bucket (str): the name of the bucket
+        - key (str): the key of the object
+
+        Returns:
+        file: the local copy opened in binary mode
+        """
+        path = self._path(bucket, key)
+        etag = None
+        if os.path.exists(path) and os.path.exists(path + '.etag'):
+            with open(path + '.etag') as f:
+                etag = json.load(f)['etag']
+
+        try:
+            response = client.get_object(Bucket=bucket, Key=key, **({'IfNoneMatch': etag} if etag else {}))
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('304', 'NotModified'):
+                raise
+            with self._lock:
+                if os.path.exists(path):
+                    # Unchanged, mark the copy as recently used
+                    os.utime(path)
+                    self.hits += 1
+                    return open(path, 'rb')
+            # Evicted since the request, download it again
+            return self.open(client, bucket, key)
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            for chunk in response['Body'].iter_chunks(1024 * 1024):
+                f.write(chunk)
+        with self._lock:
+            os.replace(tmp_path, path)
+            with open(path + '.etag', 'w') as f:
+                json.dump({'etag': response['ETag']}, f)
+            file = open(path, 'rb')
+            self.misses += 1
+            self._evict()
+        return file
+
+    def _evict(self):
+        files = []
+        for root, _, names in os.walk(self.cache_dir):
+            for name in names:
+                if not name.endswith(('.etag', '.tmp')):
+                    path = os.path.join(root, name)
+                    files.append((os.path.getmtime(path), os.path.getsize(path), path))
+
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            # Open copies stay readable after their removal
+            os.remove(path)
+            if os.path.exists(path + '.etag'):
+                os.remove(path + '.etag')
+            total -= size
+
+    def stats(self):
+        """
+        Report the hit/miss counters of this process
+
+        Parameters:
+        None
+
+        Returns:
+        dict: hits, misses and hit ratio
+        """
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_ratio': self.hits / lookups if lookups else 0.0}
+
+
+partition_cache = PartitionCache()
+
+
+class S3RangeFile(io.RawIOBase):
+    """
+    Seekable read-only file over an S3 object that fetches the bytes it reads with ranged GETs
+
+    Parquet readers only read the footer and the column chunks they need through it.
+    """
+
+    def __init__(self, client, bucket, key, size=None):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.size = size if size is not None else client.head_object(Bucket=bucket, Key=key)['ContentLength']
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.position = offset
+        elif whence == io.SEEK_CUR:
+            self.position += offset
+        else:
+            self.position = self.size + offset
+        return self.position
+
+    def read(self, size=-1):
+        end = self.size if size is None or size < 0 else min(self.size, self.position + size)
+        if self.position >= end:
+            return b''
+        response = self.client.get_object(Bucket=self.bucket, Key=self.key, Range=f'bytes={self.position}-{end - 1}')
+        data = response['Body'].read()
+        self.position += len(data)
+        return data
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+
+def read_parquet_rows(client, bucket, key, target_indices, columns=('headline', 'link')):
+        """
+        Read rows of a Parquet partition on S3 with byte-range requests
+
+        Only the footer and the requested column chunks of the row groups whose 'Index' statistics
+        may contain the target indices are downloaded.
+
+        Parameters:
+        - client (botocore.client.S3): the S3 client
+        - bucket (str): the name of the bucket
+        - key (str): the key of the Parquet file
+        - target_indices (list): the article ids to read
+        - columns (tuple): the columns to read
+
+        Returns:
+        pandas.DataFrame: the 'Index' and requested columns of the rows found
+        """
+        targets = np.asarray(target_indices, dtype=np.int64)
+        parquet = pq.ParquetFile(S3RangeFile(client, bucket, key))
+        schema_names = parquet.schema_arrow.names
+        index_column = schema_names.index('Index')
+
+        tables = []
+        for group in range(parquet.metadata.num_row_groups):
+            stats = parquet.metadata.row_group(group).column(index_column).statistics
+            if stats is not None and stats.has_min_max and not ((targets >= stats.min) & (targets <= stats.max)).any():
+                continue
+            table = parquet.read_row_group(group, columns=['Index'] + list(columns))
+            mask = np.isin(table.column('Index').to_numpy(), targets)
+            if mask.any():
+                tables.append(table.filter(pa.array(mask)))
+
+        if not tables:
+            return pd.DataFrame(columns=['Index'] + list(columns))
+        return pa.concat_tables(tables).to_pandas()
+
+
+class S3PartitionReader:
+    """
+    Reader of the rows of the dataset partitions stored on S3
+
+    The partitions holding the requested rows are fetched concurrently through the shared client,
+    CSV partitions are read from the local PartitionCache and Parquet partitions with byte-range requests.
+    """
+
+    def __init__(self, bucket_name, base_file_path, aws_access_key_id=None, aws_secret_access_key=None,
+                 endpoint_url=S3_ENDPOINT_URL, cache=partition_cache, max_workers=8, file_format='csv',
+                 manifest_key=MANIFEST_FILE):
+        self.bucket_name = bucket_name
+        self.base_file_path = base_file_path
+        self.client = get_client(aws_access_key_id, aws_secret_access_key, endpoint_url)
+        self.cache = cache
+        self.file_format = file_format
+        self.manifest_key = manifest_key
+        self._pool = ThreadPoolExecutor(max_workers=max_workers)
+
+    def partition_key(self, file_name):
+        return os.path.splitext(file_name)[0] + '.' + self.file_format
+
+    def manifest(self):
+        """
+        Return the partition manifest stored in the bucket, revalidated against its ETag
+        """
+        with self.cache.open(self.client, self.bucket_name, self.manifest_key) as f:
+            return json.load(f)
+
+    def _read_partition(self, file_name, indices, columns):
+        key = self.partition_key(file_name)
+        if self.file_format == 'parquet':
+            return read_parquet_rows(self.client, self.bucket_name, key, indices, columns or ('headline', 'link'))
+
+        with self.cache.open(self.client, self.bucket_name, key) as f:
+            df = pd.read_csv(f, usecols=None if columns is None else ['Index'] + list(columns))
+        return df[df['Index'].isin(indices)]
+
+    def read_rows(self, target_indices, partition_size=None, columns=None):
+        """
+        Read specific rows from the partitions and combine them into a DataFrame
+
+        Parameters:
+        - target_indices (list): the row indices to retrieve
+        - partition_size (int): the size of each partition, the partitions are located with the manifest if None
+        - columns (list): the columns to read, all of them if None (headline and link for Parquet partitions)
+
+        Returns:
+        pandas.DataFrame: the rows found, in the order of the target indices
+        """
+        if partition_size is None:
+            partitions = locate_partitions(self.manifest(), target_indices)
+        else:
+            # Fixed-size partitions written without a manifest
+            partitions = fixed_size_partitions(target_indices, partition_size, self.base_file_path)
+
+        frames = list(self._pool.map(lambda item: self._read_partition(item[0], item[1], columns),
+                                     partitions.items()))
+        if not frames:
+            # No target indices, or none in the manifest
+            if columns is None:
+                columns = ('headline', 'link') if self.file_format == 'parquet' else PARTITION_COLUMNS
+            return pd.DataFrame(columns=['Index'] + list(columns))
+        return _in_order(pd.concat(frames, axis=0), target_indices)
+
+
+@lru_cache(maxsize=None)
+def get_reader(bucket_name, base_file_path, aws_access_key_id=None, aws_secret_access_key=None, file_format='csv'):
+        """
+        Return the partition reader of a bucket and base path, created once so that its thread pool is reused
+
+        Parameters:
+        - bucket_name (str): the name of the S3 bucket
+        - base_file_path (str): the base path of the partitions without the partition suffix
+        - aws_access_key_id (str): AWS access key ID, the default credential chain if None
+        - aws_secret_access_key (str): AWS secret access key corresponding to the provided access key
+        - file_format (str): 'csv' or 'parquet'
+
+        Returns:
+        S3PartitionReader: the reader
+        """
+        return S3PartitionReader(bucket_name, base_file_path, aws_access_key_id, aws_secret_access_key,
+                                 file_format=file_format)
+
+
+def file_sha256(path, block_size=8 * 1024 * 1024):
+        """
+        Compute the sha256 of a file block by block
+
+        Parameters:
+        - path (str): the path of the file
+        - block_size (int): the number of bytes read at once
+
+        Returns:
+        str: the hex digest
+        """
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(block_size), b''):
+                digest.update(block)
+        return digest.hexdigest()
+
+
+def _sync_files(sources):
+        # Map every local file of the sources to its key, e.g. ('dataset/index', 'index/') to 'index/VERSION'
+        files = {}
+        for local_path, prefix in sources:
+            if os.path.isdir(local_path):
+                for root, _, names in os.walk(local_path):
+                    for name in sorted(names):
+                        if not name.endswith('.tmp'):
+                            path = os.path.join(root, name)
+                            files[prefix + os.path.relpath(path, local_path).replace(os.sep, '/')] = path
+            elif os.path.isfile(local_path):
+                files[prefix + os.path.basename(local_path)] = local_path
+        return files
+
+
+def sync_to_s3(bucket_name, sources, aws_access_key_id=None, aws_secret_access_key=None, endpoint_url=S3_ENDPOINT_URL,
+               max_workers=8, multipart_threshold_mb=64, manifest_key=SYNC_MANIFEST_KEY):
+        """
+        Upload the files that changed since the last sync to an S3 bucket
+
+        The sha256 of every local file is compared with the manifest of the last sync stored in the bucket, and
+        only new or changed files are uploaded, by a bounded pool of threads. Files above the multipart threshold
+        are uploaded in parts in parallel. The manifest is updated once every upload succeeded.
+
+        Parameters:
+        - bucket_name (str): the name of the S3 bucket
+        - sources (list): (local file or folder, key prefix) tuples
+        - aws_access_key_id (str): AWS access key ID, the default credential chain if None
+        - aws_secret_access_key (str): AWS secret access key corresponding to the provided access key
+        - endpoint_url (str): the endpoint of an S3 compatible stand-in, AWS if None
+        - max_workers (int): the number of files uploaded at once
+        - multipart_threshold_mb (int): the size above which files are uploaded in parts of that size
+        - manifest_key (str): the key of the sync manifest
+
+        Returns:
+        dict: the number of uploaded and skipped files, the uploaded bytes, the duration and the throughput
+        """
+        start = time.perf_counter()
+        client = get_client(aws_access_key_id, aws_secret_access_key, endpoint_url, max_pool_connections=4 * max_workers)
+        files = _sync_files(sources)
+
+        try:
+            remote = json.loads(client.get_object(Bucket=bucket_name, Key=manifest_key)['Body'].read())
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+                raise
+            remote = {}
+
+        transfer = TransferConfig(multipart_threshold=multipart_threshold_mb * 1024 * 1024,
+                                  multipart_chunksize=multipart_threshold_mb * 1024 * 1024, max_concurrency=4)
+
+        def upload(item):
+            key, path = item
+            checksum, size = file_sha256(path), os.path.getsize(path)
+            if remote.get(key, {}).get('sha256') == checksum:
+                return key, None
+            client.upload_file(path, bucket_name, key, Config=transfer, ExtraArgs={'Metadata': {'sha256': checksum}})
+            print(f"Uploaded {key} to S3 bucket {bucket_name}")
+            return key, {'sha256': checksum, 'size': size}
+
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            uploaded = {key: entry for key, entry in pool.map(upload, files.items()) if entry is not None}
+
+        if uploaded:
+            remote.update(uploaded)
+            client.put_object(Bucket=bucket_name, Key=manifest_key, Body=json.dumps(remote, indent=1).encode('utf-8'))
+
+        seconds = time.perf_counter() - start
+        uploaded_bytes = sum(entry['size'] for entry in uploaded.values())
+        report = {'uploaded': len(uploaded), 'skipped': len(files) - len(uploaded), 'bytes': uploaded_bytes,
+                  'seconds': seconds, 'mb_per_s': uploaded_bytes / 2**20 / seconds if seconds else 0.0}
+        print(report)
+        return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Upload the dataset partitions, embeddings and index to S3')
+    parser.add_argument('bucket')
+    parser.add_argument('--partitions', default='dataset/partitioned_nyt', help='uploaded at the root of the bucket')
+    parser.add_argument('--embeddings', default='dataset/embeddings.npy', help='uploaded under embeddings/')
+    parser.add_argument('--index-dir', default='dataset/index', help='uploaded under index/')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--multipart-mb', type=int, default=64)
+    args = parser.parse_args()
+
+    embeddings_ids = os.path.splitext(args.embeddings)[0] + '.ids.npy'
+    sync_to_s3(args.bucket, [(args.partitions, ''), (args.embeddings, 'embeddings/'), (embeddings_ids, 'embeddings/'),
+                             (args.index_dir, 'index/')],
+               max_workers=args.workers, multipart_threshold_mb=args.multipart_mb)
@@ -0,0 +1,124 @@
+import os
+import glob
+import time
+import argparse
+import threading
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+# Columnar copy of the partitioned dataset, without the article texts
+ARTICLES_PATH = 'dataset/articles.arrow'
+
+
+def rows_path(store_path):
+        """
+        Return the path of the id -> row index written next to an article store, e.g. 'articles.rows.npy'
+        """
+        return os.path.splitext(store_path)[0] + '.rows.npy'
+
+
+def build_article_store(csv_paths, output_path=ARTICLES_PATH, columns=None, chunksize=50000):
+        """
+        Convert partitioned CSV files into an Arrow IPC file that can be memory-mapped, and index its rows by id
+
+        Parameters:
+        - csv_paths (list): the CSV files with an 'Index' column, in any order
+        - output_path (str): the path of the Arrow file
+        - columns (list): the columns stored next to 'Index', every column but 'text' if None
+        - chunksize (int): the number of CSV rows converted at once
+
+        Returns:
+        int: the number of stored articles
+        """
+        if columns is None:
+            header = pd.read_csv(csv_paths[0], nrows=0).columns
+            columns = [column for column in header if column not in ('Index', 'text')]
+        schema = pa.schema([('Index', pa.int64())] + [(column, pa.string()) for column in columns])
+
+        os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+        ids = []
+        with pa.OSFile(output_path + '.tmp', 'wb') as sink, pa.ipc.new_file(sink, schema) as writer:
+            for path in csv_paths:
+                for chunk in pd.read_csv(path, usecols=['Index'] + columns, chunksize=chunksize):
+                    # Missing values stay nulls instead of floats in the string columns
+                    chunk = chunk[['Index'] + columns].astype({column: 'string' for column in columns})
+                    writer.write_batch(pa.RecordBatch.from_pandas(chunk, schema=schema, preserve_index=False))
+                    ids.append(chunk['Index'].to_numpy(dtype=np.int64))
+
+        ids = np.concatenate(ids) if ids else np.empty(0, dtype=np.int64)
+        rows = np.full(int(ids.max()) + 1 if len(ids) else 0, -1, dtype=np.int64)
+        rows[ids] = np.arange(len(ids))
+
+        # Write the row index first, readers reload when the store file changes
+        np.save(rows_path(output_path) + '.tmp.npy', rows)
+        os.replace(rows_path(output_path) + '.tmp.npy', rows_path(output_path))
+        os.replace(output_path + '.tmp', output_path)
+        print(f'Stored {len(ids)} articles in {output_path}')
+        return len(ids)
+
+
+class ArticleStore:
+    """
+    Memory-mapped Arrow article store with an id -> row index
+
+    The columns are read from the page cache without parsing, and the file is reopened when it is replaced,
+    checked at most every check_interval seconds.
+    """
+
+    def __init__(self, path=ARTICLES_PATH, check_interval=5.0):
+        self.path = path
+        self.check_interval = check_interval
+        # The table and the row of every id, replaced together
+        self._state = None
+        self._mtime = None
+        self._checked = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def available(self):
+        return os.path.exists(self.path)
+
+    def _load(self):
+        if self._state is None or time.monotonic() - self._checked > self.check_interval:
+            with self._lock:
+                if self._state is None or time.monotonic() - self._checked > self.check_interval:
+                    self._checked = time.monotonic()
+                    mtime = os.path.getmtime(self.path)
+                    if mtime != self._mtime:
+                        table = pa.ipc.open_file(pa.memory_map(self.path)).read_all()
+                        self._state, self._mtime = (table, np.load(rows_path(self.path), mmap_mode='r')), mtime
+        return self._state
+
+    def get(self, ids, columns=('headline', 'link')):
+        """
+        Read the given columns of a batch of articles
+
+        Parameters:
+        - ids (list): the article ids, unknown ids are skipped
+        - columns (tuple): the columns to read
+
+        Returns:
+        pandas.DataFrame: the 'Index' and requested columns of the articles, in the order of the ids
+        """
+        table, rows = self._load()
+        ids = np.asarray(ids, dtype=np.int64)
+        ids = ids[(ids >= 0) & (ids < len(rows))]
+        found = np.asarray(rows[ids])
+        found = found[found >= 0]
+
+        # Only the requested rows of the requested columns are gathered
+        return table.select(['Index'] + list(columns)).take(pa.array(found)).to_pandas()
+
+
+article_store = ArticleStore()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the memory-mapped article store from the partitioned CSVs')
+    parser.add_argument('csv_files', nargs='*', help='CSV files with an Index column, the NYT partitions if omitted')
+    parser.add_argument('--output', default=ARTICLES_PATH)
+    parser.add_argument('--columns', nargs='+', default=None, help="stored columns, every column but 'text' if omitted")
+    args = parser.parse_args()
+
+    build_article_store(args.csv_files or sorted(glob.glob('dataset/partitioned_nyt/*.csv')), args.output, args.columns)
@@ -0,0 +1,152 @@
+import os
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from utils.models import ENCODER_DIM
+
+
+def iter_csv_texts(file_path, id_column='Index', text_column='text', chunksize=10000):
+        """
+        Read (id, text) tuples from a CSV file chunk by chunk
+
+        Parameters:
+        - file_path (str): the path of the CSV file
+        - id_column (str): the column holding the article ids
+        - text_column (str): the column holding the article texts
+        - chunksize (int): the number of rows read at once
+
+        Yields:
+        tuple: the id and the text of every row with a text
+        """
+        for chunk in pd.read_csv(file_path, usecols=[id_column, text_column], chunksize=chunksize):
+            chunk = chunk.dropna(subset=[text_column])
+            yield from zip(chunk[id_column].tolist(), chunk[text_column].tolist())
+
+
+def write_npy_memmap(records, output_path, rows, dim=ENCODER_DIM, flush_every=1024):
+        """
+        Write streamed embeddings into a memory-mapped .npy file, in arrival order
+
+        The ids are saved next to it, e.g. 'embeddings.ids.npy' for 'embeddings.npy'.
+
+        Parameters:
+        - records (iterable): (id, summary, embedding) tuples
+        - output_path (str): the path of the .npy file
+        - rows (int): the maximum number of records, used to allocate the file. The file is truncated to the
+          records written, e.g. when iter_csv_texts skipped rows without a text
+        - dim (int): the dimension of the embeddings
+        - flush_every (int): the number of rows written between flushes
+
+        Returns:
+        int: the number of records written
+        """
+        os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+        output = np.lib.format.open_memmap(output_path, mode='w+', dtype=np.float32, shape=(rows, dim))
+
+        ids = []
+        for position, (article_id, _, embedding) in enumerate(records):
+            if position == rows:
+                del output
+                raise ValueError(f'More than {rows} records to write to {output_path}, allocate more rows')
+            output[position] = embedding
+            ids.append(article_id)
+            if (position + 1) % flush_every == 0:
+                output.flush()
+
+        output.flush()
+        if len(ids) < rows:
+            # Keep the embeddings the same length as the ids instead of leaving zero rows at the end
+            tmp_path = output_path + '.tmp.npy'
+            np.save(tmp_path, output[:len(ids)])
+            del output
+            os.replace(tmp_path, output_path)
+        else:
+            del output
+        np.save(os.path.splitext(output_path)[0] + '.ids.npy', np.asarray(ids))
+        print(f'Wrote {len(ids)} embeddings to {output_path}')
+        return len(ids)
+
+
+def write_parquet(records, output_path, rows_per_group=10000, dim=ENCODER_DIM):
+        """
+        Write streamed records to a Parquet file, one row group at a time
+
+        Parameters:
+        - records (iterable): (id, summary, embedding) tuples
+        - output_path (str): the path of the Parquet file
+        - rows_per_group (int): the number of records buffered per row group
+        - dim (int): the dimension of the embeddings
+
+        Returns:
+        int: the number of records written
+        """
+        writer = None
+        written = 0
+        buffer = []
+
+        def flush():
+            nonlocal writer
+            ids, summaries, embeddings = zip(*buffer)
+            vectors = np.asarray(embeddings, dtype=np.float32).reshape(-1)
+            table = pa.table({
+                'id': pa.array(ids),
+                'summary': pa.array(summaries, type=pa.string()),
+                'embedding': pa.FixedSizeListArray.from_arrays(pa.array(vectors, type=pa.float32()), dim),
+            })
+            if writer is None:
+                writer = pq.ParquetWriter(output_path, table.schema)
+            writer.write_table(table)
+            buffer.clear()
+
+        os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+        for record in records:
+            buffer.append(record)
+            written += 1
+            if len(buffer) == rows_per_group:
+                flush()
+        if buffer:
+            flush()
+        if writer is not None:
+            writer.close()
+
+        print(f'Wrote {written} records to {output_path}')
+        return written
+
+
+def add_to_index(records, index, batch_size=1024, with_ids=False):
+        """
+        Add streamed embeddings to a faiss index in batches
+
+        Parameters:
+        - records (iterable): (id, summary, embedding) tuples
+        - index (faiss.Index): the index to add the embeddings to
+        - batch_size (int): the number of embeddings added at once
+        - with_ids (bool): whether to add the records' integer ids with add_with_ids (for ID-mapped indexes)
+
+        Returns:
+        int: the number of embeddings added
+        """
+        added = 0
+        ids, embeddings = [], []
+
+        def flush():
+            vectors = np.ascontiguousarray(np.vstack(embeddings), dtype=np.float32)
+            if with_ids:
+                index.add_with_ids(vectors, np.asarray(ids, dtype=np.int64))
+            else:
+                index.add(vectors)
+            ids.clear()
+            embeddings.clear()
+
+        for article_id, _, embedding in records:
+            ids.append(article_id)
+            embeddings.append(embedding)
+            added += 1
+            if len(embeddings) == batch_size:
+                flush()
+        if embeddings:
+            flush()
+
+        return added
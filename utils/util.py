@@ -1,9 +1,26 @@
-import boto3
+import argparse
+import numpy as np
 import pandas as pd
-from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from functools import lru_cache
 
 import shutil
 import os
+import re
+import json
+import codecs
+import hashlib
+
+# Folder of the dataset partitions and name of the manifest describing them
+PARTITIONS_DIR = 'dataset/partitioned_nyt'
+MANIFEST_FILE = 'manifest.json'
+
+# Columns of the partitions, the category columns are kept when the dataset has them, for filtered search
+PARTITION_COLUMNS = ['text', 'link', 'headline', 'short_description', 'date']
+CATEGORY_COLUMNS = ['category', 'sub_category']
+
+# Rows per row group of the Parquet copies of the partitions, the unit of their S3 byte-range reads
+PARQUET_ROW_GROUP_SIZE = 10000
 
 
 def clear_folder(folder_path):
@@ -16,154 +33,352 @@ def clear_folder(folder_path):
             print("The folder does not exist or is not a directory.")
 
 
-def partition_large_dataset(file_path, output_folder_path):
+def detect_encoding(file_path, block_size=16 * 1024 * 1024):
+        """
+        Detect whether a file is UTF-8 by decoding it block by block, without loading it
+
+        Parameters:
+        - file_path (str): the path of the file
+        - block_size (int): the number of bytes decoded at once
+
+        Returns:
+        str: 'utf-8', or 'latin1' if the file is not valid UTF-8
+        """
+        decoder = codecs.getincrementaldecoder('utf-8')()
         try:
-            df = pd.read_csv(file_path, encoding='utf-8')
+            with open(file_path, 'rb') as f:
+                for block in iter(lambda: f.read(block_size), b''):
+                    decoder.decode(block)
+                decoder.decode(b'', final=True)
         except UnicodeDecodeError:
-            df = pd.read_csv(file_path, encoding='latin1')  # trying with 'latin1' encoding
-        df['Index'] = range(1, len(df) + 1)
-        df = df[['Index', 'text', 'link', 'headline', 'short_description', 'date']]
+            return 'latin1'
+        return 'utf-8'
+
+
+def _write_partition(partition, path):
+        # Write a partition and describe it for the manifest, run in a worker process
+        data = partition.to_csv(index=False).encode('utf-8')
+        with open(path + '.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(path + '.tmp', path)
+        return {'file': os.path.basename(path), 'first_id': int(partition['Index'].iloc[0]),
+                'last_id': int(partition['Index'].iloc[-1]), 'rows': len(partition), 'bytes': len(data),
+                'sha256': hashlib.sha256(data).hexdigest()}
 
-        # Calculate the partition size
-        partition_size = len(df) // 10  # Integer division to get the size of each partition
 
-        # Create a new folder for partitioned files
+def write_partitions(chunks, output_folder_path, rows_per_partition=None, bytes_per_partition=None, max_workers=4,
+                     base_file_path='NYTimes', source=None, encoding='utf-8', first_id=1):
+        """
+        Write a stream of DataFrame chunks into partitions and describe them in a manifest
+
+        Every article gets a sequential 'Index' starting at first_id. Partitions are written in parallel by a pool of
+        processes, and 'manifest.json' records their id ranges, row counts, sizes, checksums and the schema.
+
+        Parameters:
+        - chunks (iterable): the DataFrame chunks, with the same columns
+        - output_folder_path (str): the folder of the partitions
+        - rows_per_partition (int): the number of articles per partition
+        - bytes_per_partition (int): the target size of a partition, used if rows_per_partition is None
+        - max_workers (int): the number of processes writing partitions
+        - base_file_path (str): the prefix of the partition files
+        - source (str): the name of the source file recorded in the manifest
+        - encoding (str): the encoding of the source file recorded in the manifest
+        - first_id (int): the 'Index' of the first article, e.g. following the articles of a previous ingest
+
+        Returns:
+        dict: the manifest
+        """
         os.makedirs(output_folder_path, exist_ok=True)
 
-        # Partition and save
-        for i in range(10):
-            start = i * partition_size
-            end = (i + 1) * partition_size if i < 9 else len(df)  # Adjust the end for the last partition
-            partition = df.iloc[start:end]
-            partition_file_path = os.path.join(output_folder_path, f'NYTimes_part_{i+1}.csv')
-            partition.to_csv(partition_file_path, index=False)
+        # Buffered chunks, the first one is consumed from offset
+        buffer, buffered, offset, next_id, schema = [], 0, 0, first_id, None
+        futures = []
+
+        def flush(rows):
+            # Cut a partition of the given number of rows from the buffered chunks, without copying the rest
+            nonlocal buffered, offset
+            parts = []
+            while rows:
+                taken = min(rows, len(buffer[0]) - offset)
+                parts.append(buffer[0].iloc[offset:offset + taken])
+                offset, rows, buffered = offset + taken, rows - taken, buffered - taken
+                if offset == len(buffer[0]):
+                    buffer.pop(0)
+                    offset = 0
+            partition = pd.concat(parts, ignore_index=True)
+            path = os.path.join(output_folder_path, f'{base_file_path}_part_{len(futures) + 1}.csv')
+            futures.append(pool.submit(_write_partition, partition, path))
+
+            # Bound the number of partitions held in memory by the pending writes
+            pending = [future for future in futures if not future.done()]
+            if len(pending) > 2 * max_workers:
+                wait(pending, return_when=FIRST_COMPLETED)
+
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            for chunk in chunks:
+                if chunk.empty:
+                    continue
+                chunk = chunk.drop(columns=['Index'], errors='ignore')
+                chunk.insert(0, 'Index', range(next_id, next_id + len(chunk)))
+                next_id += len(chunk)
+
+                if schema is None:
+                    schema = {column: str(dtype) for column, dtype in chunk.dtypes.items()}
+                    if rows_per_partition is None:
+                        # Estimate the rows of a partition of the target size from the first chunk
+                        row_bytes = len(chunk.to_csv(index=False).encode('utf-8')) / max(len(chunk), 1)
+                        rows_per_partition = max(1, int((bytes_per_partition or 64 * 1024 * 1024) / row_bytes))
+
+                buffer.append(chunk)
+                buffered += len(chunk)
+                while buffered >= rows_per_partition:
+                    flush(rows_per_partition)
+            if buffered:
+                flush(buffered)
+
+            partitions = [future.result() for future in futures]
+
+        manifest = {'source': source, 'encoding': encoding, 'base_file_path': base_file_path,
+                    'rows': next_id - first_id, 'schema': schema, 'partitions': partitions}
+        with open(os.path.join(output_folder_path, MANIFEST_FILE + '.tmp'), 'w') as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(os.path.join(output_folder_path, MANIFEST_FILE + '.tmp'),
+                   os.path.join(output_folder_path, MANIFEST_FILE))
+
+        print(f"Partitioning completed: {manifest['rows']} rows in {len(partitions)} partitions.")
+        return manifest
+
+
+def _write_parquet_copy(csv_path, row_group_size):
+        # Write the Parquet copy of a partition next to it, run in a worker process
+        path = os.path.splitext(csv_path)[0] + '.parquet'
+        df = pd.read_csv(csv_path).sort_values('Index', kind='stable')
+        df.to_parquet(path + '.tmp', index=False, row_group_size=row_group_size)
+        os.replace(path + '.tmp', path)
+        return path
+
+
+def write_parquet_partitions(folder_path=PARTITIONS_DIR, row_group_size=PARQUET_ROW_GROUP_SIZE, max_workers=4):
+        """
+        Write a Parquet copy of every partition of a manifest, e.g. 'NYTimes_part_1.parquet' for 'NYTimes_part_1.csv'
 
-        print("Partitioning completed.")
+        The rows are sorted by 'Index', so the statistics of the row groups let s3.read_parquet_rows
+        download only the groups holding the requested rows (see s3.S3PartitionReader with file_format='parquet').
 
+        Parameters:
+        - folder_path (str): the folder of the partitions and of their manifest
+        - row_group_size (int): the number of rows per row group
+        - max_workers (int): the number of processes converting partitions
 
-def upload_files_to_s3(bucket_name, folder_path, aws_access_key_id, aws_secret_access_key):
+        Returns:
+        list: the paths of the Parquet files
+        """
+        paths = [os.path.join(folder_path, partition['file']) for partition in load_manifest(folder_path)['partitions']]
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            written = list(pool.map(_write_parquet_copy, paths, [row_group_size] * len(paths)))
+        print(f"Wrote the Parquet copies of {len(written)} partitions.")
+        return written
+
+
+def partition_large_dataset(file_path, output_folder_path, rows_per_partition=None, bytes_per_partition=None,
+                            chunksize=50000, max_workers=4, base_file_path='NYTimes'):
         """
-        Upload all files from a local folder to an Amazon S3 bucket
+        Split a CSV dataset into partitions, streaming it chunk by chunk, and describe them in a manifest
 
         Parameters:
-        - bucket_name (str): the name of the S3 bucket
-        - folder_path (str): the local path of the folder containing files to be uploaded
-        - aws_access_key_id (str): AWS access key ID with S3 written permissions
-        - aws_secret_access_key (str): AWS secret access key corresponding to the provided access key
+        - file_path (str): the path of the CSV dataset, UTF-8 or latin1
+        - output_folder_path (str): the folder of the partitions
+        - rows_per_partition (int): the number of articles per partition
+        - bytes_per_partition (int): the target size of a partition, used if rows_per_partition is None
+        - chunksize (int): the number of rows read at once
+        - max_workers (int): the number of processes writing partitions
+        - base_file_path (str): the prefix of the partition files
 
         Returns:
-        None
+        dict: the manifest, see write_partitions
         """
+        encoding = detect_encoding(file_path)
 
-        # Create an S3 client
-        s3 = boto3.client(
-            's3',
-            aws_access_key_id=aws_access_key_id,
-            aws_secret_access_key=aws_secret_access_key
-        )
+        def chunks():
+            for chunk in pd.read_csv(file_path, encoding=encoding, chunksize=chunksize):
+                yield chunk[PARTITION_COLUMNS + [column for column in CATEGORY_COLUMNS if column in chunk]]
 
-        # List files in the folder
-        files = os.listdir(folder_path)
+        return write_partitions(chunks(), output_folder_path, rows_per_partition, bytes_per_partition, max_workers,
+                                base_file_path, os.path.basename(file_path), encoding)
 
-        # Upload each file to the bucket
-        for file in files:
-            file_path = os.path.join(folder_path, file)
-            if os.path.isfile(file_path):
-                s3.upload_file(file_path, bucket_name, file)
-                print(f"Uploaded {file} to S3 bucket {bucket_name}")
 
+def load_manifest(folder_path=PARTITIONS_DIR):
+        """
+        Load the manifest written by partition_large_dataset
 
-def read_from_partitions(bucket_name, base_file_path, target_indices, partition_size, aws_access_key_id, aws_secret_access_key):
+        Parameters:
+        - folder_path (str): the folder of the partitions
+
+        Returns:
+        dict: the manifest
         """
-        Read specific rows from partitioned CSV files stored in an Amazon S3 bucket and combine them into a DataFrame
+        with open(os.path.join(folder_path, MANIFEST_FILE)) as f:
+            return json.load(f)
+
+
+def locate_partitions(manifest, target_indices):
+        """
+        Group row indices by the partition file holding them, using the id ranges of a manifest
 
         Parameters:
-        - bucket_name (str): the name of the S3 bucket
-        - base_file_path (str): the base path of partitioned CSV files without the partition suffix
-        - target_indices (list): a list of row indices to retrieve from the partitions
-        - partition_size (int): the size of each partition
-        - aws_access_key_id (str): AWS access key ID with S3 written permissions
-        - aws_secret_access_key (str): AWS secret access key corresponding to the provided access key
+        - manifest (dict): the manifest of the partitions
+        - target_indices (list): the row indices
 
         Returns:
-        pandas.DataFrame: a DataFrame containing the rows specified by the target indices
+        dict: the list of indices of every partition file, indices outside every partition are left out
         """
+        partitions = manifest['partitions']
+        first_ids = np.array([partition['first_id'] for partition in partitions])
+        groups = {}
+        for index in target_indices:
+            position = int(np.searchsorted(first_ids, index, side='right')) - 1
+            if position >= 0 and index <= partitions[position]['last_id']:
+                groups.setdefault(partitions[position]['file'], []).append(int(index))
+        return groups
 
-        # Create S3 client
-        s3 = boto3.client(
-            's3',
-            aws_access_key_id=aws_access_key_id,
-            aws_secret_access_key=aws_secret_access_key
-        )
 
-        # Dictionary to hold dataframes for each partition
-        partition_dfs = {}
+def fixed_size_partitions(target_indices, partition_size, base_file_path='NYTimes', count=None):
+        """
+        Group row indices by the partition file holding them, for partitions of partition_size rows written without
+        a manifest, the last partition holding the remaining rows
 
-        # List to hold the rows corresponding to target indices
-        rows = []
+        Parameters:
+        - target_indices (list): the row indices, the dataset 'Index' values starting at 1
+        - partition_size (int): the number of rows of every partition but the last
+        - base_file_path (str): the prefix of the partition files
+        - count (int): the number of partitions, unbounded if None
 
+        Returns:
+        dict: the list of indices of every partition file
+        """
+        groups = {}
         for index in target_indices:
-            # Calculate the partition suffix
-            partition_number = index // partition_size + 1
+            if index < 1:
+                continue
+            number = (int(index) - 1) // partition_size + 1
+            if count is not None:
+                number = min(number, count)
+            groups.setdefault(f"{base_file_path}_part_{number}.csv", []).append(int(index))
+        return groups
+
+
+def _partition_layout(folder_path, base_file_path='NYTimes'):
+        # Number of partitions and rows of the first one, for partitions written without a manifest, read again
+        # once files are added to or removed from the folder or the first partition is rewritten
+        try:
+            first = os.stat(os.path.join(folder_path, f'{base_file_path}_part_1.csv')).st_mtime_ns
+        except FileNotFoundError:
+            first = None
+        return _read_partition_layout(folder_path, base_file_path, os.stat(folder_path).st_mtime_ns, first)
 
-            if partition_number not in partition_dfs:
-                # Obtain the partition file name
-                partition_file_name = f"{base_file_path}_part_{partition_number}.csv"
 
-                # Get the object from S3
-                response = s3.get_object(Bucket=bucket_name, Key=partition_file_name)
-                file_content = response['Body'].read()
+@lru_cache(maxsize=32)
+def _read_partition_layout(folder_path, base_file_path, folder_mtime, first_mtime):
+        pattern = re.compile(re.escape(base_file_path) + r'_part_\d+\.csv')
+        count = sum(1 for name in os.listdir(folder_path) if pattern.fullmatch(name))
+        if count == 0:
+            raise FileNotFoundError(f"No {MANIFEST_FILE} or {base_file_path} partitions in {folder_path}, "
+                                    f"partition the dataset with python -m utils.util")
+        first = pd.read_csv(os.path.join(folder_path, f'{base_file_path}_part_1.csv'), usecols=['Index'])
+        return count, len(first)
 
-                # Read the file content into a pandas DataFrame
-                df = pd.read_csv(BytesIO(file_content))
-                partition_dfs[partition_number] = df
 
-            else:
-                df = partition_dfs[partition_number]
+def _in_order(df, target_indices):
+        # Sort the rows read from the partitions in the order of the target indices, e.g. the search ranking
+        order = {int(index): position for position, index in enumerate(target_indices)}
+        return df.iloc[np.argsort([order[index] for index in df['Index']], kind='stable')]
 
-            # Retrieve the row by index if it exists in the DataFrame
-            if index in list(df.Index):
-                rows.append(df[df.Index == index])
 
-        # Combine all rows into a single DataFrame
-        return pd.concat(rows, axis=0)
+def upload_files_to_s3(bucket_name, folder_path, aws_access_key_id, aws_secret_access_key):
+        """
+        Upload the files of a local folder to an Amazon S3 bucket, skipping those unchanged since the last upload
+
+        Parameters:
+        - bucket_name (str): the name of the S3 bucket
+        - folder_path (str): the local path of the folder containing files to be uploaded
+        - aws_access_key_id (str): AWS access key ID with S3 written permissions
+        - aws_secret_access_key (str): AWS secret access key corresponding to the provided access key
 
-def read_from_local_partitions(target_indices, partition_size):
+        Returns:
+        None
         """
-        Read specific rows from partitioned CSV files stored locally and combine them into a DataFrame
+
+        # Upload the new and changed files in parallel, see s3.sync_to_s3
+        from utils.s3 import sync_to_s3
+
+        sync_to_s3(bucket_name, [(folder_path, '')], aws_access_key_id, aws_secret_access_key)
+
+
+def read_from_partitions(bucket_name, base_file_path, target_indices, partition_size, aws_access_key_id, aws_secret_access_key):
+        """
+        Read specific rows from partitioned CSV files stored in an Amazon S3 bucket and combine them into a DataFrame
 
         Parameters:
+        - bucket_name (str): the name of the S3 bucket
+        - base_file_path (str): the base path of partitioned CSV files without the partition suffix
         - target_indices (list): a list of row indices to retrieve from the partitions
-        - partition_size (int): the size of each partition
+        - partition_size (int): the size of each partition, the partitions are located with the manifest
+          stored in the bucket if None
+        - aws_access_key_id (str): AWS access key ID with S3 written permissions
+        - aws_secret_access_key (str): AWS secret access key corresponding to the provided access key
 
         Returns:
         pandas.DataFrame: a DataFrame containing the rows specified by the target indices
         """
-        base_file_path = "NYTimes"
-        # Dictionary to hold dataframes for each partition
-        partition_dfs = {}
 
-        # List to hold the rows corresponding to target indices
-        rows = []
+        # Fetch the needed partitions concurrently through the shared client and the local partition cache
+        from utils.s3 import get_reader
 
-        for index in target_indices:
-
-            partition_number = index // partition_size + 1
-            if partition_number not in partition_dfs:
-
-                # Calculate the partition file name
-                partition_file_name = f"dataset/partitioned_nyt/{base_file_path}_part_{partition_number}.csv"
+        reader = get_reader(bucket_name, base_file_path, aws_access_key_id, aws_secret_access_key)
+        return reader.read_rows(target_indices, partition_size)
 
-                df = pd.read_csv(partition_file_name)
-                partition_dfs[partition_number] = df
+def read_from_local_partitions(target_indices, partition_size=None, folder_path=PARTITIONS_DIR):
+        """
+        Read specific rows from partitioned CSV files stored locally and combine them into a DataFrame
 
-            else:
-                df = partition_dfs[partition_number]
+        Parameters:
+        - target_indices (list): a list of row indices to retrieve from the partitions
+        - partition_size (int): the size of each partition, the partitions are located with their manifest if None
+        - folder_path (str): the folder of the partitions
 
-            # Retrieve the row by index if it exists in the DataFrame
-            if index in list(df.Index):
+        Returns:
+        pandas.DataFrame: a DataFrame containing the rows specified by the target indices, in their order
+        """
+        if partition_size is None and os.path.exists(os.path.join(folder_path, MANIFEST_FILE)):
+            groups = locate_partitions(load_manifest(folder_path), target_indices)
+        else:
+            # Fixed-size partitions written without a manifest, their size is read from the first one if not given
+            count, first_size = _partition_layout(folder_path)
+            groups = fixed_size_partitions(target_indices, partition_size or first_size, count=count)
 
-                rows.append(df[df.Index == index])
+        frames = []
+        for file_name, indices in groups.items():
+            df = pd.read_csv(os.path.join(folder_path, file_name))
+            frames.append(df[df['Index'].isin(indices)])
+        if not frames:
+            return pd.DataFrame(columns=['Index'] + PARTITION_COLUMNS)
 
         # Combine all rows into a single DataFrame
-        return pd.concat(rows, axis=0)
+        return _in_order(pd.concat(frames, axis=0), target_indices)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Split a CSV dataset into partitions described by a manifest')
+    parser.add_argument('csv_file')
+    parser.add_argument('--output', default=PARTITIONS_DIR)
+    parser.add_argument('--rows', type=int, default=None, help='articles per partition')
+    parser.add_argument('--mb', type=int, default=64, help='target partition size in MB, used without --rows')
+    parser.add_argument('--chunksize', type=int, default=50000)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--parquet', action='store_true',
+                        help='also write a Parquet copy of every partition, read from S3 with byte-range requests')
+    args = parser.parse_args()
+
+    partition_large_dataset(args.csv_file, args.output, args.rows, args.mb * 1024 * 1024, args.chunksize, args.workers)
+    if args.parquet:
+        write_parquet_partitions(args.output, max_workers=args.workers)
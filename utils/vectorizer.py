@@ -1,14 +1,29 @@
 from newspaper import Article
-import nltk
-from nltk.corpus import stopwords
-from nltk.tokenize import word_tokenize
-from nltk.stem import WordNetLemmatizer
-import re
+import os
+import time
+import threading
+import multiprocessing
 import numpy as np
+import torch
+from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
 
-from transformers import T5ForConditionalGeneration, T5Tokenizer, BartForConditionalGeneration, BartTokenizer
-from sentence_transformers import SentenceTransformer
+from utils.models import get_summarizer, get_encoder, ENCODER_NAME, QUANTIZE
+from utils.cache import embedding_cache, cache_key
+from utils.normalizer import normalize_text, normalize_batch
+
+# Maximum number of input tokens of each summarization model
+MAX_INPUT_LENGTH = {'bart': 1024, 't5': 512}
+
+# Generation parameters used for every summary
+GENERATION_KWARGS = dict(max_length=150, min_length=40, length_penalty=2.0, num_beams=4, early_stopping=True)
+
+# Token overlap between consecutive windows and latency budget of the long-document mode
+LONG_WINDOW_OVERLAP = 128
+LONG_SUMMARY_BUDGET_S = float(os.environ.get('NEWSREC_LONG_SUMMARY_BUDGET_S', 60))
+
+# Number of processes summarizing the windows of the long-document mode, 1 summarizes them in the calling process
+LONG_SUMMARY_WORKERS = int(os.environ.get('NEWSREC_LONG_SUMMARY_WORKERS', 1))
 
 def download_parse_article(url):
         """
@@ -42,159 +57,551 @@ def preprocess_text(text):
         str: the preprocessed text
         """
 
-        # Convert to lowercase, , , , and
-        text = text.lower()
+        # Lowercase, keep letters only, remove stopwords and lemmatize
+        return normalize_text(text, profile='vectorizer')
 
-        # Remove non-alphabetic characters
-        text = re.sub(r'[^a-zA-Z\s]', '', text)
 
-        # Tokenization
-        words = word_tokenize(text)
+def summarize_text(preprocessed_text, model_name='bart'):
+        """
+        Summarize the preprocessed text using the specified model (BART or T5)
 
-        # Remove stopwords
-        stop_words = set(stopwords.words('english'))
-        filtered_words = [word for word in words if word not in stop_words]
+        Parameters:
+        - preprocessed_text (str): the preprocessed text to be summarized
+        - model_name (str): the name of the summarization model ('bart' or 't5')
+
+        Returns:
+        str: the summarized text.
+        """
 
-        # Lemmatization
-        lemmatizer = WordNetLemmatizer()
-        lemmatized_words = [lemmatizer.lemmatize(word) for word in filtered_words]
-        preprocessed_text = ' '.join(lemmatized_words)
+        # Fetch the tokenizer and model loaded once per process (raises an error for an invalid model name)
+        tokenizer, model = get_summarizer(model_name)
 
-        return preprocessed_text
+        # Tokenize and encode the preprocessed text
+        input_ids = tokenizer("summarize: " + preprocessed_text, return_tensors='pt',
+                              max_length=MAX_INPUT_LENGTH[model_name.lower()], truncation=True).input_ids
 
+        # Generate a summary
+        summary_ids = model.generate(input_ids, **GENERATION_KWARGS)
 
-def summarize_text(preprocessed_text, model_name='bart'):
+        # Decode the generated summary and skip special tokens
+        summary = tokenizer.decode(summary_ids[0], skip_special_tokens=True)
+        return summary
+
+
+def summarize_texts(preprocessed_texts, model_name='bart', batch_size=8):
         """
-        Summarize the preprocessed text using the specified model (BART or T5)
+        Summarize a list of preprocessed texts in batches using the specified model (BART or T5)
+
+        The texts are sorted by token length and batched so that each batch is only padded to the
+        length of similar texts. The summaries are returned in the order of the input texts.
 
         Parameters:
-        - preprocessed_text (str): the preprocessed text to be summarized
+        - preprocessed_texts (list): the preprocessed texts to be summarized
         - model_name (str): the name of the summarization model ('bart' or 't5')
+        - batch_size (int): the number of texts passed to generate at once
 
         Returns:
-        str: the summarized text.
+        list: the summarized texts
         """
 
-        # Summarize the text using either BART or T5 model based on the specified model name
-        if model_name.lower() == 'bart':
-            # Initialize BART tokenizer and model
-            tokenizer = BartTokenizer.from_pretrained('facebook/bart-large-cnn')
-            model = BartForConditionalGeneration.from_pretrained('facebook/bart-large-cnn')
+        tokenizer, model = get_summarizer(model_name)
 
-            # Tokenize and encode the preprocessed text for BART
-            inputs = tokenizer.encode("summarize: " + preprocessed_text, return_tensors='pt', max_length=1024, truncation=True)
+        # Tokenize all texts once, without padding
+        input_ids = tokenizer(["summarize: " + text for text in preprocessed_texts],
+                              max_length=MAX_INPUT_LENGTH[model_name.lower()], truncation=True).input_ids
 
-            # Generate a summary using BART model
-            summary_ids = model.generate(inputs, max_length=150, min_length=40,
-                                         length_penalty=2.0, num_beams=4, early_stopping=True)
+        # Sort by token length so that every batch holds texts of similar length
+        order = sorted(range(len(input_ids)), key=lambda i: len(input_ids[i]))
 
-        elif model_name.lower() == 't5':
-            # Initialize T5 tokenizer and model
-            tokenizer = T5Tokenizer.from_pretrained('t5-large')
-            model = T5ForConditionalGeneration.from_pretrained('t5-large')
+        summaries = [None] * len(input_ids)
+        for start in tqdm(range(0, len(order), batch_size), desc="Summarizing Batches"):
+            batch = order[start:start + batch_size]
 
-            # Tokenize and encode the preprocessed text for T5
-            input_ids = tokenizer("summarize: " + preprocessed_text, return_tensors="pt",
-                                  max_length=512, truncation=True).input_ids
+            # Pad within the batch only
+            inputs = tokenizer.pad({'input_ids': [input_ids[i] for i in batch]}, return_tensors='pt')
+            summary_ids = model.generate(inputs['input_ids'], attention_mask=inputs['attention_mask'],
+                                         **GENERATION_KWARGS)
 
-            # Generate a summary using T5 model
-            summary_ids = model.generate(input_ids, max_length=150, min_length=40,
-                                         length_penalty=2.0, num_beams=4, early_stopping=True)
+            # Restore the original order
+            for i, summary in zip(batch, tokenizer.batch_decode(summary_ids, skip_special_tokens=True)):
+                summaries[i] = summary
 
-        else:
-            # Raise an error for an invalid model name
-            raise ValueError("Model name should be 'bart' or 't5'")
+        return summaries
+
+
+def _split_windows(token_ids, window, overlap):
+        # Start positions of overlapping windows covering all tokens, summarize_long_texts checks that overlap < window
+        step = window - overlap
+        return [token_ids[start:start + window] for start in range(0, max(len(token_ids) - overlap, 1), step)]
+
+
+_summary_pools = {}
+_summary_pools_lock = threading.Lock()
+
+
+def _init_summary_worker(threads):
+        # Give every worker process its share of the cores, the calling process keeps its own thread count
+        torch.set_num_threads(threads)
 
-        # Decode the generated summary and skip special tokens
-        summary = tokenizer.decode(summary_ids[0], skip_special_tokens=True)
-        return summary
 
+def _summary_pool(num_workers):
+        # Worker processes are started once per number of workers and keep their summarizer loaded between calls
+        from utils.corpus import available_cores
 
+        with _summary_pools_lock:
+            if num_workers not in _summary_pools:
+                # Spawn fresh workers, forking a process that already runs torch threads can deadlock
+                _summary_pools[num_workers] = ProcessPoolExecutor(
+                    max_workers=num_workers, mp_context=multiprocessing.get_context('spawn'),
+                    initializer=_init_summary_worker, initargs=(max(1, available_cores() // num_workers),))
+            return _summary_pools[num_workers]
 
 
-def process_and_encode_articles(texts, model_name='bart'):
+def _summarize_parallel(texts, model_name, batch_size, num_workers):
+        # Summarize groups of texts on a pool of processes
+        if num_workers <= 1 or len(texts) <= batch_size:
+            return summarize_texts(texts, model_name, batch_size)
+
+        # Deal out the length-sorted batches of summarize_texts whole, so that every text is generated in the same
+        # batch whatever the number of workers and the cached summaries do not depend on it
+        tokenizer, _ = get_summarizer(model_name)
+        input_ids = tokenizer(["summarize: " + text for text in texts],
+                              max_length=MAX_INPUT_LENGTH[model_name.lower()], truncation=True).input_ids
+        order = sorted(range(len(texts)), key=lambda i: len(input_ids[i]))
+        batches = [order[start:start + batch_size] for start in range(0, len(order), batch_size)]
+        groups = [[i for batch in batches[worker::num_workers] for i in batch] for worker in range(num_workers)]
+        groups = [group for group in groups if group]
+        results = _summary_pool(num_workers).map(summarize_texts, [[texts[i] for i in group] for group in groups],
+                                                 [model_name] * len(groups), [batch_size] * len(groups))
+
+        # Put the summaries of the groups back into the input order
+        summaries = [None] * len(texts)
+        for group, group_summaries in zip(groups, results):
+            for i, summary in zip(group, group_summaries):
+                summaries[i] = summary
+        return summaries
+
+
+def summarize_long_texts(preprocessed_texts, model_name='bart', overlap=LONG_WINDOW_OVERLAP, batch_size=8,
+                         num_workers=LONG_SUMMARY_WORKERS, budget_s=LONG_SUMMARY_BUDGET_S, return_timings=False):
+        """
+        Summarize texts longer than the model window with a map-reduce pass
+
+        Every text is split into overlapping token windows and all windows are summarized as one batch (map).
+        The partial summaries of each text are then joined and summarized again (reduce), repeating the
+        map pass if the joined summaries still exceed the window. Texts that fit the window are summarized directly.
+
+        Parameters:
+        - preprocessed_texts (list): the preprocessed texts to be summarized
+        - model_name (str): the name of the summarization model ('bart' or 't5')
+        - overlap (int): the number of tokens shared by consecutive windows
+        - batch_size (int): the number of windows passed to generate at once
+        - num_workers (int): the number of processes summarizing windows in parallel, each loading its own model
+        - budget_s (float): the latency budget in seconds, the reduce pass is skipped and the joined
+          partial summaries are returned once it is exceeded
+        - return_timings (bool): whether to also return the timings of the stage
+
+        Returns:
+        list: the summarized texts, and a dict of timings if return_timings is True
+        """
+
+        # Leave room for the "summarize: " prefix and the special tokens
+        window = MAX_INPUT_LENGTH[model_name.lower()] - 16
+        if not 0 <= overlap < window:
+            raise ValueError(f"The window overlap should be between 0 and {window - 1} tokens for {model_name}, "
+                             f"got {overlap}")
+
+        start = time.perf_counter()
+        tokenizer, model = get_summarizer(model_name)
+
+        # Split every text into windows (map inputs)
+        windows, owners = [], []
+        token_ids = tokenizer(list(preprocessed_texts), add_special_tokens=False).input_ids if preprocessed_texts else []
+        for i, ids in enumerate(token_ids):
+            for piece in _split_windows(ids, window, overlap):
+                windows.append(tokenizer.decode(piece))
+                owners.append(i)
+        timings = {'windows': len(windows), 'split_s': time.perf_counter() - start}
+
+        # Summarize all windows as one batch
+        partial_summaries = _summarize_parallel(windows, model_name, batch_size, num_workers)
+        timings['map_s'] = time.perf_counter() - start - timings['split_s']
+
+        summaries = [[] for _ in token_ids]
+        for i, summary in zip(owners, partial_summaries):
+            summaries[i].append(summary)
+        summaries = [' '.join(parts) for parts in summaries]
+
+        # Summarize the joined partial summaries of the texts that spanned several windows
+        long_texts = [i for i, ids in enumerate(token_ids) if len(_split_windows(ids, window, overlap)) > 1]
+        remaining = budget_s - (time.perf_counter() - start) if budget_s is not None else None
+        timings['over_budget'] = remaining is not None and remaining <= 0
+        if long_texts and not timings['over_budget']:
+            reduced, reduce_timings = summarize_long_texts([summaries[i] for i in long_texts], model_name, overlap,
+                                                           batch_size, num_workers, remaining, return_timings=True)
+            for i, summary in zip(long_texts, reduced):
+                summaries[i] = summary
+            timings['over_budget'] = reduce_timings['over_budget']
+        timings['reduce_s'] = time.perf_counter() - start - timings['split_s'] - timings['map_s']
+        timings['total_s'] = time.perf_counter() - start
+
+        if timings['over_budget']:
+            print(f"Long-document summarization exceeded its budget of {budget_s}s, returning partial summaries")
+        if return_timings:
+            return summaries, timings
+        return summaries
+
+
+def encode_text(summaries, batch_size=64, normalize=False):
+        """
+        Encode one or more summaries with the shared SentenceTransformer (all-MiniLM-L6-v2)
+
+        Parameters:
+        - summaries (str or list): a summary or a list of summaries
+        - batch_size (int): the number of summaries encoded at once
+        - normalize (bool): whether to L2-normalise the embeddings
+
+        Returns:
+        numpy.ndarray: a contiguous float32 matrix with one 384-dimensional row per summary
+        """
+
+        if isinstance(summaries, str):
+            summaries = [summaries]
+        summaries = list(summaries)
+
+        model = get_encoder()
+        if not summaries:
+            return np.empty((0, model.get_sentence_embedding_dimension()), dtype=np.float32)
+
+        embeddings = model.encode(summaries, batch_size=batch_size, convert_to_numpy=True,
+                                  normalize_embeddings=normalize, show_progress_bar=False)
+
+        # faiss expects a C-contiguous float32 matrix
+        return np.ascontiguousarray(embeddings, dtype=np.float32)
+
+
+def embed_text_direct(preprocessed_texts, pooling='mean', normalize=False, batch_size=64):
+        """
+        Encode preprocessed texts without summarizing them first
+
+        Each text is split into chunks that fit the encoder's token window, all chunks are encoded
+        in one batch and the chunk vectors of each text are pooled into a single vector.
+
+        Parameters:
+        - preprocessed_texts (list): the preprocessed article texts
+        - pooling (str): 'mean' to average the chunk vectors, 'weighted' to weight them by their number of tokens
+        - normalize (bool): whether to L2-normalise the pooled embeddings
+        - batch_size (int): the number of chunks encoded at once
+
+        Returns:
+        numpy.ndarray: a contiguous float32 matrix with one row per text
+        """
+
+        if pooling not in ('mean', 'weighted'):
+            raise ValueError("Pooling should be 'mean' or 'weighted'")
+
+        model = get_encoder()
+        tokenizer = model.tokenizer
+
+        # Leave room for the special tokens added by the encoder
+        window = model.max_seq_length - 2
+
+        chunks, owners, weights = [], [], []
+        token_ids = tokenizer(list(preprocessed_texts), add_special_tokens=False).input_ids if preprocessed_texts else []
+        for i, ids in enumerate(token_ids):
+            for start in range(0, max(len(ids), 1), window):
+                piece = ids[start:start + window]
+                chunks.append(tokenizer.decode(piece))
+                owners.append(i)
+                weights.append(max(len(piece), 1) if pooling == 'weighted' else 1)
+
+        vectors = encode_text(chunks, batch_size=batch_size)
+
+        # Pool the chunk vectors of every text
+        weights = np.asarray(weights, dtype=np.float32)
+        pooled = np.zeros((len(token_ids), vectors.shape[1]), dtype=np.float32)
+        np.add.at(pooled, owners, vectors * weights[:, None])
+        pooled /= np.bincount(owners, weights=weights, minlength=len(token_ids)).astype(np.float32)[:, None]
+
+        if normalize:
+            pooled /= np.maximum(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12)
+
+        return np.ascontiguousarray(pooled, dtype=np.float32)
+
+
+def pipeline_params(model_name='bart', normalize=False, mode='summarize', pooling='mean', batch_size=None):
+        """
+        Return the parameters that determine the summary and embedding of a text
+
+        Padded batched generation is not guaranteed to reproduce unbatched generation token for token,
+        so the generation batch size is part of the parameters of the summarizing modes.
+
+        Parameters:
+        - model_name (str): the name of the summarization model ('bart' or 't5')
+        - normalize (bool): whether the embeddings are L2-normalised
+        - mode (str): 'summarize' to embed the summary, 'long' to embed a map-reduce summary, 'direct' to embed the text itself
+        - pooling (str): the chunk pooling of the direct mode
+        - batch_size (int): the generation batch size, None for one text at a time
+
+        Returns:
+        dict: the parameters used to build cache keys
+        """
+        if mode == 'direct':
+            return dict(mode=mode, pooling=pooling, encoder=ENCODER_NAME, normalize=normalize, quantized=QUANTIZE)
+        params = dict(GENERATION_KWARGS, max_input_length=MAX_INPUT_LENGTH.get(model_name.lower()),
+                      encoder=ENCODER_NAME, normalize=normalize, quantized=QUANTIZE, batch_size=batch_size)
+        if mode == 'long':
+            params.update(mode=mode, overlap=LONG_WINDOW_OVERLAP, batch_size=batch_size or 8)
+        return params
+
+
+def run_pipeline(preprocessed_texts, model_name='bart', batch_size=None, normalize=False, mode='summarize',
+                 pooling='mean', use_cache=True, num_workers=LONG_SUMMARY_WORKERS):
+        """
+        Summarize and encode preprocessed texts, reusing the cached results of texts seen before
+
+        Parameters:
+        - preprocessed_texts (list): the preprocessed article texts
+        - model_name (str): the name of the summarization model ('bart' or 't5')
+        - batch_size (int): summarize in length-bucketed batches of this size, one text at a time if None
+        - normalize (bool): whether to L2-normalise the embeddings
+        - mode (str): 'summarize' to embed the summaries, 'long' to summarize long texts with a map-reduce pass,
+          'direct' to skip summarization and embed pooled text chunks
+        - pooling (str): 'mean' or 'weighted' chunk pooling of the direct mode
+        - use_cache (bool): whether to read and write the summary/embedding cache
+        - num_workers (int): the number of processes summarizing the windows of the long mode
+
+        Returns:
+        tuple: a list of summaries (None in direct mode) and a float32 matrix of embeddings
+        """
+
+        if mode not in ('summarize', 'long', 'direct'):
+            raise ValueError("Mode should be 'summarize', 'long' or 'direct'")
+
+        # Look up every text in the cache before running any model
+        params = pipeline_params(model_name, normalize, mode, pooling, batch_size)
+        name = 'direct' if mode == 'direct' else model_name.lower()
+        keys = [cache_key(text, name, params) for text in preprocessed_texts]
+        results = embedding_cache.get_many(keys) if use_cache else {}
+
+        # Texts to run through the models, each distinct text only once
+        missing = {}
+        for key, text in zip(keys, preprocessed_texts):
+            if key not in results:
+                missing.setdefault(key, text)
+
+        if missing:
+            texts = list(missing.values())
+            if mode == 'direct':
+                summaries = [None] * len(texts)
+                embeddings = embed_text_direct(texts, pooling, normalize)
+            elif mode == 'long':
+                summaries, timings = summarize_long_texts(texts, model_name, batch_size=batch_size or 8,
+                                                          num_workers=num_workers, return_timings=True)
+                embeddings = encode_text(summaries, normalize=normalize)
+
+                # Partial summaries returned over budget are not worth keeping
+                use_cache = use_cache and not timings['over_budget']
+            else:
+                if batch_size:
+                    summaries = summarize_texts(texts, model_name, batch_size)
+                else:
+                    summaries = [summarize_text(text, model_name) for text in tqdm(texts, desc="Processing Articles")]
+                embeddings = encode_text(summaries, normalize=normalize)
+
+            items = list(zip(missing, summaries, embeddings))
+            if use_cache:
+                embedding_cache.put_many(items)
+            results.update((key, (summary, embedding)) for key, summary, embedding in items)
+
+        summaries = [results[key][0] for key in keys]
+        if not keys:
+            return summaries, encode_text([], normalize=normalize)
+        return summaries, np.ascontiguousarray(np.vstack([results[key][1] for key in keys]), dtype=np.float32)
+
+
+
+
+def process_and_encode_articles(texts, model_name='bart', batch_size=None, normalize=False, mode='summarize',
+                                pooling='mean', num_workers=LONG_SUMMARY_WORKERS):
         """
         Process and encode a list of articles' texts using the specified model ('bart' or 't5')
 
         Parameters:
         - texts (list): a list of article texts
         - model_name (str): the name of the summarization model ('bart' or 't5')
+        - batch_size (int): summarize the articles in length-bucketed batches of this size, one at a time if None
+        - normalize (bool): whether to L2-normalise the embeddings
+        - mode (str): 'summarize' to embed the summaries, 'long' to summarize long articles with a map-reduce pass,
+          'direct' to embed the articles without summarizing them
+        - pooling (str): 'mean' or 'weighted' chunk pooling of the direct mode
+        - num_workers (int): the number of processes summarizing the windows of the long mode
 
         Returns:
-        tuple: two lists, which are summaries and embeddings
+        tuple: a list of summaries and a float32 matrix of embeddings
         """
 
         # Check if input is a list
         if isinstance(texts, str):
             raise TypeError("Input cannot be str")
 
-        summaries = []
-        embeddings = []
-
-        # Use tqdm for the progress bar
-        for i, text in tqdm(enumerate(texts), total=len(texts), desc="Processing Articles"):
-            # Preprocess, summarize, and encode each article
-            preprocessed_text = preprocess_text(text)
-            summary = summarize_text(preprocessed_text, model_name)
-            embedding = encode_text(summary)
-            summaries.append(summary)
-            embeddings.append(embedding)
-
-        return summaries, embeddings
+        preprocessed_texts = normalize_batch(list(texts), profile='vectorizer')
+        return run_pipeline(preprocessed_texts, model_name, batch_size, normalize, mode, pooling,
+                            num_workers=num_workers)
 
 
 
 # Function to process and encode articles from multiple URLs
-def process_and_encode_url(urls, model_name='bart'):
+def process_and_encode_url(urls, model_name='bart', normalize=False, mode='summarize', pooling='mean'):
         """
         Process and encode text from url input using the specified model ('bart' or 't5')
 
         Parameters:
-        - texts (list): a list of urls
+        - urls (list): a list of urls
         - model_name (str): the name of the summarization model ('bart' or 't5')
+        - normalize (bool): whether to L2-normalise the embeddings
+        - mode (str): 'summarize' to embed the summaries, 'long' to summarize long articles with a map-reduce pass,
+          'direct' to embed the articles without summarizing them
+        - pooling (str): 'mean' or 'weighted' chunk pooling of the direct mode
 
         Returns:
-        tuple: two lists, which are summaries and embeddings
+        tuple: a list of summaries and a float32 matrix of embeddings
         """
-        if isinstance(texts, str):
+        if isinstance(urls, str):
             raise TypeError("Input can not be str")
 
-        summaries = []
-        embeddings = []
+        preprocessed_texts = []
 
         for i,url in enumerate(urls):
             print(f'Start embedding...{i}')
             text = download_parse_article(url)
-            preprocessed_text = preprocess_text(text)
-            summary = summarize_text(preprocessed_text, model_name)
-            embedding = encode_text(summary)
-            summaries.append(summary)
-            embeddings.append(embedding)
+            preprocessed_texts.append(preprocess_text(text))
+
+        return run_pipeline(preprocessed_texts, model_name, normalize=normalize, mode=mode, pooling=pooling)
+
+
 
-        return summaries, embeddings
+def _batches(iterable, size):
+        # Group an iterable into lists of at most size items
+        batch = []
+        for item in iterable:
+            batch.append(item)
+            if len(batch) == size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
 
 
+def _with_ids(items):
+        # Accept plain items or (id, item) tuples, plain items are numbered in order
+        for position, item in enumerate(items):
+            yield item if isinstance(item, tuple) else (position, item)
 
-def encode_dataset(df, output_path):
+
+def iter_process_and_encode_articles(texts, model_name='bart', batch_size=8, normalize=False, mode='summarize',
+                                     chunk_size=256, pooling='mean'):
+        """
+        Process and encode an iterable of articles' texts, yielding the results as they complete
+
+        Only chunk_size articles are held in memory at a time, so the input can be a generator over a
+        dataset larger than RAM (see utils.streaming.iter_csv_texts).
+
+        Parameters:
+        - texts (iterable): article texts, or (id, text) tuples
+        - model_name (str): the name of the summarization model ('bart' or 't5')
+        - batch_size (int): the summarization batch size inside each chunk
+        - normalize (bool): whether to L2-normalise the embeddings
+        - mode (str): 'summarize', 'long' or 'direct', see run_pipeline
+        - chunk_size (int): the number of articles processed together
+        - pooling (str): 'mean' or 'weighted' chunk pooling of the direct mode
+
+        Yields:
+        tuple: the id, the summary and the float32 embedding of every article, in input order
+        """
+
+        if isinstance(texts, str):
+            raise TypeError("Input cannot be str")
+
+        for chunk in _batches(_with_ids(texts), chunk_size):
+            ids = [article_id for article_id, _ in chunk]
+            preprocessed_texts = normalize_batch([text for _, text in chunk], profile='vectorizer')
+            summaries, embeddings = run_pipeline(preprocessed_texts, model_name, batch_size, normalize, mode, pooling)
+            yield from zip(ids, summaries, embeddings)
+
+
+def iter_process_and_encode_url(urls, model_name='bart', batch_size=8, normalize=False, mode='summarize',
+                                chunk_size=32, pooling='mean'):
+        """
+        Download, process and encode an iterable of URLs, yielding the results as they complete
+
+        Parameters:
+        - urls (iterable): urls, or (id, url) tuples. Plain urls are used as their own id
+        - model_name (str): the name of the summarization model ('bart' or 't5')
+        - batch_size (int): the summarization batch size inside each chunk
+        - normalize (bool): whether to L2-normalise the embeddings
+        - mode (str): 'summarize', 'long' or 'direct', see run_pipeline
+        - chunk_size (int): the number of articles processed together
+        - pooling (str): 'mean' or 'weighted' chunk pooling of the direct mode
+
+        Yields:
+        tuple: the id, the summary and the float32 embedding of every article, in input order
+        """
+
+        if isinstance(urls, str):
+            raise TypeError("Input can not be str")
+
+        texts = ((item if isinstance(item, tuple) else (item, item)) for item in urls)
+        downloaded = ((url_id, download_parse_article(url)) for url_id, url in texts)
+        yield from iter_process_and_encode_articles(downloaded, model_name, batch_size, normalize, mode, chunk_size,
+                                                    pooling)
+
+
+def encode_dataset(df, output_path, model_name='bart', batch_size=8, mode='summarize', pooling='mean'):
         """
-        Encode a dataset of articles from the 'text' column and saves the embeddings to a numpy file
+        Encode a dataset of articles from the 'text' column and saves the embeddings to a numpy file,
+        and the 'Index' column, if any, to an ids file next to it
 
         Parameters:
         - df (pandas.DataFrame): the dataset containing a 'text' column with article texts
         - output_path (str): the path to save the embeddings numpy file
+        - model_name (str): the name of the summarization model ('bart' or 't5')
+        - batch_size (int): the summarization batch size, one article at a time if None
+        - mode (str): 'summarize' to embed the summaries, 'long' to summarize long articles with a map-reduce pass,
+          'direct' to embed the articles without summarizing them
+        - pooling (str): 'mean' or 'weighted' chunk pooling of the direct mode
 
         Returns:
         None
         """
 
         # Process and encode articles from the 'text' column of the DataFrame
-        summaries, embedding = process_and_encode_articles(df['text'])
+        summaries, embedding = process_and_encode_articles(list(df['text']), model_name, batch_size, mode=mode,
+                                                           pooling=pooling)
 
         # Save the embeddings to the specified output path as a numpy file
         np.save(output_path, embedding)
 
-def process_single_article(text, model_name='bart'):
+        # Save the article ids next to them, e.g. 'embeddings.ids.npy', for ID-mapped indexes
+        if 'Index' in df:
+            np.save(os.path.splitext(output_path)[0] + '.ids.npy', df['Index'].to_numpy())
+
+def process_single_article(text, model_name='bart', normalize=False, mode='summarize', pooling='mean'):
+        """
+        Process and encode a single article's text using the specified model ('bart' or 't5')
+
+        Parameters:
+        - text (str): the article text
+        - model_name (str): the name of the summarization model ('bart' or 't5')
+        - normalize (bool): whether to L2-normalise the embedding
+        - mode (str): 'summarize' to embed the summary, 'long' to summarize a long article with a map-reduce pass,
+          'direct' to embed the article without summarizing it
+        - pooling (str): 'mean' or 'weighted' chunk pooling of the direct mode
+
+        Returns:
+        tuple: the summary and a float32 matrix holding its embedding as a single row
+        """
         preprocessed_text = preprocess_text(text)
-        summary = summarize_text(preprocessed_text, model_name)
-        embedding = encode_text(summary)
-        return summary, embedding
+        summaries, embeddings = run_pipeline([preprocessed_text], model_name, normalize=normalize, mode=mode,
+                                             pooling=pooling)
+        return summaries[0], embeddings